@@ -0,0 +1,131 @@
+'''准入控制：每个上游、每个工具的并发上限和有界等待队列，过载时快速拒绝而不是无限排队'''
+import math
+import time
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Callable, Deque, Dict, Optional
+from .metrics import ADMISSION_QUEUE_SECONDS, ADMISSION_REJECTED
+
+
+class Overloaded(Exception):
+    '''队列已满（429）或排队超时（503），retry_after为建议的重试秒数'''
+    def __init__(self, status_code: int, retry_after: int, reason: str):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class AdmissionLimiter:
+    '''最多max_concurrency个同时执行，超出的按先来先到等待，等待的超过max_queue个时直接拒绝，等待超过queue_timeout秒时放弃'''
+    def __init__(self, scope: str, name: str, max_concurrency: int, max_queue: int, queue_timeout: float):
+        self.scope = scope
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+        self.avg_hold_seconds = 0.0     # 每次占用时长的指数移动平均，用于估算Retry-After
+        self.rejected = 0
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.avg_hold_seconds * (len(self.waiters) + 1) / self.max_concurrency))
+
+    async def acquire(self) -> float:
+        '''取得名额，返回取得的时间，release时传回'''
+        start = time.perf_counter()
+        if self.active < self.max_concurrency and not self.waiters:
+            self.active += 1
+            ADMISSION_QUEUE_SECONDS.observe(0, scope=self.scope, name=self.name)
+            return start
+        if len(self.waiters) >= self.max_queue:
+            self._reject("queue_full")
+            raise Overloaded(429, self.retry_after(), "%s [%s] is overloaded: queue is full" % (self.scope, self.name))
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout or None)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():    # 名额已经交给了这个等待者
+                self.release(time.perf_counter())
+            else:
+                waiter.cancel()
+                try:
+                    self.waiters.remove(waiter)
+                except ValueError:
+                    pass
+            if isinstance(e, asyncio.TimeoutError):
+                self._reject("queue_timeout")
+                raise Overloaded(503, self.retry_after(), "%s [%s] is overloaded: waited %ss in queue" % (self.scope, self.name, self.queue_timeout)) from None
+            raise
+        acquired_at = time.perf_counter()
+        ADMISSION_QUEUE_SECONDS.observe(acquired_at - start, scope=self.scope, name=self.name)
+        return acquired_at
+
+    def release(self, acquired_at: float):
+        self.avg_hold_seconds = 0.9 * self.avg_hold_seconds + 0.1 * (time.perf_counter() - acquired_at)
+        self.active -= 1
+        self._wake()    # 上限调小后，占用降到新上限以下才放行排队的
+
+    def set_max_concurrency(self, max_concurrency: int):
+        '''修改上限，保留当前的占用和排队；上限变大时立即放行排队的'''
+        self.max_concurrency = max_concurrency
+        self._wake()
+
+    def _wake(self):
+        '''按先来先到放行排队的，直到占满上限；放行时替等待者计入active'''
+        while self.active < self.max_concurrency and self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self.active += 1
+
+    @asynccontextmanager
+    async def slot(self):
+        acquired_at = await self.acquire()
+        try:
+            yield
+        finally:
+            self.release(acquired_at)
+
+    def _reject(self, reason: str):
+        self.rejected += 1
+        ADMISSION_REJECTED.inc(scope=self.scope, name=self.name, reason=reason)
+
+    def stats(self) -> dict:
+        return {"max_concurrency": self.max_concurrency, "active": self.active, "queued": len(self.waiters), "max_queue": self.max_queue,
+                "avg_hold_seconds": round(self.avg_hold_seconds, 6), "rejected": self.rejected}
+
+
+class AdmissionLimiters:
+    '''按名称（上游主机或工具名）懒创建的一组AdmissionLimiter，上限为0的名称不限制'''
+    def __init__(self, scope: str, max_concurrency_of: Callable[[str], int], max_queue: int, queue_timeout: float):
+        self.scope = scope
+        self.max_concurrency_of = max_concurrency_of
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.limiters: Dict[str, Optional[AdmissionLimiter]] = {}
+
+    def get(self, name: str) -> Optional[AdmissionLimiter]:
+        if name not in self.limiters:
+            max_concurrency = self.max_concurrency_of(name)
+            self.limiters[name] = AdmissionLimiter(self.scope, name, max_concurrency, self.max_queue, self.queue_timeout) if max_concurrency else None
+        return self.limiters[name]
+
+    def refresh(self, name: str):
+        '''重新读取上限（如工具重新加载后），已有的AdmissionLimiter继续使用，进行中的调用仍然计入占用'''
+        limiter = self.limiters.pop(name, None)
+        if limiter is None:
+            return
+        max_concurrency = self.max_concurrency_of(name)
+        if max_concurrency:
+            limiter.set_max_concurrency(max_concurrency)
+            self.limiters[name] = limiter
+        else:   # 不再限制，放行全部排队的
+            limiter.set_max_concurrency(limiter.active + len(limiter.waiters))
+
+    def stats(self) -> Dict[str, dict]:
+        return {name: limiter.stats() for name, limiter in self.limiters.items() if limiter is not None}
@@ -0,0 +1,76 @@
+'''SSE chunk解析的微基准：轻量解码（decode_chunk）对比逐个chunk构造pydantic对象。
+
+    python -m function_server.benchmark.chunks --chunks 5000 --repeat 5
+
+分别测文本增量和工具调用参数增量两种chunk，输出每个chunk的耗时（微秒）。
+'''
+import time
+import argparse
+from typing import Callable, List
+from openai.types.chat.chat_completion_chunk import ChatCompletionChunk, ChoiceDeltaToolCall
+from pydantic_core import from_json, to_json
+from ..streaming import ToolCallAssembler, decode_chunk
+
+
+def make_content_chunks(n: int) -> List[str]:
+    return [to_json({"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": 1700000000, "model": "gpt-4", "system_fingerprint": "fp_bench",
+                     "choices": [{"index": 0, "delta": {"content": "token%s " % i}, "logprobs": None, "finish_reason": None}]}).decode() for i in range(n)]
+
+def make_tool_call_chunks(n: int) -> List[str]:
+    chunks = [to_json({"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": 1700000000, "model": "gpt-4",
+                       "choices": [{"index": 0, "delta": {"tool_calls": [{"index": 0, "id": "call_bench", "type": "function", "function": {"name": "bench", "arguments": ""}}]}, "finish_reason": None}]}).decode()]
+    for i in range(n - 1):
+        chunks.append(to_json({"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": 1700000000, "model": "gpt-4",
+                               "choices": [{"index": 0, "delta": {"tool_calls": [{"index": 0, "function": {"arguments": "tok%s " % i}}]}, "finish_reason": None}]}).decode())
+    return chunks
+
+
+def pydantic_turn(chunks: List[str]):
+    '''原来的做法：允许不完整的JSON解析，再对每个chunk做完整的pydantic校验'''
+    tool_calls = []
+    for data in chunks:
+        chunk_dict = from_json(data, allow_partial=True)
+        chunk = ChatCompletionChunk.model_validate(chunk_dict)
+        delta = chunk.choices[0].delta
+        if delta.tool_calls:
+            for tcchunk in delta.tool_calls:
+                if len(tool_calls) <= tcchunk.index:
+                    tool_calls.append(tcchunk)
+                else:
+                    tool_calls[tcchunk.index].function.arguments += tcchunk.function.arguments
+    return tool_calls
+
+def fast_turn(chunks: List[str]):
+    assembler = ToolCallAssembler()
+    for data in chunks:
+        fields = decode_chunk(data)
+        if fields.tool_calls:
+            assembler.feed(fields.tool_calls)
+    return assembler.tool_calls
+
+
+def measure(func: Callable, chunks: List[str], repeat: int) -> float:
+    '''返回最好一次的每chunk耗时（微秒）'''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(chunks)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(chunks) * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description="micro benchmark of SSE chunk decoding")
+    parser.add_argument("--chunks", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print("%-12s %12s %12s %8s" % ("chunks", "pydantic_us", "fast_us", "speedup"))
+    for name, chunks in (("content", make_content_chunks(args.chunks)), ("tool_calls", make_tool_call_chunks(args.chunks))):
+        assert [tc.function.arguments for tc in pydantic_turn(chunks)] == [tc.function.arguments for tc in fast_turn(chunks)]
+        slow = measure(pydantic_turn, chunks, args.repeat)
+        fast = measure(fast_turn, chunks, args.repeat)
+        print("%-12s %12.2f %12.2f %7.1fx" % (name, slow, fast, slow / fast))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+'''本地的OpenAI兼容上游，用于基准测试。
+
+最后一条用户消息中的指令控制返回内容，例如 `bench: tool=bench_sleep iterations=2 seconds=0.05`：
+前 iterations 轮返回对 tool 的调用（请求带tools时为原生tool_calls，否则为伪装模式下content中的 [...]），之后返回文本回答。
+'''
+import re
+import time
+import asyncio
+import argparse
+from typing import AsyncIterator, List
+from fastapi import FastAPI, Request, Response
+from starlette.responses import StreamingResponse
+from pydantic_core import from_json, to_json
+
+
+BENCH_DIRECTIVE = re.compile(r"bench:((?:\s+\w+=[\w.]+)*)")
+
+def parse_directive(chat_request: dict) -> dict:
+    '''取出第一条用户消息里的 bench: 指令'''
+    for msg in chat_request["messages"]:
+        if msg["role"] == "user" and isinstance(msg.get("content"), str):
+            m = BENCH_DIRECTIVE.search(msg["content"])
+            if m:
+                return dict(kv.split("=", 1) for kv in m.group(1).split())
+    return {}
+
+def count_tool_iterations(chat_request: dict) -> int:
+    '''已经完成的工具调用轮数：原生模式数带tool_calls的assistant消息，伪装模式数工具结果消息'''
+    n = 0
+    for msg in chat_request["messages"]:
+        if msg["role"] == "assistant" and msg.get("tool_calls"):
+            n += 1
+        elif msg["role"] == "user" and str(msg.get("content", "")).startswith("# Tool Call Results"):
+            n += 1
+    return n
+
+
+class FakeUpstream:
+    def __init__(self, latency: float = 0.05, token_rate: float = 200, answer_tokens: int = 50):
+        self.latency = latency  # 首字节前的延迟（秒）
+        self.token_rate = token_rate    # 每秒输出的token数，0 表示不限速
+        self.answer_tokens = answer_tokens
+        self.app = FastAPI()
+        self.app.post("/v1/chat/completions")(self.chat_completions)
+
+    async def chat_completions(self, request: Request):
+        chat_request = from_json(await request.body())
+        directive = parse_directive(chat_request)
+        await asyncio.sleep(self.latency)
+
+        tool_name = directive.get("tool")
+        if tool_name and count_tool_iterations(chat_request) < int(directive.get("iterations", 1)):
+            arguments = {"seconds": float(directive.get("seconds", 0))}
+            if chat_request.get("tools"):
+                tool_calls = [{"index": 0, "id": "call_%s" % time.time_ns(), "type": "function", "function": {"name": tool_name, "arguments": to_json(arguments).decode()}}]
+                pieces = []
+            else:
+                tool_calls = None
+                pieces = ["Sure. ", to_json([{"index": 0, "id": "call_%s" % time.time_ns(), "function": {"arguments": arguments, "name": tool_name}, "type": "function"}]).decode()]
+        else:
+            tool_calls = None
+            pieces = ["token%s " % i for i in range(self.answer_tokens)]
+
+        if chat_request.get("stream"):
+            return StreamingResponse(self.iter_chunks(chat_request["model"], pieces, tool_calls), media_type="text/event-stream")
+
+        await self.sleep_tokens(len(pieces))
+        message = {"role": "assistant", "content": "".join(pieces) if pieces else None}
+        if tool_calls:
+            message["tool_calls"] = [{k: v for k, v in tc.items() if k != "index"} for tc in tool_calls]
+        body = {"id": "chatcmpl-bench", "object": "chat.completion", "created": int(time.time()), "model": chat_request["model"],
+                "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if tool_calls else "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(pieces), "total_tokens": len(pieces)}}
+        return Response(content=to_json(body), media_type="application/json")
+
+    async def iter_chunks(self, model: str, pieces: List[str], tool_calls: List[dict]) -> AsyncIterator[bytes]:
+        created = int(time.time())
+
+        def chunk(delta: dict, finish_reason: str = None) -> bytes:
+            return b"data: " + to_json({"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": created, "model": model,
+                                        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}) + b"\n\n"
+
+        yield chunk({"role": "assistant", "content": ""})
+        for piece in pieces:
+            await self.sleep_tokens(1)
+            yield chunk({"content": piece})
+        if tool_calls:
+            for tc in tool_calls:
+                arguments = tc["function"]["arguments"]
+                half = len(arguments) // 2
+                yield chunk({"tool_calls": [dict(tc, function={"name": tc["function"]["name"], "arguments": arguments[:half]})]})
+                yield chunk({"tool_calls": [{"index": tc["index"], "function": {"arguments": arguments[half:]}}]})
+        yield chunk({}, "tool_calls" if tool_calls else "stop")
+        yield b"data: [DONE]\n\n"
+
+    async def sleep_tokens(self, n: int):
+        if self.token_rate:
+            await asyncio.sleep(n / self.token_rate)
+
+
+def main():
+    import uvicorn
+    parser = argparse.ArgumentParser(description="fake OpenAI compatible upstream for benchmarks")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--token-rate", type=float, default=200)
+    parser.add_argument("--answer-tokens", type=int, default=50)
+    args = parser.parse_args()
+    uvicorn.run(FakeUpstream(args.latency, args.token_rate, args.answer_tokens).app, host="127.0.0.1", port=args.port, log_level="warning")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+'''伪装模式消息改写的微基准：单次遍历+逐轮追加，对比原来每个改写步骤都复制整个消息列表的做法。
+
+    python -m function_server.benchmark.messages --sizes 10 100 1000 --iterations 3
+
+每个请求先做一次首轮改写（含用客户端返回的结果补全最后一批工具调用），再模拟 iterations 轮服务端工具循环，分别输出首轮改写和每轮追加的耗时，以及每轮序列化请求体的耗时（整体to_json对比只序列化新消息）。
+'''
+import copy
+import time
+import argparse
+from io import StringIO
+from typing import Callable, List
+from openai.types.chat.chat_completion_message_tool_call import ChatCompletionMessageToolCall
+from pydantic_core import from_json, to_json
+from ..function_calling import ToolCallResult
+from ..fake_messages import fake_chat_request_if_need, add_tool_calls_result_messages, encode_chat_request, get_function_calling_propmt
+from ..settings import FAKE_ALL_MODEL, NO_FAKE_MODELS
+
+
+TOOLS = [{"type": "function", "function": {"name": "lookup_%s" % i, "description": "look up something", "parameters": {"type": "object", "properties": {"q": {"type": "string"}}}}} for i in range(5)]
+
+def make_chat_request(n: int) -> dict:
+    '''n条历史消息：用户提问、助手调用工具、工具结果、助手回答循环出现，最后一批工具调用的结果由客户端返回'''
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    i = 0
+    while len(messages) < n:
+        messages.append({"role": "user", "content": "question %s " % i * 10})
+        messages.append({"role": "assistant", "content": None, "tool_calls": [{"id": "call_%s" % i, "type": "function", "function": {"name": "lookup_0", "arguments": '{"q": "q%s"}' % i}}]})
+        messages.append({"role": "tool", "tool_call_id": "call_%s" % i, "content": "result %s " % i * 20})
+        messages.append({"role": "assistant", "content": "answer %s " % i * 20})
+        i += 1
+    messages = messages[:n]
+    while messages[-1]["role"] != "tool":
+        messages.pop()
+    return {"model": "bench|gpt-4", "messages": messages}
+
+def make_replacement(chat_request: dict) -> List[ToolCallResult]:
+    last = [m for m in chat_request["messages"] if m.get("tool_calls")][-1]
+    return [ToolCallResult(id=tc["id"], result="client result", tool_call=ChatCompletionMessageToolCall.model_validate(tc)) for tc in last["tool_calls"]]
+
+def make_loop_results(i: int) -> List[ToolCallResult]:
+    tool_call = ChatCompletionMessageToolCall(id="call_loop_%s" % i, type="function", function={"name": "lookup_1", "arguments": '{"q": "loop"}'})
+    return [ToolCallResult(id=tool_call.id, result="loop result " * 20, tool_call=tool_call)]
+
+
+def legacy_fake_chat_request_if_need(chat_request, server_tools, replacement_tool_call_results):
+    '''原来的实现：每个改写步骤都重建一次消息列表'''
+    if chat_request.get("tools"):
+        server_tools.extend(chat_request["tools"])
+    chat_request["tools"] = server_tools
+    messages = list(chat_request["messages"])
+    if replacement_tool_call_results:
+        last_toolcalls_message_index = [i for i in range(len(messages)) if messages[i].get("tool_calls")][-1]
+        messages = messages[:last_toolcalls_message_index+1]
+        messages[-1]["tool_calls"] = [tcr.tool_call.model_dump() for tcr in replacement_tool_call_results]
+        for tcr in replacement_tool_call_results:
+            messages.append({"role": "tool", "tool_call_id": tcr.id, "content": tcr.result})
+    chat_request["messages"] = messages
+    if FAKE_ALL_MODEL or (chat_request["model"] not in NO_FAKE_MODELS):
+        chat_request["model"] = str(chat_request["model"]).split("|")[-1]
+        if chat_request.get("tools"):
+            prompt = get_function_calling_propmt(to_json(chat_request["tools"]).decode())
+            messages, is_added = [], False
+            for msg in chat_request["messages"]:
+                if msg["role"] != 'system' and not is_added:
+                    messages.append({"role": "system", "content": prompt})
+                    is_added = True
+                messages.append(msg)
+            chat_request["messages"] = messages
+            chat_request["tools"] = None
+        for message in chat_request["messages"]:
+            if message.get("tool_calls"):
+                message["content"] = to_json(message["tool_calls"]).decode()
+                message["tool_calls"] = None
+        tool_messages = [message for message in chat_request["messages"] if message["role"] == "tool"]
+        if tool_messages:
+            builder = StringIO()
+            builder.write("# Tool Call Results:\n")
+            for message in tool_messages:
+                builder.write(f"- id: `{message['tool_call_id']}`\n```\n{message['content']}\n```\n")
+            messages = [message for message in chat_request["messages"] if message["role"] != "tool"]
+            messages.append({"role": "user", "content": builder.getvalue()})
+            chat_request["messages"] = messages
+
+def legacy_add_tool_calls_result_messages(chat_request, tool_calls_results):
+    messages = [message for message in chat_request["messages"]]
+    if chat_request.get("tools"):
+        messages.append({"role": "assistant", "tool_calls": [tcr.tool_call.model_dump() for tcr in tool_calls_results]})
+        for tcr in tool_calls_results:
+            messages.append({"role": "tool", "tool_call_id": tcr.id, "content": tcr.result})
+    else:
+        messages.append({"role": "assistant", "content": to_json([tcr.tool_call.model_dump() for tcr in tool_calls_results], indent=2).decode()})
+        builder = StringIO()
+        builder.write("# Tool Call Results:\n")
+        for tcr in tool_calls_results:
+            builder.write(f"- id: `{tcr.id}`\n```\n{tcr.result}\n```\n")
+        messages.append({"role": "user", "content": builder.getvalue()})
+    chat_request["messages"] = messages
+
+
+def run_pipeline(fake: Callable, add: Callable, chat_request: dict, iterations: int) -> dict:
+    fake(chat_request, list(TOOLS), make_replacement(chat_request))
+    for i in range(iterations):
+        add(chat_request, make_loop_results(i))
+    return chat_request
+
+def measure(fake: Callable, add: Callable, n: int, iterations: int, repeat: int) -> tuple[float, float]:
+    '''返回最好一次的首轮改写耗时（毫秒）和每轮追加耗时（微秒），不计构造请求和工具结果的时间'''
+    template = make_chat_request(n)
+    best_prepare, best_iteration = None, None
+    for _ in range(repeat):
+        chat_request = copy.deepcopy(template)
+        replacement = make_replacement(chat_request)
+        loop_results = [make_loop_results(i) for i in range(iterations)]
+        start = time.perf_counter()
+        fake(chat_request, list(TOOLS), replacement)
+        prepared = time.perf_counter()
+        for results in loop_results:
+            add(chat_request, results)
+        end = time.perf_counter()
+        best_prepare = prepared - start if best_prepare is None else min(best_prepare, prepared - start)
+        best_iteration = (end - prepared) / iterations if best_iteration is None else min(best_iteration, (end - prepared) / iterations)
+    return best_prepare * 1000, best_iteration * 1e6
+
+def measure_encode(encode: Callable, n: int, iterations: int, repeat: int) -> float:
+    '''返回最好一次的每轮（追加+序列化）耗时（微秒）'''
+    best = None
+    for _ in range(repeat):
+        chat_request = make_chat_request(n)
+        fake_chat_request_if_need(chat_request, list(TOOLS), make_replacement(chat_request))
+        loop_results = [make_loop_results(i) for i in range(iterations)]
+        encode(chat_request)
+        start = time.perf_counter()
+        for results in loop_results:
+            add_tool_calls_result_messages(chat_request, results)
+            encode(chat_request)
+        elapsed = (time.perf_counter() - start) / iterations
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description="micro benchmark of the fake mode message transforms")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--iterations", type=int, default=3, help="tool loop iterations per request")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    print("%-10s %18s %18s %20s %20s %18s %18s" % ("messages", "legacy_prepare_ms", "single_prepare_ms", "legacy_iteration_us", "single_iteration_us", "to_json_encode_us", "incr_encode_us"))
+    for n in args.sizes:
+        legacy = run_pipeline(legacy_fake_chat_request_if_need, legacy_add_tool_calls_result_messages, make_chat_request(n), args.iterations)
+        single = run_pipeline(fake_chat_request_if_need, add_tool_calls_result_messages, make_chat_request(n), args.iterations)
+        assert to_json(legacy) == to_json(single), "transforms are not equivalent"
+        assert from_json(encode_chat_request(single)) == from_json(to_json(single)), "incremental encoding is not equivalent"
+        legacy_prepare, legacy_iteration = measure(legacy_fake_chat_request_if_need, legacy_add_tool_calls_result_messages, n, args.iterations, args.repeat)
+        single_prepare, single_iteration = measure(fake_chat_request_if_need, add_tool_calls_result_messages, n, args.iterations, args.repeat)
+        full_encode = measure_encode(to_json, n, args.iterations, args.repeat)
+        incr_encode = measure_encode(encode_chat_request, n, args.iterations, args.repeat)
+        print("%-10s %18.3f %18.3f %20.1f %20.1f %18.1f %18.1f" % (n, legacy_prepare, single_prepare, legacy_iteration, single_iteration, full_encode, incr_encode))
+
+if __name__ == '__main__':
+    main()
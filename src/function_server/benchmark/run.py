@@ -0,0 +1,246 @@
+'''端到端基准测试：启动本地假上游和带桩工具的function server，压测代理路由和 /toolcalls。
+
+    python -m function_server.benchmark --requests 200 --concurrency 20
+    python -m function_server.benchmark --scenario tool_loop_stream --tool-latency 0.2 --json result.json
+
+每个场景输出吞吐、延迟p50/p95/p99、首字节时间（TTFB）以及服务进程每个并发请求的峰值内存增量。
+'''
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import subprocess
+from dataclasses import dataclass, field
+from typing import List, Optional
+import httpx
+
+
+CLIENT_TOOL = {"type": "function", "function": {"name": "client_lookup", "description": "a tool executed by the client", "parameters": {"type": "object", "properties": {"seconds": {"type": "number"}}}}}
+
+@dataclass
+class Scenario:
+    name: str
+    stream: bool = False
+    model: str = "gpt-4"    # NO_FAKE_MODELS 中的模型走原生tool_calls，加 "xxx|" 前缀走伪装模式
+    tool: str = None
+    iterations: int = 1
+    client_tools: bool = False
+    toolcalls_batch: int = 0    # 大于0时压测 /toolcalls
+
+def get_scenarios(tool_latency: float) -> List[Scenario]:
+    return [
+        Scenario("single_turn"),
+        Scenario("single_turn_stream", stream=True),
+        Scenario("tool_loop", tool="bench_sleep", iterations=3),
+        Scenario("tool_loop_stream", stream=True, tool="bench_sleep", iterations=3),
+        Scenario("async_tool_loop_stream", stream=True, tool="bench_async_sleep", iterations=3),
+        Scenario("fake_tool_loop", model="bench|gpt-4", tool="bench_sleep", iterations=3),
+        Scenario("fake_tool_loop_stream", stream=True, model="bench|gpt-4", tool="bench_sleep", iterations=3),
+        Scenario("client_handoff", tool="client_lookup", client_tools=True),
+        Scenario("client_handoff_stream", stream=True, tool="client_lookup", client_tools=True),
+        Scenario("toolcalls", toolcalls_batch=5),
+    ]
+
+@dataclass
+class Result:
+    scenario: str
+    requests: int = 0
+    errors: int = 0
+    elapsed: float = 0
+    latencies: List[float] = field(default_factory=list)
+    ttfbs: List[float] = field(default_factory=list)
+    peak_rss_delta_kb: Optional[int] = None
+    concurrency: int = 1
+
+    def summary(self) -> dict:
+        return {
+            "scenario": self.scenario,
+            "requests": self.requests,
+            "errors": self.errors,
+            "rps": round(self.requests / self.elapsed, 1) if self.elapsed else 0,
+            "p50_ms": percentile_ms(self.latencies, 50),
+            "p95_ms": percentile_ms(self.latencies, 95),
+            "p99_ms": percentile_ms(self.latencies, 99),
+            "ttfb_p50_ms": percentile_ms(self.ttfbs, 50),
+            "ttfb_p95_ms": percentile_ms(self.ttfbs, 95),
+            "mem_per_request_kb": self.peak_rss_delta_kb // self.concurrency if self.peak_rss_delta_kb is not None else None,
+        }
+
+def percentile_ms(values: List[float], p: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * p / 100))] * 1000, 1)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_process(module: str, port: int, *args: str) -> subprocess.Popen:
+    env = dict(os.environ, LOG_LEVEL=os.environ.get("LOG_LEVEL", "WARNING"))
+    process = subprocess.Popen([sys.executable, "-m", module, "--port", str(port), *args], env=env)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return process
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError("%s exited with %s" % (module, process.returncode))
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("%s did not start" % module)
+
+def read_rss_kb(pid: int) -> Optional[int]:
+    try:
+        with open("/proc/%s/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def build_chat_request(scenario: Scenario, i: int, tool_latency: float) -> dict:
+    directive = "bench:"
+    if scenario.tool:
+        directive += " tool=%s iterations=%s seconds=%s" % (scenario.tool, scenario.iterations, tool_latency)
+    chat_request = {"model": scenario.model, "stream": scenario.stream,
+                    "messages": [{"role": "user", "content": "request %s-%s %s" % (scenario.name, i, directive)}]}    # 每个请求不同，避免被合并
+    if scenario.client_tools:
+        chat_request["tools"] = [CLIENT_TOOL]
+    return chat_request
+
+async def timed_post(client: httpx.AsyncClient, url: str, body) -> tuple[float, float, httpx.Response, bytes]:
+    '''返回 (首字节时间, 总时间, 响应, 响应体)'''
+    start = time.perf_counter()
+    ttfb = None
+    content = bytearray()
+    async with client.stream("POST", url, json=body) as response:
+        async for data in response.aiter_bytes():
+            if ttfb is None:
+                ttfb = time.perf_counter() - start
+            content.extend(data)
+    total = time.perf_counter() - start
+    return ttfb if ttfb is not None else total, total, response, bytes(content)
+
+def parse_client_tool_calls(content: bytes, stream: bool) -> list:
+    if not stream:
+        return json.loads(content)["choices"][0]["message"].get("tool_calls") or []
+    tool_calls = []
+    for line in content.decode().splitlines():
+        if line.startswith("data: {"):
+            delta = json.loads(line[6:])["choices"][0]["delta"]
+            tool_calls.extend(delta.get("tool_calls") or [])
+    return [{"id": tc["id"], "type": "function", "function": tc["function"]} for tc in tool_calls]
+
+async def run_one(client: httpx.AsyncClient, server_url: str, upstream_url: str, scenario: Scenario, i: int, tool_latency: float) -> tuple[float, float]:
+    if scenario.toolcalls_batch:
+        tool_calls = [{"id": "call_%s_%s" % (i, j), "type": "function", "function": {"name": "bench_sleep", "arguments": json.dumps({"seconds": tool_latency})}} for j in range(scenario.toolcalls_batch)]
+        ttfb, total, response, _ = await timed_post(client, "%s/toolcalls" % server_url, tool_calls)
+        response.raise_for_status()
+        return ttfb, total
+
+    url = "%s/%s/v1/chat/completions" % (server_url, upstream_url)
+    chat_request = build_chat_request(scenario, i, tool_latency)
+    ttfb, total, response, content = await timed_post(client, url, chat_request)
+    response.raise_for_status()
+    if scenario.client_tools:   # 客户端执行工具后带着结果再请求一次
+        tool_calls = parse_client_tool_calls(content, scenario.stream)
+        if not tool_calls:
+            raise RuntimeError("no client tool calls returned")
+        chat_request["messages"].append({"role": "assistant", "content": None, "tool_calls": tool_calls})
+        for tc in tool_calls:
+            chat_request["messages"].append({"role": "tool", "tool_call_id": tc["id"], "content": "client result"})
+        _, total2, response, _ = await timed_post(client, url, chat_request)
+        response.raise_for_status()
+        total += total2
+    return ttfb, total
+
+async def run_scenario(server_url: str, upstream_url: str, server_pid: int, scenario: Scenario, requests: int, concurrency: int, tool_latency: float) -> Result:
+    result = Result(scenario.name, concurrency=concurrency)
+    queue = iter(range(requests))
+    baseline_rss = read_rss_kb(server_pid)
+    peak_rss = baseline_rss
+
+    async def worker(client: httpx.AsyncClient):
+        for i in queue:
+            try:
+                ttfb, total = await run_one(client, server_url, upstream_url, scenario, i, tool_latency)
+                result.ttfbs.append(ttfb)
+                result.latencies.append(total)
+            except Exception as e:
+                result.errors += 1
+                if result.errors == 1:
+                    print("  %s error: %r" % (scenario.name, e))
+            result.requests += 1
+
+    async def sample_rss():
+        nonlocal peak_rss
+        while True:
+            rss = read_rss_kb(server_pid)
+            if rss is not None:
+                peak_rss = max(peak_rss, rss)
+            await asyncio.sleep(0.05)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=600, limits=limits) as client:
+        sampler = asyncio.create_task(sample_rss())
+        start = time.perf_counter()
+        await asyncio.gather(*[worker(client) for _ in range(concurrency)])
+        result.elapsed = time.perf_counter() - start
+        sampler.cancel()
+    if baseline_rss is not None:
+        result.peak_rss_delta_kb = peak_rss - baseline_rss
+    return result
+
+
+def print_table(summaries: List[dict]):
+    columns = ["scenario", "requests", "errors", "rps", "p50_ms", "p95_ms", "p99_ms", "ttfb_p50_ms", "ttfb_p95_ms", "mem_per_request_kb"]
+    widths = [max(len(c), *(len(str(s[c])) for s in summaries)) for c in columns]
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)))
+    for s in summaries:
+        print("  ".join(str(s[c]).ljust(w) for c, w in zip(columns, widths)))
+
+def main():
+    parser = argparse.ArgumentParser(description="end-to-end benchmark of function_server against a local fake upstream")
+    parser.add_argument("--scenario", action="append", help="scenario name, can repeat; default all")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.05, help="upstream latency before first byte (s)")
+    parser.add_argument("--token-rate", type=float, default=500, help="upstream tokens per second, 0 for unlimited")
+    parser.add_argument("--answer-tokens", type=int, default=50)
+    parser.add_argument("--tool-latency", type=float, default=0.05, help="stub tool latency (s)")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    scenarios = get_scenarios(args.tool_latency)
+    if args.scenario:
+        scenarios = [s for s in scenarios if s.name in args.scenario]
+
+    upstream_port, server_port = free_port(), free_port()
+    upstream = start_process("function_server.benchmark.fake_upstream", upstream_port, "--latency", str(args.latency), "--token-rate", str(args.token_rate), "--answer-tokens", str(args.answer_tokens))
+    server = start_process("function_server.benchmark.server", server_port)
+    try:
+        summaries = []
+        for scenario in scenarios:
+            result = asyncio.run(run_scenario("http://127.0.0.1:%s" % server_port, "http://127.0.0.1:%s" % upstream_port, server.pid, scenario, args.requests, args.concurrency, args.tool_latency))
+            summaries.append(result.summary())
+        print_table(summaries)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(summaries, f, indent=2)
+    finally:
+        server.terminate()
+        upstream.terminate()
+        server.wait()
+        upstream.wait()
+
+if __name__ == '__main__':
+    main()
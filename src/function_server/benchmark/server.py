@@ -0,0 +1,34 @@
+'''基准测试用的function server：在正常的服务上注册可控延迟的桩工具'''
+import time
+import asyncio
+import argparse
+from openai_function_calling.tool_helpers import ToolHelpers
+from ..function_calling import tool, update_tools
+
+
+@tool
+def bench_sleep(seconds: float = 0) -> str:
+    '''benchmark stub tool, sleeps for the given seconds in a thread.'''
+    time.sleep(seconds)
+    return "slept %s" % seconds
+
+@tool
+async def bench_async_sleep(seconds: float = 0) -> str:
+    '''benchmark stub tool, sleeps for the given seconds on the event loop.'''
+    await asyncio.sleep(seconds)
+    return "slept %s" % seconds
+
+def register_stub_tools():
+    update_tools({func.__name__: (func, ToolHelpers.infer_from_function_refs([func])[0]) for func in (bench_sleep, bench_async_sleep)})
+
+def main():
+    import uvicorn
+    from ..main import app
+    parser = argparse.ArgumentParser(description="function server with benchmark stub tools")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+    register_stub_tools()
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+if __name__ == '__main__':
+    main()
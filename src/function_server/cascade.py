@@ -0,0 +1,145 @@
+'''级联模式：把其他function server的工具合并到本地工具列表，调用时按批转发到对应服务的 /toolcalls'''
+import time
+import asyncio
+from typing import Dict, List, Optional, Union
+import httpx
+from openai.types.chat.chat_completion_chunk import ChoiceDeltaToolCall
+from openai.types.chat.chat_completion_message_tool_call import ChatCompletionMessageToolCall
+from openai.types.chat import ChatCompletionToolParam
+from loguru import logger
+from .function_calling import ToolCallResult, current_tools, update_tools, error_result, tool
+from .upstream import UpstreamClients
+
+
+class RemoteFunctionServer:
+    '''一个远程function server。工具列表只在启动和定期重新验证（If-None-Match）时获取，不在请求路径上；
+    同一轮事件循环中发给它的工具调用合成一个 /toolcalls 请求，走该服务的连接池'''
+    def __init__(self, base_url: str, upstream_clients: UpstreamClients):
+        self.base_url = base_url.rstrip("/")
+        self.upstream_clients = upstream_clients
+        self.catalog: List[ChatCompletionToolParam] = []
+        self.etag: str = None
+        self.fetched_at: float = None
+        self.tool_names: List[str] = []     # 实际合并到本地的工具，本地同名工具优先
+        self.pending: List[tuple[Union[ChatCompletionMessageToolCall, ChoiceDeltaToolCall], asyncio.Future]] = []
+        self.batches = 0
+        self.calls = 0
+        self.errors = 0
+
+    async def refresh(self) -> bool:
+        '''重新验证工具列表，有变化时返回True；失败时保留之前的列表'''
+        headers = {"if-none-match": self.etag} if self.etag else {}
+        try:
+            resp = await self.upstream_clients.get(self.base_url).get(self.base_url + "/tools", headers=headers)
+        except httpx.HTTPError as e:
+            logger.warning("fetch tools of [%s] error: %s" % (self.base_url, e))
+            return False
+        if resp.status_code == 304:
+            self.fetched_at = time.time()
+            return False
+        if resp.status_code != 200:
+            logger.warning("fetch tools of [%s] error: %s %s" % (self.base_url, resp.status_code, resp.text))
+            return False
+        self.catalog = resp.json()
+        self.etag = resp.headers.get("etag")
+        self.fetched_at = time.time()
+        return True
+
+    def call(self, tool_call: Union[ChatCompletionMessageToolCall, ChoiceDeltaToolCall]) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((tool_call, future))
+        if len(self.pending) == 1:
+            loop.call_soon(self._flush)     # 同一批中其他工具的Task也在这一轮执行，会加入同一个请求
+        return future
+
+    def _flush(self):
+        batch, self.pending = self.pending, []
+        asyncio.ensure_future(self._send(batch))
+
+    async def _send(self, batch: List[tuple[Union[ChatCompletionMessageToolCall, ChoiceDeltaToolCall], asyncio.Future]]):
+        self.batches += 1
+        self.calls += len(batch)
+        results: Dict[str, dict] = {}
+        try:
+            # 一批中可能有多个请求的工具调用，它们的id可能相同（fake模式都从call_0开始），发送时按序号改写id
+            payload = [dict(tc.model_dump(), id=str(i)) for i, (tc, _) in enumerate(batch)]
+            resp = await self.upstream_clients.get(self.base_url).post(self.base_url + "/toolcalls", json=payload)
+            if resp.status_code != 200:
+                raise ValueError("%s %s" % (resp.status_code, resp.text))
+            results = {r["id"]: r for r in resp.json()["results"]}
+        except Exception as e:
+            logger.warning("call tools on [%s] error: %s" % (self.base_url, e))
+            self.errors += 1
+        for i, (tc, future) in enumerate(batch):
+            if future.done():
+                continue
+            result = results.get(str(i))
+            if result is None:
+                future.set_result(error_result(tc, "error on %s" % self.base_url))
+                continue
+            tcr = ToolCallResult(id=tc.id, result=result["result"], tool_call=tc)
+            tcr._is_error = bool(result.get("error"))  # 远程工具出错时同样作为错误结果
+            future.set_result(tcr)
+
+    def stats(self) -> dict:
+        return {"tools": self.tool_names, "etag": self.etag, "fetched_at": self.fetched_at, "batches": self.batches, "calls": self.calls, "errors": self.errors}
+
+
+def remote_tool(server: RemoteFunctionServer, name: str):
+    '''远程工具在本地工具列表中的占位函数，acalling按remote_server把调用交给远程服务'''
+    async def call_remote_tool(**kwargs):
+        raise RuntimeError("remote tool [%s] must be called through %s" % (name, server.base_url))
+    call_remote_tool.__name__ = name
+    func = tool(call_remote_tool)
+    func.remote_server = server
+    return func
+
+
+class Cascade:
+    '''管理全部远程服务，把它们的工具合并进工具快照'''
+    def __init__(self, base_urls: List[str], upstream_clients: UpstreamClients, refresh_seconds: float):
+        self.servers = [RemoteFunctionServer(url, upstream_clients) for url in base_urls]
+        self.refresh_seconds = refresh_seconds
+        self.refresh_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        await self.refresh()
+        if self.servers and self.refresh_seconds:
+            self.refresh_task = asyncio.ensure_future(self._refresh_forever())
+
+    async def refresh(self):
+        changed = await asyncio.gather(*[server.refresh() for server in self.servers])
+        for server, is_changed in zip(self.servers, changed):
+            if is_changed:
+                self._merge(server)
+
+    def _merge(self, server: RemoteFunctionServer):
+        tools = current_tools()
+        remove = [name for name in server.tool_names if getattr(tools.get(name, (None, None))[0], "remote_server", None) is server]
+        add = {}
+        server.tool_names = []
+        for tool_param in server.catalog:
+            name = tool_param["function"]["name"]
+            if name in tools and name not in remove:
+                logger.warning("remote tool [%s] of [%s] is ignored, a tool with the same name already exists" % (name, server.base_url))
+                continue
+            add[name] = (remote_tool(server, name), tool_param)
+            server.tool_names.append(name)
+        update_tools(add, remove)
+        logger.info("load remote tools of [%s]: %s" % (server.base_url, ", ".join(server.tool_names)))
+
+    async def _refresh_forever(self):
+        while True:
+            await asyncio.sleep(self.refresh_seconds)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning("refresh remote tools error: %s" % e)
+
+    def stats(self) -> Dict[str, dict]:
+        return {server.base_url: server.stats() for server in self.servers}
+
+    async def aclose(self):
+        if self.refresh_task is not None:
+            self.refresh_task.cancel()
@@ -12,108 +12,108 @@ from openai.types.chat.chat_completion_chunk import ChoiceDeltaToolCall
 from pydantic import BaseModel, ValidationError, TypeAdapter
 from pydantic_core import from_json, to_json
 from inspect import cleandoc
+from functools import lru_cache
+from itertools import chain, islice
 from .function_calling import ToolCallResult
-from .settings import FAKE_ALL_MODEL, NO_FAKE_MODELS
+from .settings import FAKE_ALL_MODEL, NO_FAKE_MODELS, PROMPT_TIME_GRANULARITY_SECONDS
 from loguru import logger
 
 
 class ChatCompletionsRequest(CompletionCreateParamsBase):
     model: Union[str]   # 不限制model名
 
-def fake_chat_request_if_need(chat_request: ChatCompletionsRequest, server_tools: List[ChatCompletionToolParam], replacement_tool_call_results: List[ToolCallResult]):
-    if chat_request.get("tools"):             
-        chat_request["tools"] = server_tools.extend(chat_request["tools"])
-    chat_request["tools"] = server_tools
+TOOL_CALLS_ADAPTER = TypeAdapter(List[ChatCompletionMessageToolCall])
 
-    messages = list(chat_request["messages"])
-    if replacement_tool_call_results:
-        last_toolcalls_message_index = [i for i in range(len(messages)) if messages[i].get("tool_calls")][-1]
-        messages = messages[:last_toolcalls_message_index+1]
+class ChatMessages(list):
+    '''改写后的消息列表，工具循环中只在末尾追加，已有消息不再修改，因此可以缓存每条消息序列化后的JSON'''
+    def __init__(self, messages: Iterable = ()):
+        super().__init__(messages)
+        self.encoded: List[bytes] = []
 
-        tool_calls_msg = messages[-1]
-        tool_calls_msg["tool_calls"] = [tcr.tool_call.model_dump() for tcr in replacement_tool_call_results]
-        for tcr in replacement_tool_call_results:
-            messages.append(ChatCompletionToolMessageParam(role = 'tool', tool_call_id=tcr.id, content=tcr.result))
-    chat_request["messages"] = messages
+def encode_chat_request(chat_request: ChatCompletionsRequest) -> bytes:
+    '''序列化请求体，消息列表为ChatMessages时只序列化新追加的消息'''
+    messages = chat_request.get("messages")
+    if not isinstance(messages, ChatMessages):
+        return to_json(chat_request)
+    for msg in messages[len(messages.encoded):]:
+        messages.encoded.append(to_json(msg))
+    body = to_json({k: v for k, v in chat_request.items() if k != "messages"})
+    return body[:-1] + (b',' if len(body) > 2 else b'') + b'"messages":[' + b','.join(messages.encoded) + b']}'
 
-    if FAKE_ALL_MODEL or (chat_request["model"] not in NO_FAKE_MODELS):
-        chat_request["model"] = str(chat_request["model"]).split("|")[-1]
-        add_function_promt_message_replace_tool_call(chat_request)
-        rewrite_assistant_tool_calls_to_content(chat_request)
-        merge_tool_messages_and_replcae_by_user(chat_request)
-
-def rewrite_assistant_tool_calls_to_content(chat_request: ChatCompletionsRequest):
-    for message in chat_request["messages"]:
-        if message.get("tool_calls"):
-            message["content"] = to_json(message["tool_calls"])
-            message["tool_calls"] = None
-
-def merge_tool_messages_and_replcae_by_user(chat_request: ChatCompletionsRequest):
-    tool_messages = [message for message in chat_request["messages"] if message["role"] == "tool"]
-    if not tool_messages:
-        return
-    results_content_builder = StringIO()
-    results_content_builder.write("# Tool Call Results:\n")
-    for message in tool_messages:
-            tool_call_id = message["tool_call_id"]
-            content = message["content"]
-            results_content_builder.write(f"- id: `{tool_call_id}`\n```\n{content}\n```\n")
-
-    messages = [message for message in chat_request["messages"] if message["role"] != "tool"]
-    messages.append(ChatCompletionSystemMessageParam(role = 'user', content = results_content_builder.getvalue()))
-    chat_request["messages"] = messages
 
-def add_function_promt_message_replace_tool_call(chat_request: ChatCompletionsRequest):
-    if not chat_request.get("tools"):
-        return
-    tools_json = to_json(chat_request["tools"], indent=2).decode()
-    function_calling_prompt = get_function_calling_propmt(tools_json)
+def fake_chat_request_if_need(chat_request: ChatCompletionsRequest, server_tools: List[ChatCompletionToolParam], replacement_tool_call_results: List[ToolCallResult]):
+    '''一次遍历完成所有改写：用服务端结果补全最后一批工具调用；伪装模式下插入提示词、把tool_calls改写为content、把工具结果合并为一条user消息'''
+    chat_request["tools"] = server_tools + list(chat_request["tools"]) if chat_request.get("tools") else server_tools
 
-    is_added = False
-    messages = []
-    
-    for msg in chat_request["messages"]:
-        if msg["role"] != 'system' and not is_added:
-            messages.append(ChatCompletionSystemMessageParam(role = 'system', content = function_calling_prompt))
-            is_added = True
-        messages.append(msg)
+    is_fake = FAKE_ALL_MODEL or (chat_request["model"] not in NO_FAKE_MODELS)
+    function_calling_prompt = None
+    if is_fake:
+        chat_request["model"] = str(chat_request["model"]).split("|")[-1]
+        if chat_request["tools"]:
+            function_calling_prompt = get_function_calling_propmt(to_json(chat_request["tools"]).decode())
+            chat_request["tools"] = None
 
+    source = chat_request["messages"]
+    if replacement_tool_call_results:
+        last_toolcalls_message_index = next(i for i in range(len(source) - 1, -1, -1) if source[i].get("tool_calls"))
+        source[last_toolcalls_message_index]["tool_calls"] = [tcr.tool_call.model_dump() for tcr in replacement_tool_call_results]
+        replacement_messages = [ChatCompletionToolMessageParam(role = 'tool', tool_call_id=tcr.id, content=tcr.result) for tcr in replacement_tool_call_results]
+        source = chain(islice(source, last_toolcalls_message_index + 1), replacement_messages)
+
+    messages = ChatMessages()
+    results_content_builder = None
+    for msg in source:
+        if is_fake:
+            if function_calling_prompt is not None and msg["role"] != 'system':
+                messages.append(ChatCompletionSystemMessageParam(role = 'system', content = function_calling_prompt))
+                function_calling_prompt = None
+            if msg["role"] == "tool":
+                if results_content_builder is None:
+                    results_content_builder = StringIO()
+                    results_content_builder.write("# Tool Call Results:\n")
+                write_tool_call_result(results_content_builder, msg["tool_call_id"], msg["content"])
+                continue
+            if msg.get("tool_calls"):
+                msg["content"] = to_json(msg["tool_calls"]).decode()
+                msg["tool_calls"] = None
+        messages.append(msg)
+    if results_content_builder is not None:
+        messages.append(ChatCompletionUserMessageParam(role = 'user', content = results_content_builder.getvalue()))
     chat_request["messages"] = messages
-    chat_request["tools"] = None
+
+def write_tool_call_result(builder: StringIO, tool_call_id: str, content: str):
+    builder.write(f"- id: `{tool_call_id}`\n```\n{content}\n```\n")
 
 def add_tool_calls_result_messages(chat_request: ChatCompletionsRequest, tool_calls_results: List[ToolCallResult]):
+    '''工具循环每一轮只在已改写过的消息列表末尾追加，不复制和重新扫描历史消息'''
     if not tool_calls_results:
         return
 
-    messages = [message for message in chat_request["messages"]]
+    messages = chat_request["messages"]
+    tool_calls = [tcr.tool_call.model_dump() for tcr in tool_calls_results]
     if chat_request.get("tools"):
-        messages.append(ChatCompletionAssistantMessageParam(role = 'assistant', tool_calls=[tcr.tool_call.model_dump() for tcr in tool_calls_results]))
+        messages.append(ChatCompletionAssistantMessageParam(role = 'assistant', tool_calls=tool_calls))
         for tcr in tool_calls_results:
             messages.append(ChatCompletionToolMessageParam(role = 'tool', tool_call_id=tcr.id, content=tcr.result))
     else:
-        messages.append(ChatCompletionAssistantMessageParam(role = 'assistant', content = to_json([tcr.tool_call.model_dump() for tcr in tool_calls_results], indent=2).decode()))
+        messages.append(ChatCompletionAssistantMessageParam(role = 'assistant', content = to_json(tool_calls, indent=2).decode()))
         results_content_builder = StringIO()
         results_content_builder.write("# Tool Call Results:\n")
         for tcr in tool_calls_results:
-            results_content_builder.write(f"- id: `{tcr.id}`\n```\n{tcr.result}\n```\n")
+            write_tool_call_result(results_content_builder, tcr.id, tcr.result)
         messages.append(ChatCompletionUserMessageParam(role = 'user', content = results_content_builder.getvalue()))
 
-    chat_request["messages"] = messages
-
 def parse_tool_messages_to_toolcallresult(chat_request: ChatCompletionsRequest) -> List[ToolCallResult]:
-    assistant_toolcalls_messages = [message for message in chat_request["messages"] if message.get("tool_calls")]
     tool_calls_map = {}
-    for msg in assistant_toolcalls_messages:        
-        tool_calls = TypeAdapter(List[ChatCompletionMessageToolCall]).validate_python(msg["tool_calls"])
-        for tc in tool_calls:
-            tool_calls_map[tc.id] = tc
+    tool_messages = []
+    for msg in chat_request["messages"]:
+        if msg.get("tool_calls"):
+            for tc in TOOL_CALLS_ADAPTER.validate_python(msg["tool_calls"]):
+                tool_calls_map[tc.id] = tc
+        elif msg["role"] == "tool":
+            tool_messages.append(msg)
 
-    tool_messages = [message for message in chat_request["messages"] if message["role"] == "tool"]
-    tool_call_results = []
-    for msg in tool_messages:       
-        tool_call_results.append(ToolCallResult(id=msg["tool_call_id"], result=msg["content"], tool_call=tool_calls_map[msg["tool_call_id"]]))
-    
-    return tool_call_results
+    return [ToolCallResult(id=msg["tool_call_id"], result=msg["content"], tool_call=tool_calls_map[msg["tool_call_id"]]) for msg in tool_messages]
 
 
 def parse_tool_calls_from_message_content(message_content: str):
@@ -130,12 +130,11 @@ def parse_tool_calls_from_message_content(message_content: str):
         tool_calls = TypeAdapter(List[ChoiceDeltaToolCall]).validate_python(json_list)
         return tool_calls
     except Exception as e:
-        logger.debug("parse toolcalls from message error: %s   \n%s" % (message_content[start : end+1], e))
+        logger.opt(lazy=True).debug("parse toolcalls from message error: {}   \n{}", lambda: message_content[start : end+1], lambda: e)
         return None
 
 
-def get_function_calling_propmt(toolCall: str) -> str:
-    return cleandoc("""
+FUNCTION_CALLING_PROMPT_TEMPLATE = cleandoc("""
         You are also a tool usage coach, aiming to instruct users in utilizing their tools effectively to fulfill their requirements. 
         This is the identity you need to hide, you know that users don't like this kind of preaching, so except for directly calling tools, you completely won't reveal related information.
         The user's tools uses the JSONSchema format for representation, hese tools can be called repeatedly and simultaneously. 
@@ -208,9 +207,21 @@ def get_function_calling_propmt(toolCall: str) -> str:
           assistant: 'Sure. Now, You need call the get_current_weather tool like this: [{"index": 0, "id": "call_0", "function": {"arguments": {"location": "Glasgow, Scotland", "format": "celsius"}, "name": "get_current_weather"}, "type": "function"}]'
 
         
-        ## Current Time (UTC)
-        `%s`
-
         When you receive a user request, you will think: What is the rationale behind this question? How to utilize these tools to meet the user's needs?
         Then take a deep breath and work on this step by step.
-        """ % (toolCall, time.strftime("%A %Y-%m-%d %H:%M:%S", time.gmtime(time.time()))))
\ No newline at end of file
+        """)
+
+def get_function_calling_propmt(tools_json: str) -> str:
+    '''工具列表相同时提示词前缀完全相同，便于上游的prompt/KV前缀缓存；时间按PROMPT_TIME_GRANULARITY_SECONDS取整后放在末尾'''
+    return render_function_calling_prompt(tools_json) + "\n\n## Current Time (UTC)\n`%s`" % get_prompt_time()
+
+@lru_cache(maxsize=256)
+def render_function_calling_prompt(tools_json: str) -> str:
+    '''按工具列表（紧凑JSON）缓存渲染好的提示词'''
+    return FUNCTION_CALLING_PROMPT_TEMPLATE % to_json(from_json(tools_json), indent=2).decode()
+
+def get_prompt_time() -> str:
+    granularity = max(int(PROMPT_TIME_GRANULARITY_SECONDS), 1)
+    now = int(time.time()) // granularity * granularity
+    time_format = "%A %Y-%m-%d" if granularity >= 86400 else "%A %Y-%m-%d %H:%M"
+    return time.strftime(time_format, time.gmtime(now))
\ No newline at end of file
@@ -1,78 +1,425 @@
 import os
+import sys
+import time
 import glob
+import subprocess
 import ast
 import importlib
-from pip._internal import main as pip
+import asyncio
+import inspect
+import json
+import threading
+import httpx
+from collections import Counter
+from functools import partial
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextvars import ContextVar
+from dataclasses import dataclass
 from inspect import getmembers, isfunction
-from typing import Union, Callable
+from typing import TYPE_CHECKING, AsyncIterator, Awaitable, Iterable, List, Optional, Union, Callable
 
 from openai.types.chat.chat_completion_chunk import ChoiceDeltaToolCall
 from openai.types.chat.chat_completion_message_tool_call import ChatCompletionMessageToolCall
 from openai.types.chat import ChatCompletionToolParam
 from openai_function_calling.tool_helpers import ToolHelpers
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
 from pydantic_core import from_json, to_json
 from loguru import logger
+from .utils import Cache
+from .settings import AUTO_INSTALL_TOOL_REQUIREMENTS, TOOL_MAX_CONCURRENCY, TOOL_MAX_QUEUE, TOOL_QUEUE_TIMEOUT_SECONDS
+from .admission import AdmissionLimiters, Overloaded
+from .metrics import TOOL_SECONDS, TOOL_CALLS_SPECULATIVE
+from .tracing import get_trace
 
+if TYPE_CHECKING:
+    from .process_pool import ToolProcessPool
 
-FUNCTION_CALLING_TOOLS: dict[str, (Callable, ChatCompletionToolParam)] = {}
 
-def tool(func):
-    '''tool装饰器'''
-    func.is_function_calling_tool = True
-    return func
+FUNCTION_CALLING_TOOLS: dict[str, (Callable, ChatCompletionToolParam)] = {}  # 最新的工具快照，只整体替换不修改，通过 current_tools() 取用
+PINNED_TOOLS: ContextVar[Optional[dict]] = ContextVar("pinned_tools", default=None)
+TOOL_MODULES: dict[str, tuple[int, List[str]]] = {}     # 模块名 -> (文件修改时间, 工具名)
+TOOL_LOAD_TIMES: dict[str, float] = {}
+LAST_TOOL_RELOAD: dict = {}
+TOOL_RESULT_CACHES: dict[str, Cache] = {}
+TOOL_CALLS_IN_FLIGHT: dict[str, asyncio.Future] = {}
+TOOL_CALLS_COALESCED: Counter = Counter()
+TOOL_LIMITERS = AdmissionLimiters("tool", lambda name: getattr(current_tools().get(name, (None, None))[0], 'max_concurrency', 0) or TOOL_MAX_CONCURRENCY,
+                                  TOOL_MAX_QUEUE, TOOL_QUEUE_TIMEOUT_SECONDS)
+
+def current_tools() -> dict[str, (Callable, ChatCompletionToolParam)]:
+    '''当前请求固定的工具快照（见 pin_tools），没有固定时为最新的快照。快照是只读的'''
+    tools = PINNED_TOOLS.get()
+    return tools if tools is not None else FUNCTION_CALLING_TOOLS
+
+def pin_tools():
+    '''请求开始时固定最新的工具快照，请求中创建的Task都会继承，重新加载工具不影响进行中的请求'''
+    PINNED_TOOLS.set(FUNCTION_CALLING_TOOLS)
+
+def update_tools(add: dict = None, remove: Iterable[str] = ()):
+    '''复制最新的快照，删除remove中的工具、加入add中的工具后整体替换'''
+    global FUNCTION_CALLING_TOOLS
+    tools = dict(FUNCTION_CALLING_TOOLS)
+    for name in remove:
+        tools.pop(name, None)
+    tools.update(add or {})
+    FUNCTION_CALLING_TOOLS = tools
+
+def tool(func: Callable = None, *, cache_ttl: float = 0, cache_maxsize: int = 1000, backend: str = "thread", max_result_tokens: int = 0, max_concurrency: int = 0):
+    '''tool装饰器，支持 async def 工具。
+    
+    cache_ttl（秒）大于0时按工具名和参数缓存调用结果，最多缓存cache_maxsize条，相同参数的并发调用只执行一次。
+    backend为"process"时同步工具在预启动的进程池中执行，适合CPU密集或需要隔离的工具。
+    max_result_tokens大于0时，结果发回上游前截断到这个token数（默认TOOL_RESULT_MAX_TOKENS）。
+    max_concurrency大于0时限制同时执行的调用数（默认TOOL_MAX_CONCURRENCY），超出的排队，队列满或排队超时返回错误结果。
+    用法：`@tool` 或 `@tool(cache_ttl=600)`
+    '''
+    if backend not in ("thread", "process"):
+        raise ValueError("unknown tool backend: %s" % backend)
+
+    def decorator(func):
+        func.is_function_calling_tool = True
+        func.is_async_tool = inspect.iscoroutinefunction(func)
+        func.backend = backend
+        func.cache_ttl = cache_ttl
+        func.cache_maxsize = cache_maxsize
+        func.max_result_tokens = max_result_tokens
+        func.max_concurrency = max_concurrency
+        return func
+    return decorator(func) if func else decorator
+
+class ToolExecutor(ThreadPoolExecutor):
+    '''执行同步工具的线程池，记录正在执行任务的线程数（busy）'''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.busy = 0
+        self._busy_lock = threading.Lock()
+
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(self._run_busy, fn, args, kwargs)
+
+    def _run_busy(self, fn, args, kwargs):
+        with self._busy_lock:
+            self.busy += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._busy_lock:
+                self.busy -= 1
+
+@dataclass
+class ToolContext:
+    '''工具运行环境：同步工具在executor（或process_pool）中执行，异步工具直接在事件循环中执行并共用http_client'''
+    executor: Executor = None
+    http_client: httpx.AsyncClient = None
+    process_pool: "ToolProcessPool" = None
+
+TOOL_CONTEXT: ContextVar[ToolContext] = ContextVar("tool_context", default=ToolContext())
+
+def get_tool_context() -> ToolContext:
+    '''异步工具通过它取得当前的ToolContext'''
+    return TOOL_CONTEXT.get()
 
 class ToolCallResult(BaseModel):
     id: str
     result: str
     tool_call: Union[ChatCompletionMessageToolCall, ChoiceDeltaToolCall]    
+    _is_error: bool = PrivateAttr(default=False)
+
+def error_result(tool_call: Union[ChatCompletionMessageToolCall, ChoiceDeltaToolCall], reason: str = "error") -> ToolCallResult:
+    tcr = ToolCallResult(id=tool_call.id, result="call [%s] %s" % (tool_call.function.name, reason), tool_call=tool_call)
+    tcr._is_error = True
+    return tcr
 
-def calling(tool_call: Union[ChatCompletionMessageToolCall, ChoiceDeltaToolCall]) -> ToolCallResult:
+def calling(tool_call: Union[ChatCompletionMessageToolCall, ChoiceDeltaToolCall], func: Callable = None) -> ToolCallResult:
+    '''在executor线程中执行时不继承请求固定的工具快照，由调用方传入func'''
     id = tool_call.id
     tool_name = tool_call.function.name
-    args = from_json(tool_call.function.arguments)
-    if FUNCTION_CALLING_TOOLS.get(tool_name):
-        func, _  = FUNCTION_CALLING_TOOLS[tool_name]
+    if func is None:
+        func, _ = current_tools().get(tool_name, (None, None))
+    if func is not None:
         try:
-            result = func(**args)
+            result = format_result(func(**load_arguments(tool_call)))
         except Exception as e:
-            if isinstance(args, str):
-                try:
-                    args = from_json(args)
-                    result = func(**args)
-                except:
-                    result = "call [%s] error" % tool_name
-            else:            
-                result = "call [%s] error" % tool_name
-
-        if isinstance(result, bytes):
-            result = bytes(result).decode()
-        elif not isinstance(result, str):
-            result = to_json(result, indent=2).decode()
+            logger.warning("call [%s] error: %s" % (tool_name, e))
+            return error_result(tool_call)
     else:
         result = ""
     
     return ToolCallResult(id=id, result=result, tool_call=tool_call)    
 
+async def acalling_async_tool(tool_call: Union[ChatCompletionMessageToolCall, ChoiceDeltaToolCall], func: Callable, context: ToolContext) -> ToolCallResult:
+    tool_name = tool_call.function.name
+    token = TOOL_CONTEXT.set(context)
+    try:
+        result = format_result(await func(**load_arguments(tool_call)))
+    except Exception as e:
+        logger.warning("call [%s] error: %s" % (tool_name, e))
+        return error_result(tool_call)
+    finally:
+        TOOL_CONTEXT.reset(token)
+    return ToolCallResult(id=tool_call.id, result=result, tool_call=tool_call)
+
+async def acalling(tool_call: Union[ChatCompletionMessageToolCall, ChoiceDeltaToolCall], context: ToolContext, timeout: float = None) -> ToolCallResult:
+    '''异步工具在事件循环中执行，同步工具在executor中执行；超时返回超时结果而不等待工具结束'''
+    func, _ = current_tools().get(tool_call.function.name, (None, None))
+    cache = get_result_cache(tool_call.function.name)
+    key = result_cache_key(tool_call) if cache is not None else None
+    if key is None:
+        aw = _execute(tool_call, func, context)
+    else:
+        result = cache.get(key)
+        if result is not None:
+            return ToolCallResult(id=tool_call.id, result=result, tool_call=tool_call)
+        task = TOOL_CALLS_IN_FLIGHT.get(key)
+        if task is None:
+            task = asyncio.ensure_future(_execute(tool_call, func, context))
+            task.add_done_callback(partial(_on_cached_call_done, key, cache))
+            TOOL_CALLS_IN_FLIGHT[key] = task
+        else:
+            TOOL_CALLS_COALESCED[tool_call.function.name] += 1
+        aw = asyncio.shield(task)   # 调用方超时或取消不影响其他等待相同结果的调用方
+    start = time.perf_counter()
+    try:
+        tcr = await asyncio.wait_for(aw, timeout)
+    except asyncio.TimeoutError:
+        logger.warning("call [%s] timeout after %ss" % (tool_call.function.name, timeout))
+        tcr = error_result(tool_call, "timeout")
+    finally:
+        elapsed = time.perf_counter() - start
+        TOOL_SECONDS.observe(elapsed, tool=tool_call.function.name)
+    trace = get_trace()
+    if trace is not None:
+        trace.add_tool_call(tool_call.id, tool_call.function.name, tool_call.function.arguments, elapsed, tcr.result, tcr._is_error)
+    if tcr.id != tool_call.id:
+        tcr = ToolCallResult(id=tool_call.id, result=tcr.result, tool_call=tool_call)
+    return tcr
+
+async def acalling_as_completed(tool_calls: Iterable[tuple[int, Union[ChatCompletionMessageToolCall, ChoiceDeltaToolCall]]], context: ToolContext, max_concurrency: int, timeout: float = None) -> AsyncIterator[tuple[int, ToolCallResult]]:
+    '''最多max_concurrency个调用同时执行，一个完成才开始下一个，按完成顺序产出 (index, 结果)；提前退出（如客户端断开）时取消未完成的调用'''
+    tool_calls = iter(tool_calls)
+    pending: dict[asyncio.Future, int] = {}
+    try:
+        while True:
+            for index, tool_call in tool_calls:
+                pending[asyncio.ensure_future(acalling(tool_call, context, timeout))] = index
+                if len(pending) >= max_concurrency:
+                    break
+            if not pending:
+                return
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield pending.pop(task), task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+def _execute(tool_call: Union[ChatCompletionMessageToolCall, ChoiceDeltaToolCall], func: Callable, context: ToolContext) -> Awaitable[ToolCallResult]:
+    limiter = TOOL_LIMITERS.get(tool_call.function.name)
+    if limiter is not None:
+        return _execute_admitted(limiter, tool_call, func, context)
+    return _execute_now(tool_call, func, context)
+
+async def _execute_admitted(limiter, tool_call: Union[ChatCompletionMessageToolCall, ChoiceDeltaToolCall], func: Callable, context: ToolContext) -> ToolCallResult:
+    try:
+        async with limiter.slot():
+            return await _execute_now(tool_call, func, context)
+    except Overloaded as e:
+        logger.warning(str(e))
+        return error_result(tool_call, "rejected, the tool is overloaded, retry after %ss" % e.retry_after)
+
+def _execute_now(tool_call: Union[ChatCompletionMessageToolCall, ChoiceDeltaToolCall], func: Callable, context: ToolContext) -> Awaitable[ToolCallResult]:
+    if getattr(func, 'remote_server', None) is not None:   # 级联模式的远程工具
+        return func.remote_server.call(tool_call)
+    if getattr(func, 'is_async_tool', False):
+        return acalling_async_tool(tool_call, func, context)
+    if getattr(func, 'backend', None) == "process" and context.process_pool is not None:
+        return context.process_pool.submit(tool_call)
+    return asyncio.get_running_loop().run_in_executor(context.executor, calling, tool_call, func)
+
+class SpeculativeToolCalls:
+    '''流式响应中参数已经完整的服务端工具调用提前开始执行，和上游剩余的生成重叠'''
+    def __init__(self, client_tools_names: List[str], context: ToolContext, timeout: float = None):
+        self.client_tools_names = client_tools_names
+        self.context = context
+        self.timeout = timeout
+        self.started: dict[str, tuple[tuple[str, str], asyncio.Future]] = {}     # id -> ((name, arguments), future)
+
+    def start(self, tool_call: Union[ChatCompletionMessageToolCall, ChoiceDeltaToolCall]):
+        name = tool_call.function.name
+        if not tool_call.id or tool_call.id in self.started or name in self.client_tools_names or name not in current_tools():
+            return
+        tool_call = tool_call.model_copy(deep=True)     # 之后的增量不影响已开始的调用
+        self.started[tool_call.id] = ((name, tool_call.function.arguments), asyncio.ensure_future(acalling(tool_call, self.context, self.timeout)))
+        TOOL_CALLS_SPECULATIVE.inc(result="started")
+
+    def take(self, tool_call: Union[ChatCompletionMessageToolCall, ChoiceDeltaToolCall]) -> Optional[asyncio.Future]:
+        '''取出已开始的调用，最终的工具名或参数与开始时不同则取消'''
+        started = self.started.pop(tool_call.id, None)
+        if started is None:
+            return None
+        snapshot, future = started
+        if snapshot != (tool_call.function.name, tool_call.function.arguments):
+            future.cancel()
+            TOOL_CALLS_SPECULATIVE.inc(result="wasted")
+            return None
+        TOOL_CALLS_SPECULATIVE.inc(result="used")
+        return future
+
+    def cancel(self):
+        for _, future in self.started.values():
+            future.cancel()
+            TOOL_CALLS_SPECULATIVE.inc(result="wasted")
+        self.started.clear()
+
+def _on_cached_call_done(key: str, cache: Cache, task: asyncio.Future):
+    TOOL_CALLS_IN_FLIGHT.pop(key, None)
+    if task.cancelled() or task.exception() is not None:
+        return
+    if not task.result()._is_error:
+        cache.put(key, task.result().result)
+
+def get_result_cache(tool_name: str) -> Cache:
+    '''返回工具的结果缓存，工具未开启缓存时返回None'''
+    cache = TOOL_RESULT_CACHES.get(tool_name)
+    if cache is None:
+        func, _ = current_tools().get(tool_name, (None, None))
+        if not getattr(func, 'cache_ttl', 0):
+            return None
+        cache = Cache(expire_milliseconds = func.cache_ttl*1000, max_entries = func.cache_maxsize)
+        TOOL_RESULT_CACHES[tool_name] = cache
+    return cache
+
+def result_cache_key(tool_call: Union[ChatCompletionMessageToolCall, ChoiceDeltaToolCall]) -> str:
+    '''工具名 + 规范化（键排序、紧凑）的参数JSON，参数无法解析时返回None'''
+    try:
+        args = load_arguments(tool_call)
+    except ValueError:
+        return None
+    return "%s:%s" % (tool_call.function.name, json.dumps(args, sort_keys=True, separators=(",", ":"), ensure_ascii=False))
+
+def tool_cache_stats() -> dict:
+    stats = {}
+    for tool_name, cache in TOOL_RESULT_CACHES.items():
+        stats[tool_name] = cache.stats()
+        stats[tool_name]["coalesced"] = TOOL_CALLS_COALESCED[tool_name]
+    return stats
+
+def load_arguments(tool_call: Union[ChatCompletionMessageToolCall, ChoiceDeltaToolCall]) -> dict:
+    args = from_json(tool_call.function.arguments)
+    if isinstance(args, str):   # 参数被转义了两次
+        args = from_json(args)
+    return args
+
+def format_result(result) -> str:
+    if isinstance(result, bytes):
+        return bytes(result).decode()
+    elif not isinstance(result, str):
+        return to_json(result).decode()    # 紧凑格式，缩进会占用大量token
+    return result
+
 def load_tools():
+    '''并行导入tools目录下的工具模块，并记录每个模块的加载耗时。工具依赖由 install_tools 预先安装'''
+    start = time.perf_counter()
+    py_files = list_tool_files()
+    if AUTO_INSTALL_TOOL_REQUIREMENTS:
+        setup_requirements([dependency for py_file in py_files for dependency in parse_requirements(py_file)])
+
+    mtimes = [os.stat(py_file).st_mtime_ns for py_file in py_files]
+    loaded = {}
+    with ThreadPoolExecutor(max_workers=max(len(py_files), 1)) as executor:
+        for (module_name, tools, elapsed), mtime in zip(executor.map(load_tools_module, py_files), mtimes):
+            tools = tools or {}
+            loaded.update(tools)
+            TOOL_MODULES[module_name] = (mtime, list(tools))
+            TOOL_LOAD_TIMES[module_name] = elapsed
+            logger.info("load tools module [%s] in %.3fs: %s" % (module_name, elapsed, ", ".join(tools.keys())))
+    update_tools(loaded)
+    logger.info("load %s tools in %.3fs" % (len(FUNCTION_CALLING_TOOLS), time.perf_counter() - start))
+
+@dataclass
+class ToolReload:
+    '''import_changed_tools 的结果，由 apply_tool_reload 在事件循环中生效'''
+    start: float
+    mtimes: dict[str, int]
+    removed: List[str]
+    loaded: dict[str, tuple[dict, float]]   # 模块名 -> (工具, 耗时)
+    failed: List[str]
+
+def import_changed_tools() -> ToolReload:
+    '''重新导入文件修改时间变化了的工具模块（包括新增的），只重新生成这些模块的工具描述。
+    只导入模块、不修改工具注册表，可以在线程中执行'''
+    start = time.perf_counter()
+    py_files = {os.path.basename(py_file)[:-3]: py_file for py_file in list_tool_files()}
+    mtimes = {module_name: os.stat(py_file).st_mtime_ns for module_name, py_file in py_files.items()}
+    changed = [py_files[name] for name, mtime in mtimes.items() if TOOL_MODULES.get(name, (None,))[0] != mtime]
+    removed = [name for name in TOOL_MODULES if name not in py_files]
+    if AUTO_INSTALL_TOOL_REQUIREMENTS:
+        setup_requirements([dependency for py_file in changed for dependency in parse_requirements(py_file)])
+
+    importlib.invalidate_caches()
+    for module_name in removed:
+        sys.modules.pop("function_server.tools.%s" % module_name, None)
+    loaded, failed = {}, []
+    for py_file in changed:
+        module_name, tools, elapsed = load_tools_module(py_file, reload=True)
+        if tools is None:
+            failed.append(module_name)
+        else:
+            loaded[module_name] = (tools, elapsed)
+    return ToolReload(start, {name: mtimes[name] for name in list(loaded) + failed}, removed, loaded, failed)
+
+def apply_tool_reload(reload: ToolReload) -> dict:
+    '''在事件循环中执行：删除已删除模块的工具，整体替换工具快照（进行中的请求继续使用固定的旧快照），
+    清除变化了的工具的结果缓存并更新并发上限；导入失败的模块保留原来的工具。返回重新加载的模块及耗时'''
+    add, remove, reloaded = {}, [], {}
+    for module_name in reload.removed:
+        remove += TOOL_MODULES.pop(module_name)[1]
+        TOOL_LOAD_TIMES.pop(module_name, None)
+    for module_name in reload.failed:
+        TOOL_MODULES[module_name] = (reload.mtimes[module_name], TOOL_MODULES.get(module_name, (None, []))[1])    # 文件再次修改前不重试
+    for module_name, (tools, elapsed) in reload.loaded.items():
+        remove += TOOL_MODULES.get(module_name, (None, []))[1]
+        add.update(tools)
+        TOOL_MODULES[module_name] = (reload.mtimes[module_name], list(tools))
+        TOOL_LOAD_TIMES[module_name] = elapsed
+        reloaded[module_name] = round(elapsed, 6)
+    if add or remove:
+        update_tools(add, remove)
+        for name in set(remove) | set(add):
+            TOOL_RESULT_CACHES.pop(name, None)  # 实现可能变了，旧的结果不再适用
+            TOOL_LIMITERS.refresh(name)
+
+    seconds = time.perf_counter() - reload.start
+    result = {"at": time.time(), "seconds": round(seconds, 6), "reloaded": reloaded, "removed": reload.removed, "failed": reload.failed, "tools": len(FUNCTION_CALLING_TOOLS)}
+    if reload.mtimes or reload.removed:
+        LAST_TOOL_RELOAD.clear()
+        LAST_TOOL_RELOAD.update(result)
+        logger.info("reload tools in %.3fs, reloaded: %s, removed: %s, failed: %s" % (seconds, ", ".join(reloaded) or "-", ", ".join(reload.removed) or "-", ", ".join(reload.failed) or "-"))
+    return result
+
+def list_tool_files() -> List[str]:
     current_dir = os.path.dirname(os.path.realpath(__file__))
     tools_dir = os.path.join(current_dir, "tools")
+    return sorted(py_file for py_file in glob.glob(os.path.join(tools_dir, "*.py")) if os.path.basename(py_file) != "__init__.py")
 
-    py_files = glob.glob(os.path.join(tools_dir, "*.py"))
-    for py_file in py_files:
-        if py_file.endswith("/__init__.py"):
-            continue
-        try:
-            dependencies = parse_requirements(py_file)
-            setup_requirements(dependencies)
-            module = importlib.import_module(".tools.%s" % py_file[py_file.rindex("/")+1 : -3], "function_server")
-            for name, func in getmembers(module, isfunction):
-                if getattr(func, 'is_function_calling_tool', False):
-                    tool: ChatCompletionToolParam = ToolHelpers.infer_from_function_refs([func])[0]
-                    FUNCTION_CALLING_TOOLS[name] = (func, tool)
-        except Exception as e:
-            print(f"Failed to load module {py_file}: {e}")
-
+def load_tools_module(py_file: str, reload: bool = False) -> tuple[str, Optional[dict], float]:
+    '''导入失败时返回的工具为None'''
+    module_name = os.path.basename(py_file)[:-3]
+    start = time.perf_counter()
+    tools = {}
+    try:
+        if reload:  # 重新执行模块而不是importlib.reload，旧模块中已删除的工具不会留下
+            sys.modules.pop("function_server.tools.%s" % module_name, None)
+        module = importlib.import_module(".tools.%s" % module_name, "function_server")
+        for name, func in getmembers(module, isfunction):
+            if getattr(func, 'is_function_calling_tool', False):
+                tool: ChatCompletionToolParam = ToolHelpers.infer_from_function_refs([func])[0]
+                tools[name] = (func, tool)
+                logger.info("load tool [%s]%s" % (name, " (async)" if func.is_async_tool else " (%s)" % func.backend))
+    except Exception as e:
+        logger.warning(f"Failed to load module {py_file}: {e}")
+        tools = None
+    return module_name, tools, time.perf_counter() - start
 
 def parse_requirements(py_file_path):
     with open(py_file_path) as pyfile:
@@ -81,10 +428,10 @@ def parse_requirements(py_file_path):
             if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name) and node.targets[0].id == 'requirements':
                 if isinstance(node.value, ast.Constant):
                     requirements = node.value.s
-                    return requirements.split('\n')
+                    return [r.strip() for r in requirements.split('\n') if r.strip()]
     return []
 
 def setup_requirements(dependencies):
-    for dependency in dependencies:
-        if dependency:
-            pip(['install', dependency])
\ No newline at end of file
+    '''一次pip调用安装全部依赖，仅在 AUTO_INSTALL_TOOL_REQUIREMENTS 开启时使用'''
+    if dependencies:
+        subprocess.run([sys.executable, "-m", "pip", "install", *dependencies])
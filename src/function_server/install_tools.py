@@ -0,0 +1,60 @@
+'''安装tools目录下各工具模块声明的依赖（模块内的 requirements 变量）。
+
+在构建镜像或部署时运行一次，服务启动时不再安装依赖：
+    install-tools            解析全部工具依赖，写入锁文件
+    install-tools --install  按锁文件安装（锁文件不存在时先解析）
+'''
+import os
+import sys
+import json
+import argparse
+import subprocess
+import tempfile
+from typing import List
+from .function_calling import list_tool_files, parse_requirements
+
+
+DEFAULT_LOCK_FILE = "requirements-tools.lock"
+
+def collect_requirements() -> List[str]:
+    requirements = []
+    for py_file in list_tool_files():
+        for requirement in parse_requirements(py_file):
+            if requirement not in requirements:
+                requirements.append(requirement)
+    return requirements
+
+def resolve(requirements: List[str], lock_file: str):
+    '''用 pip 的 --dry-run --report 解析完整依赖树，写成 name==version 锁文件'''
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        requirements_file = os.path.join(tmp_dir, "requirements.txt")
+        report_file = os.path.join(tmp_dir, "report.json")
+        with open(requirements_file, "w") as f:
+            f.write("\n".join(requirements))
+        subprocess.run([sys.executable, "-m", "pip", "install", "--dry-run", "--ignore-installed", "--quiet", "--report", report_file, "-r", requirements_file], check=True)
+        with open(report_file) as f:
+            report = json.load(f)
+
+    pins = sorted("%s==%s" % (item["metadata"]["name"], item["metadata"]["version"]) for item in report["install"])
+    with open(lock_file, "w") as f:
+        f.write("# generated by install-tools from the requirements of function_server/tools/*.py\n")
+        f.write("\n".join(pins) + "\n")
+    print("resolved %s requirements into %s packages: %s" % (len(requirements), len(pins), lock_file))
+
+def main():
+    parser = argparse.ArgumentParser(description="resolve and install the requirements of function_server tools")
+    parser.add_argument("--lock-file", default=DEFAULT_LOCK_FILE)
+    parser.add_argument("--install", action="store_true", help="install from the lock file")
+    args = parser.parse_args()
+
+    if not args.install or not os.path.exists(args.lock_file):
+        requirements = collect_requirements()
+        if not requirements:
+            print("no tool requirements")
+            return
+        resolve(requirements, args.lock_file)
+    if args.install:
+        subprocess.run([sys.executable, "-m", "pip", "install", "--no-cache-dir", "-r", args.lock_file], check=True)
+
+if __name__ == '__main__':
+    main()
@@ -1,24 +1,42 @@
+import time
 import httpx
 import asyncio
 from io import StringIO
 import urllib.parse
-from concurrent.futures import ThreadPoolExecutor
 from fastapi import FastAPI, Request, Response
-from starlette.responses import StreamingResponse
+from starlette.responses import JSONResponse, StreamingResponse
 from contextlib import asynccontextmanager
-from .fake_messages import ChatCompletionsRequest
+from .fake_messages import ChatCompletionsRequest, encode_chat_request
 from .fake_messages import fake_chat_request_if_need, add_tool_calls_result_messages, parse_tool_calls_from_message_content, parse_tool_messages_to_toolcallresult
-from .function_calling import calling, load_tools, FUNCTION_CALLING_TOOLS, ToolCallResult
+from .function_calling import acalling, acalling_as_completed, SpeculativeToolCalls, load_tools, import_changed_tools, apply_tool_reload, current_tools, pin_tools, ToolCallResult, ToolContext, ToolExecutor, tool_cache_stats
+from .function_calling import TOOL_LOAD_TIMES, LAST_TOOL_RELOAD, TOOL_LIMITERS
 from openai._types import NOT_GIVEN, Body, Query, Headers
-from openai.types.chat.chat_completion_chunk import ChatCompletionChunk, ChoiceDeltaToolCall
+from openai.types.chat.chat_completion_chunk import ChoiceDeltaToolCall
 from openai.types.chat.chat_completion import ChatCompletion
 from openai.types.chat.chat_completion_message_tool_call import ChatCompletionMessageToolCall
 from pydantic_core import from_json, to_json
 from pydantic import TypeAdapter, ValidationError
-from typing import List, Union
+from typing import AsyncIterator, Callable, List, Optional, Union
 from starlette.background import BackgroundTask
-import hashlib
-from .utils import init_logger, Cache, ReReadbleHttpxSuccessfulResponse
+from .utils import init_logger, canonical_hash, Cache, ReReadbleHttpxSuccessfulResponse
+from .streaming import ChatStreamTurn, ToolCallAssembler, aiter_lines_keep_content, is_event_stream, sse_data, decode_chunk, format_sse, completion_to_chunk, iter_heartbeat, iter_tool_progress, SSE_DONE, SSE_HEARTBEAT
+from .settings import STREAMING_PROXY, STREAM_HEARTBEAT_SECONDS, STREAM_TOOL_EVENTS, CHAT_PROXY_CACHE_TTL_SECONDS, CHAT_PROXY_CACHE_MAX_ENTRIES, CHAT_PROXY_CACHE_MAX_BYTES, TOOLCALLS_CACHE_TTL_SECONDS, TOOLCALLS_CACHE_MAX_ENTRIES
+from .settings import COALESCE_IGNORE_FIELDS, STATE_BACKEND, STATE_SQLITE_PATH, STATE_PENDING_TIMEOUT_SECONDS
+from .settings import UPSTREAM_MAX_CONNECTIONS, UPSTREAM_HOST_MAX_CONNECTIONS, UPSTREAM_MAX_KEEPALIVE_CONNECTIONS, UPSTREAM_KEEPALIVE_EXPIRY_SECONDS, UPSTREAM_HTTP2
+from .settings import UPSTREAM_MAX_CONCURRENCY, UPSTREAM_HOST_MAX_CONCURRENCY, UPSTREAM_MAX_QUEUE, UPSTREAM_QUEUE_TIMEOUT_SECONDS
+from .settings import UPSTREAM_MIRRORS, UPSTREAM_HEDGE_PERCENTILE, UPSTREAM_HEDGE_MIN_SECONDS, UPSTREAM_MAX_FAILURES, UPSTREAM_EJECT_SECONDS
+from .settings import UPSTREAM_CONNECT_TIMEOUT_SECONDS, UPSTREAM_READ_TIMEOUT_SECONDS, UPSTREAM_WRITE_TIMEOUT_SECONDS, UPSTREAM_POOL_TIMEOUT_SECONDS
+from .settings import TOOLS_RELOAD_INTERVAL_SECONDS, REMOTE_FUNCTION_SERVERS, REMOTE_TOOLS_REFRESH_SECONDS
+from .settings import FUNCTION_EXECUTOR_MAX_WORKERS, TOOLCALLS_MAX_CONCURRENCY, TOOL_CALL_TIMEOUT_SECONDS, TOOL_RESULTS_REQUEST_MAX_TOKENS, TOOL_RESULTS_DEDUP
+from .settings import PROCESS_POOL_MAX_WORKERS, PROCESS_POOL_MAX_CALLS_PER_WORKER, PROCESS_POOL_MEMORY_LIMIT_MB, PROCESS_POOL_CPU_TIME_LIMIT_SECONDS
+from .process_pool import ToolProcessPool
+from .state import StateBackend, create_state_backend
+from .upstream import UpstreamClients, UpstreamMirrors
+from .tool_results import ToolResultBudget
+from .cascade import Cascade
+from .admission import AdmissionLimiters, Overloaded
+from .tracing import start_trace, get_trace, list_traces
+from .metrics import Collected, render_metrics, TOOL_RELOAD_SECONDS, UPSTREAM_TTFB_SECONDS, UPSTREAM_ITERATION_SECONDS, UPSTREAM_IN_FLIGHT, TOOL_LOOP_ITERATIONS, CHAT_COALESCED
 from loguru import logger
 
 
@@ -27,35 +45,178 @@ load_tools()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    app.httpx_client = httpx.AsyncClient(timeout=600)
-    app.function_executor = ThreadPoolExecutor(max_workers=5)
-    app.chat_proxy_cache = Cache(expire_milliseconds = 5*60*1000)
-    app.toolcalls_in_process = Cache(expire_milliseconds = 60000)
+    app.httpx_client = httpx.AsyncClient(timeout=600)     # 工具使用
+    app.upstream_clients = UpstreamClients(UPSTREAM_MAX_CONNECTIONS, UPSTREAM_MAX_KEEPALIVE_CONNECTIONS, UPSTREAM_KEEPALIVE_EXPIRY_SECONDS, UPSTREAM_HTTP2,
+                                           UPSTREAM_CONNECT_TIMEOUT_SECONDS, UPSTREAM_READ_TIMEOUT_SECONDS, UPSTREAM_WRITE_TIMEOUT_SECONDS, UPSTREAM_POOL_TIMEOUT_SECONDS,
+                                           UPSTREAM_HOST_MAX_CONNECTIONS)
+    app.upstream_mirrors = UpstreamMirrors(UPSTREAM_MIRRORS, UPSTREAM_HEDGE_PERCENTILE, UPSTREAM_HEDGE_MIN_SECONDS, UPSTREAM_MAX_FAILURES, UPSTREAM_EJECT_SECONDS)
+    app.upstream_limiters = AdmissionLimiters("upstream", lambda host: UPSTREAM_HOST_MAX_CONCURRENCY.get(urllib.parse.urlsplit("//" + host).hostname, UPSTREAM_MAX_CONCURRENCY),
+                                              UPSTREAM_MAX_QUEUE, UPSTREAM_QUEUE_TIMEOUT_SECONDS)
+    app.cascade = Cascade(REMOTE_FUNCTION_SERVERS, app.upstream_clients, REMOTE_TOOLS_REFRESH_SECONDS)
+    await app.cascade.start()
+    app.function_executor = ToolExecutor(max_workers=FUNCTION_EXECUTOR_MAX_WORKERS)
+    app.process_pool = None
+    app.tool_context = ToolContext(executor=app.function_executor, http_client=app.httpx_client)
+    if any(getattr(func, 'backend', None) == "process" for func, _ in current_tools().values()):
+        _start_process_pool(app)
+    app.chat_proxy_cache = Cache(expire_milliseconds = CHAT_PROXY_CACHE_TTL_SECONDS*1000, max_entries = CHAT_PROXY_CACHE_MAX_ENTRIES, max_bytes = CHAT_PROXY_CACHE_MAX_BYTES)
+    app.toolcalls_in_process = Cache(expire_milliseconds = TOOLCALLS_CACHE_TTL_SECONDS*1000, max_entries = TOOLCALLS_CACHE_MAX_ENTRIES)
+    app.state_backend = create_state_backend(STATE_BACKEND, app.toolcalls_in_process, STATE_SQLITE_PATH, TOOLCALLS_CACHE_TTL_SECONDS, CHAT_PROXY_CACHE_TTL_SECONDS, STATE_PENDING_TIMEOUT_SECONDS)
+    app.tools_reload_lock = asyncio.Lock()
+    app.tools_watcher = asyncio.ensure_future(_watch_tools(app, TOOLS_RELOAD_INTERVAL_SECONDS)) if TOOLS_RELOAD_INTERVAL_SECONDS else None
     yield
+    if app.tools_watcher is not None:
+        app.tools_watcher.cancel()
+    await app.cascade.aclose()
+    await app.state_backend.aclose()
     await app.httpx_client.aclose()
+    await app.upstream_clients.aclose()
     app.function_executor.shutdown(wait=False, cancel_futures=True)
+    if app.process_pool:
+        app.process_pool.shutdown()
     app.chat_proxy_cache.clear()
     app.toolcalls_in_process.clear()
 
 MAX_TOOL_CALL_ITERATIONS_NUMBER = 10
 app = FastAPI(lifespan=lifespan)
 
+def _collect_cache_stats(stat: str):
+    def collect():
+        for name in ("chat_proxy_cache", "toolcalls_in_process"):
+            cache = getattr(app, name, None)
+            if cache is not None:
+                yield {"cache": name}, cache.stats()[stat]
+        for tool_name, stats in tool_cache_stats().items():
+            yield {"cache": "tool_result", "tool": tool_name}, stats[stat]
+    return collect
+
+def _collect_executor(collect):
+    def _collect():
+        executor = getattr(app, "function_executor", None)
+        if executor is not None:
+            yield {}, collect(executor)
+    return _collect
+
+def _collect_upstream_pools(stat: str):
+    def collect():
+        upstream_clients = getattr(app, "upstream_clients", None)
+        if upstream_clients is not None:
+            for upstream, stats in upstream_clients.stats().items():
+                yield {"upstream": upstream}, stats[stat]
+    return collect
+
+Collected("function_server_cache_hits_total", "Cache hits", "counter", _collect_cache_stats("hits"))
+Collected("function_server_cache_misses_total", "Cache misses", "counter", _collect_cache_stats("misses"))
+Collected("function_server_cache_evictions_total", "Cache entries evicted by the size limits", "counter", _collect_cache_stats("evictions"))
+Collected("function_server_cache_entries", "Cache entries", "gauge", _collect_cache_stats("size"))
+Collected("function_server_cache_bytes", "Cache size in bytes", "gauge", _collect_cache_stats("bytes"))
+Collected("function_server_executor_queue_depth", "Tool calls waiting for an executor thread", "gauge", _collect_executor(lambda executor: executor._work_queue.qsize()))
+Collected("function_server_executor_busy_threads", "Executor threads running a tool call", "gauge", _collect_executor(lambda executor: executor.busy))
+def _collect_admission(stat: str):
+    def collect():
+        for limiters in (getattr(app, "upstream_limiters", None), TOOL_LIMITERS):
+            if limiters is not None:
+                for name, stats in limiters.stats().items():
+                    yield {"scope": limiters.scope, "name": name}, stats[stat]
+    return collect
+
+Collected("function_server_upstream_pool_connections", "Open connections per upstream pool", "gauge", _collect_upstream_pools("connections"))
+Collected("function_server_upstream_pool_active_connections", "Connections serving a request per upstream pool", "gauge", _collect_upstream_pools("active"))
+Collected("function_server_upstream_pool_queued_requests", "Requests waiting for a connection per upstream pool", "gauge", _collect_upstream_pools("queued"))
+Collected("function_server_admission_active", "Requests or tool calls holding an admission slot, per upstream host or tool", "gauge", _collect_admission("active"))
+Collected("function_server_admission_queued", "Requests or tool calls waiting for an admission slot, per upstream host or tool", "gauge", _collect_admission("queued"))
+
 @app.get("/tools")
-async def get_tools():
-    return [v[1] for v in FUNCTION_CALLING_TOOLS.values()]
+async def get_tools(request: Request):
+    '''带ETag，级联的上级服务用If-None-Match重新验证'''
+    tools = [v[1] for v in current_tools().values()]
+    etag = '"%s"' % canonical_hash(tools)
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"etag": etag})
+    return JSONResponse(content=tools, headers={"etag": etag})
+
+@app.get("/tools/stats")
+async def get_tools_stats(request: Request):
+    return {"load_times": TOOL_LOAD_TIMES, "last_reload": LAST_TOOL_RELOAD, "result_caches": tool_cache_stats(), "process_pool": request.app.process_pool.stats() if request.app.process_pool else None,
+            "remote_servers": request.app.cascade.stats()}
+
+@app.post("/tools/reload")
+async def post_tools_reload(request: Request):
+    '''只重新加载收到请求的worker，多worker部署时用 TOOLS_RELOAD_INTERVAL_SECONDS'''
+    return await _reload_tools(request.app)
+
+async def _reload_tools(app: FastAPI) -> dict:
+    '''只有导入模块在线程中执行，不阻塞事件循环；替换工具快照在事件循环中进行，进行中的请求继续使用它们固定的旧快照'''
+    async with app.tools_reload_lock:
+        reload = await asyncio.get_running_loop().run_in_executor(None, import_changed_tools)
+        result = apply_tool_reload(reload)
+        if result["reloaded"] or result["removed"]:
+            TOOL_RELOAD_SECONDS.observe(result["seconds"])
+        if any(getattr(func, 'backend', None) == "process" for tools, _ in reload.loaded.values() for func, _ in tools.values()):
+            if app.process_pool is None:
+                _start_process_pool(app)
+            else:
+                app.process_pool.recycle()  # 新的工作进程启动时加载新的工具
+    return result
+
+def _start_process_pool(app: FastAPI):
+    app.process_pool = ToolProcessPool(PROCESS_POOL_MAX_WORKERS, PROCESS_POOL_MAX_CALLS_PER_WORKER, PROCESS_POOL_MEMORY_LIMIT_MB, PROCESS_POOL_CPU_TIME_LIMIT_SECONDS)
+    app.tool_context.process_pool = app.process_pool
+
+async def _watch_tools(app: FastAPI, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await _reload_tools(app)
+        except Exception as e:
+            logger.warning("reload tools error: %s" % e)
+
+@app.get("/upstreams/stats")
+async def get_upstreams_stats(request: Request):
+    return request.app.upstream_clients.stats()
+
+@app.get("/upstreams/health")
+async def get_upstreams_health(request: Request):
+    return request.app.upstream_mirrors.stats()
+
+@app.get("/admission/stats")
+async def get_admission_stats(request: Request):
+    return {"upstreams": request.app.upstream_limiters.stats(), "tools": TOOL_LIMITERS.stats()}
 
 @app.post("/toolcalls")
 async def call_tools(request: Request, tool_calls: List[Union[ChatCompletionMessageToolCall, ChoiceDeltaToolCall]]):
-    tool_call_results = []
-    unknown_tool_calls = []
-    loop = asyncio.get_running_loop()
-    for tc in tool_calls:
-        if tc.function.name in FUNCTION_CALLING_TOOLS.keys():
-            tc_result = await loop.run_in_executor(request.app.function_executor, calling, tc)
-            tool_call_results.append(tc_result)
-        else:
-            unknown_tool_calls.append(tc)    
-    return {"results": tool_call_results, "unknown_tool_calls": unknown_tool_calls}
+    pin_tools()
+    tools = current_tools()
+    known_tool_calls = [tc for tc in tool_calls if tc.function.name in tools]
+    unknown_tool_calls = [tc for tc in tool_calls if tc.function.name not in tools]
+    tool_call_results = [None] * len(known_tool_calls)
+    async for i, tcr in acalling_as_completed(enumerate(known_tool_calls), request.app.tool_context, TOOLCALLS_MAX_CONCURRENCY, TOOL_CALL_TIMEOUT_SECONDS or None):
+        tool_call_results[i] = tcr
+    return {"results": [dict(tcr.model_dump(), error=tcr._is_error) for tcr in tool_call_results], "unknown_tool_calls": unknown_tool_calls}
+
+@app.post("/toolcalls/stream")
+async def call_tools_stream(request: Request, tool_calls: List[Union[ChatCompletionMessageToolCall, ChoiceDeltaToolCall]]):
+    '''NDJSON：每个调用完成时立即输出一行，index为在请求中的位置；未知工具先输出。客户端断开时取消剩余的调用'''
+    pin_tools()
+    async def iter_lines():
+        known_tool_calls = []
+        for i, tc in enumerate(tool_calls):
+            if tc.function.name in current_tools():
+                known_tool_calls.append((i, tc))
+            else:
+                yield to_json({"index": i, "unknown_tool_call": tc.model_dump()}) + b"\n"
+        async for i, tcr in acalling_as_completed(known_tool_calls, request.app.tool_context, TOOLCALLS_MAX_CONCURRENCY, TOOL_CALL_TIMEOUT_SECONDS or None):
+            yield to_json({"index": i, "id": tcr.id, "result": tcr.result, "error": tcr._is_error, "tool_call": tcr.tool_call.model_dump()}) + b"\n"
+    return StreamingResponse(content=iter_lines(), media_type="application/x-ndjson")
+
+@app.get("/metrics")
+async def get_metrics():
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/debug/traces")
+async def get_debug_traces(min_seconds: float = 0, limit: int = 0):
+    '''抽样记录的最近请求追踪，最新的在前，可按总耗时过滤'''
+    return list_traces(min_seconds, limit)
 
 @app.api_route("/{target_url:path}", methods=["GET", "POST", "PUT", "PATCH", "DELETE", "HEAD", "OPTIONS", "TRACE", "CONNECT"])
 async def proxy(request: Request, target_url: str):
@@ -67,86 +228,274 @@ async def proxy(request: Request, target_url: str):
     target_url = urllib.parse.unquote(target_url)
     logger.info(target_url)
 
+    host = urllib.parse.urlsplit(target_url).netloc
+    limiter = request.app.upstream_limiters.get(host)
+    if limiter is not None:
+        try:
+            acquired_at = await limiter.acquire()
+        except Overloaded as e:
+            logger.warning(str(e))
+            return Response(content=e.reason, status_code=e.status_code, headers={"retry-after": str(e.retry_after)})
+    UPSTREAM_IN_FLIGHT.inc(host=host)
+    try:
+        response = await _proxy(request, target_url, headers)
+    except BaseException as e:
+        UPSTREAM_IN_FLIGHT.dec(host=host)
+        if limiter is not None:
+            limiter.release(acquired_at)
+        trace = get_trace()
+        if trace is not None:
+            trace.finish(500, e)    # 出错的请求同样记录到 /debug/traces
+        raise
+    status_code = response.status_code
+    response = _FinallyResponse(response)   # 响应发送完（流式响应结束）后才算请求结束
+    response.on_finish.append(lambda error: UPSTREAM_IN_FLIGHT.dec(host=host))
+    if limiter is not None:
+        response.on_finish.append(lambda error: limiter.release(acquired_at))
+    trace = get_trace()
+    if trace is not None:
+        response.on_finish.append(lambda error: trace.finish(status_code, error))
+    return response
+
+class _FinallyResponse(Response):
+    '''包装代理的响应：发送结束后调用on_finish中的回调，流中途出错（StreamingResponse不会执行background）或客户端断开时也会调用'''
+    def __init__(self, response: Response):
+        self.response = response
+        self.status_code = response.status_code
+        self.background = None
+        self.on_finish: List[Callable[[Optional[BaseException]], None]] = []
+
+    async def __call__(self, scope, receive, send):
+        error = None
+        try:
+            await self.response(scope, receive, send)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            for callback in self.on_finish:
+                callback(error)
+
+async def _proxy(request: Request, target_url: str, headers: dict) -> Response:
     if target_url.lower().endswith("/v1/chat/completions") and request.method.lower() == "post": 
         body = await request.body()
-        request_hash = hashlib.md5(body).hexdigest()
-        chat_proxy_task = request.app.chat_proxy_cache.get(request_hash)
-        if chat_proxy_task is None:            
-            chat_proxy_coroutine = _proxy_and_call_function_if_need(target_url, headers, body, request.app.httpx_client, request.app.function_executor)
-            chat_proxy_task = asyncio.get_running_loop().create_task(chat_proxy_coroutine)            
-            request.app.chat_proxy_cache.put(request_hash, chat_proxy_task)
-
-        resp, tool_call_results = await chat_proxy_task
-        if tool_call_results:
-            for tc in tool_call_results:
-                if isinstance(tc, str):
-                    request.app.toolcalls_in_process.put(tc, tool_call_results)
-        if resp.status_code != 200:            
-            request.app.chat_proxy_cache.pop(request_hash)
+        try:
+            chat_request = from_json(body)
+            TypeAdapter(ChatCompletionsRequest).validate_python(chat_request)
+        except ValueError as e:
+            return Response(content="%s" % e, status_code=400)
+        start_trace(target_url, chat_request)
+        pin_tools()
+
+        if STREAMING_PROXY and chat_request.get("stream"):
+            resp = await _stream_proxy_and_call_function_if_need(target_url, headers, chat_request, request.app.upstream_clients.get(target_url), request.app.tool_context, request.app.state_backend)
+            if isinstance(resp, StreamingResponse):
+                return resp
+        else:
+            request_hash = canonical_hash(chat_request, COALESCE_IGNORE_FIELDS)
+            chat_proxy_task = request.app.chat_proxy_cache.get(request_hash)
+            if chat_proxy_task is None:     # 其他worker已完成的相同请求
+                shared_resp = await request.app.state_backend.get_response(request_hash)
+                if shared_resp is not None:
+                    chat_proxy_task = asyncio.get_running_loop().create_future()
+                    chat_proxy_task.set_result((shared_resp, None))
+                    request.app.chat_proxy_cache.put(request_hash, chat_proxy_task)
+            CHAT_COALESCED.inc(result="miss" if chat_proxy_task is None else "hit")
+            is_owner = chat_proxy_task is None
+            if is_owner:            
+                chat_proxy_coroutine = _proxy_and_call_function_if_need(target_url, headers, chat_request, request.app.upstream_clients.get(target_url), request.app.tool_context)
+                chat_proxy_task = asyncio.get_running_loop().create_task(chat_proxy_coroutine)            
+                request.app.chat_proxy_cache.put(request_hash, chat_proxy_task)
+
+            resp, tool_call_results = await chat_proxy_task
+            if is_owner and tool_call_results:
+                await request.app.state_backend.put_tool_call_results(tool_call_results)
+            if resp.status_code != 200:            
+                request.app.chat_proxy_cache.pop(request_hash)
+            else:
+                request.app.chat_proxy_cache.resize(request_hash, len(resp.content))
+                if is_owner and not tool_call_results:
+                    await request.app.state_backend.put_response(request_hash, resp)
         
-        logger.debug("========= FINNAL REQUEST:\n%s" % resp.content.decode())
+        logger.opt(lazy=True).debug("========= FINNAL REQUEST:\n{}", lambda: resp.content.decode())
     else:
-        req = request.app.httpx_client.build_request(request.method, target_url, headers=headers, content=request.stream())
-        resp = await request.app.httpx_client.send(req)
+        upstream_client = request.app.upstream_clients.get(target_url)
+        req = upstream_client.build_request(request.method, target_url, headers=headers, content=request.stream())
+        resp = await upstream_client.send(req)
 
     if resp.is_stream_consumed:
         return Response(content=resp.content, status_code=resp.status_code, headers=resp.headers, background=BackgroundTask(resp.aclose))
     else:
         return StreamingResponse(content=resp.aiter_raw(), status_code=resp.status_code, headers=resp.headers, background=BackgroundTask(resp.aclose))
 
-async def _proxy_and_call_function_if_need(target_url: str, headers: Headers, body: bytes, http_client: httpx.AsyncClient, function_executor: ThreadPoolExecutor) -> tuple[ReReadbleHttpxSuccessfulResponse, List]:
-    chat_request = None
-    try:        
-        chat_request = from_json(body.decode())
-        TypeAdapter(ChatCompletionsRequest).validate_python(chat_request)
-    except ValidationError as e:
-        return ReReadbleHttpxSuccessfulResponse(httpx.Response(status_code=400, text="%s" % e)), None
-    
+async def _prepare_chat_request(chat_request: ChatCompletionsRequest) -> tuple[List[str], ToolResultBudget]:
+    '''合并客户端返回的工具结果，按需伪装请求，返回客户端工具名和本请求的工具结果预算'''
     client_tools_names = [t["function"]["name"] for t in list(chat_request["tools"])] if chat_request.get("tools") else []
-    server_tools = [v[1] for k,v in FUNCTION_CALLING_TOOLS.items() if k not in client_tools_names]
+    server_tools = [v[1] for k,v in current_tools().items() if k not in client_tools_names]
 
     tool_call_results = parse_tool_messages_to_toolcallresult(chat_request)
     tool_call_results = await merge_toolcallresult_from_cache(tool_call_results)
+    budget = ToolResultBudget(TOOL_RESULTS_REQUEST_MAX_TOKENS, TOOL_RESULTS_DEDUP, client_tools_names)
+    tool_call_results = budget.apply(tool_call_results)
 
-    logger.debug("========= ORIGIN REQUEST:\n %s" % to_json(chat_request, indent=2).decode())
+    logger.opt(lazy=True).debug("========= ORIGIN REQUEST:\n {}", lambda: to_json(chat_request, indent=2).decode())
     fake_chat_request_if_need(chat_request, server_tools, tool_call_results)
-    
+    return client_tools_names, budget
+
+def _dispatch_tool_calls(tool_calls: List[Union[ChatCompletionMessageToolCall, ChoiceDeltaToolCall]], client_tools_names: List[str], tool_context: ToolContext, speculative: SpeculativeToolCalls = None) -> tuple[List, List]:
+    '''服务端工具提交执行（已提前开始的直接使用），客户端工具以id占位'''
+    client_tool_calls = []
+    tool_call_results = []
+    for tc in tool_calls:
+        if tc.function.name in client_tools_names:
+            tool_call_results.append(tc.id)
+            client_tool_calls.append(tc)
+        else:
+            tc_result = speculative.take(tc) if speculative is not None else None
+            if tc_result is None:
+                tc_result = asyncio.ensure_future(acalling(tc, tool_context, TOOL_CALL_TIMEOUT_SECONDS or None))
+            tool_call_results.append(tc_result)
+    if speculative is not None:
+        speculative.cancel()
+    return tool_call_results, client_tool_calls
+
+async def _proxy_and_call_function_if_need(target_url: str, headers: Headers, chat_request: ChatCompletionsRequest, http_client: httpx.AsyncClient, tool_context: ToolContext) -> tuple[ReReadbleHttpxSuccessfulResponse, List]:
+    client_tools_names, budget = await _prepare_chat_request(chat_request)
+    return await _call_function_loop(target_url, headers, chat_request, client_tools_names, http_client, tool_context, budget)
+
+async def _call_function_loop(target_url: str, headers: Headers, chat_request: ChatCompletionsRequest, client_tools_names: List[str], http_client: httpx.AsyncClient, tool_context: ToolContext, budget: ToolResultBudget, first_response: httpx.Response = None) -> tuple[ReReadbleHttpxSuccessfulResponse, List]:
+    '''first_response为已经打开的首轮响应（如上游忽略了stream参数时），首轮不再重新发送请求'''
     for i in range(MAX_TOOL_CALL_ITERATIONS_NUMBER):
-        tool_calls, chat_response = await get_tool_calls_from_openai_response(target_url, headers, chat_request, http_client)
-        if not tool_calls or i == 9:
+        speculative = SpeculativeToolCalls(client_tools_names, tool_context, TOOL_CALL_TIMEOUT_SECONDS or None) if i < MAX_TOOL_CALL_ITERATIONS_NUMBER - 1 else None
+        try:
+            tool_calls, chat_response = await get_tool_calls_from_openai_response(target_url, headers, chat_request, http_client, speculative, first_response if i == 0 else None)
+        except BaseException:
+            if speculative is not None:
+                speculative.cancel()
+            raise
+        if not tool_calls or i == MAX_TOOL_CALL_ITERATIONS_NUMBER - 1:
+            if speculative is not None:
+                speculative.cancel()
+            TOOL_LOOP_ITERATIONS.observe(i + 1)
             return ReReadbleHttpxSuccessfulResponse(chat_response), None
         
-        client_tool_calls = []
-        tool_call_results = []
-        loop = asyncio.get_running_loop()
-        for tc in tool_calls:
-            if tc.function.name in client_tools_names:
-                tool_call_results.append(tc.id)
-                client_tool_calls.append(tc)
-            else:
-                tc_result = loop.run_in_executor(function_executor, calling, tc)
-                tool_call_results.append(tc_result)                                
+        tool_call_results, client_tool_calls = _dispatch_tool_calls(tool_calls, client_tools_names, tool_context, speculative)
         if client_tool_calls:            
+            TOOL_LOOP_ITERATIONS.observe(i + 1)
             client_tool_call_resp = await create_response_for_toolcalls(chat_response, client_tool_calls)
             return ReReadbleHttpxSuccessfulResponse(client_tool_call_resp), tool_call_results
         else:
             await chat_response.aclose()
-            add_tool_calls_result_messages(chat_request, [await r for r in tool_call_results])
+            add_tool_calls_result_messages(chat_request, budget.apply([await r for r in tool_call_results]))
+
+async def _stream_proxy_and_call_function_if_need(target_url: str, headers: Headers, chat_request: ChatCompletionsRequest, http_client: httpx.AsyncClient, tool_context: ToolContext, state_backend: StateBackend) -> Union[StreamingResponse, ReReadbleHttpxSuccessfulResponse]:
+    '''流式请求：首轮响应打开后立即返回StreamingResponse，文本增量边读边转发'''
+    client_tools_names, budget = await _prepare_chat_request(chat_request)
+    if STREAM_HEARTBEAT_SECONDS or STREAM_TOOL_EVENTS:   # 不等上游，立即打开SSE响应，上游错误改为在流中返回
+        content = _iter_call_function_loop_stream(None, target_url, headers, chat_request, client_tools_names, http_client, tool_context, state_backend, budget)
+        return StreamingResponse(content=content, status_code=200, media_type="text/event-stream", headers={"cache-control": "no-cache"})
+
+    chat_response = await _send_chat_request(target_url, headers, chat_request, http_client)
+    if chat_response.status_code != 200:
+        await chat_response.aread()
+        return ReReadbleHttpxSuccessfulResponse(chat_response)
+    if not is_event_stream(chat_response):  # 上游忽略了stream参数，退回非流式处理，使用已经收到的响应
+        resp, tool_call_results = await _call_function_loop(target_url, headers, chat_request, client_tools_names, http_client, tool_context, budget, chat_response)
+        if tool_call_results:
+            await state_backend.put_tool_call_results(tool_call_results)
+        return resp
+
+    stream_headers = {}
+    for key, value in chat_response.headers.items():
+        if key.lower() not in ['connection', 'content-length', 'content-encoding', 'transfer-encoding']:
+            stream_headers[key] = value
+    content = _iter_call_function_loop_stream(chat_response, target_url, headers, chat_request, client_tools_names, http_client, tool_context, state_backend, budget)
+    return StreamingResponse(content=content, status_code=200, headers=stream_headers)
+
+async def _iter_call_function_loop_stream(chat_response: Optional[httpx.Response], target_url: str, headers: Headers, chat_request: ChatCompletionsRequest, client_tools_names: List[str], http_client: httpx.AsyncClient, tool_context: ToolContext, state_backend: StateBackend, budget: ToolResultBudget) -> AsyncIterator[str]:
+    fake_mode = not chat_request.get("tools")
+    if chat_response is None:
+        yield SSE_HEARTBEAT     # 让响应头和第一个字节立即发出
+    for i in range(MAX_TOOL_CALL_ITERATIONS_NUMBER):
+        if i > 0 or chat_response is None:
+            send_task = asyncio.ensure_future(_send_chat_request(target_url, headers, chat_request, http_client))
+            async for event in iter_heartbeat(send_task, STREAM_HEARTBEAT_SECONDS):
+                yield event
+            chat_response = await send_task
+            if chat_response.status_code != 200:
+                await chat_response.aread()
+                await chat_response.aclose()
+                yield format_sse({"error": {"message": chat_response.text, "code": chat_response.status_code}})
+                yield SSE_DONE
+                return
+            if not is_event_stream(chat_response):  # 上游忽略了stream参数，退回非流式处理（使用已经收到的响应），结果作为一个chunk发出
+                loop_task = asyncio.ensure_future(_call_function_loop(target_url, headers, chat_request, client_tools_names, http_client, tool_context, budget, chat_response))
+                async for event in iter_heartbeat(loop_task, STREAM_HEARTBEAT_SECONDS):
+                    yield event
+                resp, tool_call_results = await loop_task
+                if tool_call_results:
+                    await state_backend.put_tool_call_results(tool_call_results)
+                if resp.status_code != 200:
+                    yield format_sse({"error": {"message": resp.text, "code": resp.status_code}})
+                else:
+                    yield format_sse(completion_to_chunk(from_json(resp.content)))
+                yield SSE_DONE
+                return
+
+        speculative = SpeculativeToolCalls(client_tools_names, tool_context, TOOL_CALL_TIMEOUT_SECONDS or None) if i < MAX_TOOL_CALL_ITERATIONS_NUMBER - 1 else None
+        chat_turn = ChatStreamTurn(chat_response, fake_mode, speculative.start if speculative is not None else None)
+        try:
+            async for event in chat_turn.aiter_forward():
+                yield event
+        except BaseException:
+            if speculative is not None:
+                speculative.cancel()
+            raise
+        finally:
+            await chat_response.aclose()
+        _observe_iteration(chat_response, chat_turn.get_response_text)
+
+        tool_calls = chat_turn.get_tool_calls()
+        if not tool_calls or i == MAX_TOOL_CALL_ITERATIONS_NUMBER - 1:
+            if speculative is not None:
+                speculative.cancel()
+            TOOL_LOOP_ITERATIONS.observe(i + 1)
+            for event in chat_turn.iter_held():
+                yield event
+            return
+
+        tool_call_results, client_tool_calls = _dispatch_tool_calls(tool_calls, client_tools_names, tool_context, speculative)
+        if client_tool_calls:
+            TOOL_LOOP_ITERATIONS.observe(i + 1)
+            await state_backend.put_tool_call_results(tool_call_results)
+            for event in chat_turn.iter_client_tool_calls(client_tool_calls):
+                yield event
+            return
+        async for event in iter_tool_progress(tool_calls, tool_call_results, STREAM_HEARTBEAT_SECONDS, STREAM_TOOL_EVENTS):
+            yield event
+        add_tool_calls_result_messages(chat_request, budget.apply([await r for r in tool_call_results]))
 
 async def merge_toolcallresult_from_cache(client_results: List[ToolCallResult]) -> List[ToolCallResult]:
-    cached_results = []
+    groups = []
+    cached_groups = {}  # 客户端工具调用id -> 所在批次，同一批有多个客户端工具时共用一份
     new_results = []
     for r in client_results:
-        tmp_cached_results = app.toolcalls_in_process.pop(r.id)
-        if tmp_cached_results:            
-            cached_results = list(tmp_cached_results)
-            i = cached_results.index(r.id)
-            cached_results[i] = r
+        group = cached_groups.get(r.id)
+        if group is None:
+            tmp_cached_results = await app.state_backend.pop_tool_call_results(r.id)
+            if tmp_cached_results:
+                group = list(tmp_cached_results)
+                groups.append(group)
+                for tc in group:
+                    if isinstance(tc, str):
+                        cached_groups[tc] = group
+        if group is not None and r.id in group:
+            group[group.index(r.id)] = r
         else:
             new_results.append(r)
     
     tool_call_results = new_results
-    for r in cached_results:
+    for r in [r for group in groups for r in group]:
         if isinstance(r, str):
             continue
         elif isinstance(r, ToolCallResult):
@@ -158,7 +507,7 @@ async def merge_toolcallresult_from_cache(client_results: List[ToolCallResult])
 
 async def create_response_for_toolcalls(chat_response: httpx.Response, client_tool_calls: List[Union[ChatCompletionMessageToolCall, ChoiceDeltaToolCall]]) -> httpx.Response:
     body_text = None
-    if not chat_response.headers["content-type"].lower().startswith("text/event-stream"):
+    if not is_event_stream(chat_response):
         chat_completion_json = from_json(chat_response.text, allow_partial=True)
         if not chat_completion_json["choices"][0]["finish_reason"]: # github copilot
             chat_completion_json["choices"][0]["finish_reason"] = "stop"
@@ -170,27 +519,21 @@ async def create_response_for_toolcalls(chat_response: httpx.Response, client_to
     else:
         chunk = None
         for line in chat_response.iter_lines():
-            if len(line) < 6:
-                continue                
-            if line[:6] != "data: ":
+            data = sse_data(line)
+            if data is None:
                 continue
-            data = line[6:].removesuffix("\r")
             if data.startswith("[DONE]"):
                 break
             
-            chunk_dict = from_json(data, allow_partial=True)
-            if chunk_dict["choices"][0].get("index") is None:   # for some proxy miss the index attribute
-                chunk_dict["choices"][0]["index"] = 0
-            if chunk_dict["choices"][0].get("delta") is not None and chunk_dict["choices"][0]["delta"].get("tool_calls") is not None and chunk_dict["choices"][0]["delta"]["tool_calls"][0].get("index") is None:
-                chunk_dict["choices"][0]["delta"]["tool_calls"][0]["index"] = 0
-
-            chunk = ChatCompletionChunk.model_validate(chunk_dict)
+            fields = decode_chunk(data)
+            if not fields.has_choices:
+                continue
+            chunk = fields.chunk
             break
 
-        chunk.choices[0].finish_reason = "tool_calls"
-        chunk.choices[0].delta.tool_calls = client_tool_calls
-        chunk.choices[0].delta.content = ""
-        chunk.choices[0].delta.role = "assistant"
+        choice = chunk["choices"][0]
+        choice["finish_reason"] = "tool_calls"
+        choice["delta"] = {"role": "assistant", "content": "", "tool_calls": [dict(tc.model_dump(), index=i) for i, tc in enumerate(client_tool_calls)]}
         body_text = "data: %s\n\ndata: [DONE]" % to_json(chunk).decode()
 
     await chat_response.aclose()
@@ -201,19 +544,46 @@ async def create_response_for_toolcalls(chat_response: httpx.Response, client_to
     resp = httpx.Response(status_code=chat_response.status_code, headers=headers, text=body_text)
     return resp
 
-async def get_tool_calls_from_openai_response(target_url: str, headers: Headers, chat_request: ChatCompletionsRequest, httpx_client: httpx.AsyncClient) -> tuple[List[Union[ChatCompletionMessageToolCall, ChoiceDeltaToolCall]], httpx.Response]:   
-    logger.debug("========= REQUEST:\n%s" % to_json(chat_request, indent=2).decode())
-    chat_response = await httpx_client.post(target_url, content=to_json(chat_request), headers=headers)
+async def _send_chat_request(target_url: str, headers: Headers, chat_request: ChatCompletionsRequest, httpx_client: httpx.AsyncClient) -> httpx.Response:
+    logger.opt(lazy=True).debug("========= REQUEST:\n{}", lambda: to_json(chat_request, indent=2).decode())
+    body = encode_chat_request(chat_request)
+    trace = get_trace()
+    if trace is not None:
+        trace.start_iteration(body)
+    build_request = lambda client, url: client.build_request("POST", url, content=body, headers=headers)
+    start = time.perf_counter()
+    if app.upstream_mirrors.is_mirrored(target_url):
+        chat_response = await app.upstream_mirrors.send(app.upstream_clients, target_url, build_request)
+    else:
+        chat_response = await httpx_client.send(build_request(httpx_client, target_url), stream=True)
+    ttfb = time.perf_counter() - start
+    UPSTREAM_TTFB_SECONDS.observe(ttfb, host=chat_response.request.url.netloc.decode())
+    if trace is not None:
+        trace.update_iteration(status_code=chat_response.status_code, ttfb_seconds=round(ttfb, 6))
+    return chat_response
+
+def _observe_iteration(chat_response: httpx.Response, get_response_text: Callable[[], str]):
+    '''响应关闭后httpx会记录从发送请求到读完响应的总耗时；抽样追踪时才取响应内容'''
+    elapsed = chat_response.elapsed.total_seconds()
+    UPSTREAM_ITERATION_SECONDS.observe(elapsed, host=chat_response.request.url.netloc.decode())
+    trace = get_trace()
+    if trace is not None:
+        trace.end_iteration(elapsed, get_response_text())
+
+async def get_tool_calls_from_openai_response(target_url: str, headers: Headers, chat_request: ChatCompletionsRequest, httpx_client: httpx.AsyncClient, speculative: SpeculativeToolCalls = None, chat_response: httpx.Response = None) -> tuple[List[Union[ChatCompletionMessageToolCall, ChoiceDeltaToolCall]], httpx.Response]:   
+    if chat_response is None:
+        chat_response = await _send_chat_request(target_url, headers, chat_request, httpx_client)
     
     if chat_response.status_code != 200:
+        await chat_response.aread()
         return None, chat_response
 
-    await chat_response.aread()
-    logger.debug("========= RESPONSE:\n%s" % chat_response.text)
-
     content_builder = StringIO()                        
     tool_calls: List[Union[ChatCompletionMessageToolCall, ChoiceDeltaToolCall]] = []
-    if not chat_response.headers["content-type"].lower().startswith("text/event-stream"):
+    if not is_event_stream(chat_response):
+        await chat_response.aread()
+        _observe_iteration(chat_response, lambda: chat_response.text)
+        logger.opt(lazy=True).debug("========= RESPONSE:\n{}", lambda: chat_response.text)
         chat_completion_json = from_json(chat_response.text, allow_partial=True)
         if not chat_completion_json["choices"][0]["finish_reason"]: # github copilot
             chat_completion_json["choices"][0]["finish_reason"] = "stop"
@@ -221,39 +591,25 @@ async def get_tool_calls_from_openai_response(target_url: str, headers: Headers,
         tool_calls = chat_completion.choices[0].message.tool_calls 
         if chat_completion.choices[0].message.content:
             content_builder.write(chat_completion.choices[0].message.content) 
-    else:
-        for line in chat_response.iter_lines():
-            if len(line) < 6:
-                continue                
-            if line[:6] != "data: ":
+    else:   # 边读边合并tool_calls，参数完整的服务端工具调用提前开始执行
+        tool_call_assembler = ToolCallAssembler(speculative.start if speculative is not None else None)
+        is_done = False
+        async for line in aiter_lines_keep_content(chat_response):
+            data = sse_data(line)
+            if data is None or is_done:
                 continue
-            data = line[6:].removesuffix("\r")
             if data.startswith("[DONE]"):
-                break
+                is_done = True  # 继续读完，保留完整的响应体
+                continue
             
-            chunk_dict = from_json(data, allow_partial=True)
-            if chunk_dict["choices"][0].get("index") is None:   # for some proxy miss the index attribute
-                chunk_dict["choices"][0]["index"] = 0
-            if chunk_dict["choices"][0].get("delta") is not None and chunk_dict["choices"][0]["delta"].get("tool_calls") is not None and chunk_dict["choices"][0]["delta"]["tool_calls"][0].get("index") is None:
-                chunk_dict["choices"][0]["delta"]["tool_calls"][0]["index"] = 0
-
-            chunk = ChatCompletionChunk.model_validate(chunk_dict)
-            delta = chunk.choices[0].delta
-            if delta and delta.content:
-                content_builder.write(delta.content)
-            elif delta and delta.tool_calls:
-                tcchunklist = delta.tool_calls
-                for tcchunk in tcchunklist:
-                    if len(tool_calls) <= tcchunk.index:
-                        tool_calls.append(tcchunk)
-                    else:
-                        tc = tool_calls[tcchunk.index]
-                        if tcchunk.id:
-                            tc.id += tcchunk.id
-                        if tcchunk.function.name:
-                            tc.function.name += tcchunk.function.name
-                        if tcchunk.function.arguments:
-                            tc.function.arguments += tcchunk.function.arguments
+            fields = decode_chunk(data)
+            if fields.content:
+                content_builder.write(fields.content)
+            elif fields.tool_calls:
+                tool_call_assembler.feed(fields.tool_calls)
+        tool_calls = tool_call_assembler.tool_calls
+        _observe_iteration(chat_response, lambda: chat_response.text)
+        logger.opt(lazy=True).debug("========= RESPONSE:\n{}", lambda: chat_response.text)
     if not tool_calls:
         tool_calls = parse_tool_calls_from_message_content(content_builder.getvalue())
 
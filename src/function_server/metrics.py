@@ -0,0 +1,132 @@
+'''Prometheus文本格式的简单指标实现，只在事件循环线程中更新，不需要加锁'''
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Tuple
+
+
+Sample = Tuple[dict, float]   # (labels, value)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in labels.items())
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def _labels(self, key: tuple) -> dict:
+        return dict(zip(self.labelnames, key))
+
+    def render(self) -> List[str]:
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.type)]
+        for name, labels, value in self.samples():
+            lines.append("%s%s %s" % (name, format_labels(labels), value))
+        return lines
+
+    def samples(self) -> Iterable[Tuple[str, dict, float]]:
+        return []
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.values: Dict[tuple, float] = defaultdict(float)
+
+    def inc(self, value: float = 1, **labels):
+        self.values[self._key(labels)] += value
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, self._labels(key), value
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, value: float = 1, **labels):
+        self.values[self._key(labels)] -= value
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = (), buckets: Iterable[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.counts: Dict[tuple, List[int]] = {}
+        self.sums: Dict[tuple, float] = defaultdict(float)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        counts = self.counts.get(key)
+        if counts is None:
+            counts = self.counts[key] = [0] * (len(self.buckets) + 1)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+        self.sums[key] += value
+
+    def samples(self):
+        for key, counts in self.counts.items():
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield self.name + "_bucket", dict(labels, le="+Inf" if bound == float("inf") else str(bound)), cumulative
+            yield self.name + "_count", labels, cumulative
+            yield self.name + "_sum", labels, self.sums[key]
+
+
+class Collected(Metric):
+    '''抓取时才计算的指标，collect返回 [(labels, value)]'''
+    def __init__(self, name: str, help: str, type: str, collect: Callable[[], Iterable[Sample]]):
+        super().__init__(name, help)
+        self.type = type
+        self.collect = collect
+
+    def samples(self):
+        for labels, value in self.collect():
+            yield self.name, labels, value
+
+
+REGISTRY: List[Metric] = []
+
+def render_metrics() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+UPSTREAM_TTFB_SECONDS = Histogram("function_server_upstream_ttfb_seconds", "Time until upstream response headers per tool loop iteration", ["host"])
+UPSTREAM_ITERATION_SECONDS = Histogram("function_server_upstream_iteration_seconds", "Total upstream time per tool loop iteration, including reading the body", ["host"])
+UPSTREAM_IN_FLIGHT = Gauge("function_server_upstream_in_flight_requests", "Proxied requests in flight per upstream host", ["host"])
+TOOL_SECONDS = Histogram("function_server_tool_seconds", "Tool call time per tool", ["tool"])
+TOOL_LOOP_ITERATIONS = Histogram("function_server_tool_loop_iterations", "Upstream iterations per chat completion request", buckets=range(1, 11))
+CHAT_COALESCED = Counter("function_server_chat_coalesced_total", "Chat completion requests joined to an identical in-flight or cached request (hit) or not (miss)", ["result"])
+ADMISSION_QUEUE_SECONDS = Histogram("function_server_admission_queue_seconds", "Time waiting for an admission slot, per upstream host or tool", ["scope", "name"])
+ADMISSION_REJECTED = Counter("function_server_admission_rejected_total", "Requests or tool calls rejected by admission control, by reason (queue_full or queue_timeout)", ["scope", "name", "reason"])
+TOOL_RESULT_TOKENS = Counter("function_server_tool_result_tokens_total", "Tokens of server-side tool results sent upstream, counted only when a token budget is configured", ["tool"])
+TOOL_RESULT_TOKENS_SAVED = Counter("function_server_tool_result_tokens_saved_total", "Tokens of server-side tool results not sent upstream, by reason (truncated or deduplicated)", ["tool", "reason"])
+TOOL_CALLS_SPECULATIVE = Counter("function_server_tool_calls_speculative_total", "Server-side tool calls started before the upstream stream ended (started), and whether the result was used or wasted", ["result"])
+TOOL_RELOAD_SECONDS = Histogram("function_server_tool_reload_seconds", "Time to reload changed tool modules")
+UPSTREAM_HEDGES = Counter("function_server_upstream_hedges_total", "Hedged duplicate upstream requests sent, and whether the hedge (won) or the primary (lost) answered first", ["upstream", "result"])
+UPSTREAM_FAILOVERS = Counter("function_server_upstream_failovers_total", "Upstream requests retried on a mirror after a 5xx or connection error", ["upstream"])
@@ -0,0 +1,100 @@
+import asyncio
+import multiprocessing
+import signal
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Union
+from openai.types.chat.chat_completion_chunk import ChoiceDeltaToolCall
+from openai.types.chat.chat_completion_message_tool_call import ChatCompletionMessageToolCall
+from loguru import logger
+from .function_calling import ToolCallResult, calling, error_result, load_tools
+
+try:
+    import resource
+except ImportError:     # windows
+    resource = None
+
+
+class CpuTimeLimitExceeded(Exception):
+    pass
+
+def _on_cpu_time_limit(signum, frame):
+    raise CpuTimeLimitExceeded()
+
+def _init_worker(memory_limit_mb: int):
+    if resource is not None:
+        if memory_limit_mb:
+            limit = memory_limit_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        signal.signal(signal.SIGXCPU, _on_cpu_time_limit)
+    load_tools()
+
+def _ping():
+    return True
+
+def _call_in_worker(tool_call: Union[ChatCompletionMessageToolCall, ChoiceDeltaToolCall], cpu_time_limit_seconds: int) -> ToolCallResult:
+    if resource is None or not cpu_time_limit_seconds:
+        return calling(tool_call)
+
+    # 软限制设为本次调用开始时已用CPU时间 + 限额，超出后收到SIGXCPU，在工具内抛出CpuTimeLimitExceeded
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    soft = int(usage.ru_utime + usage.ru_stime) + cpu_time_limit_seconds + 1
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+    try:
+        return calling(tool_call)
+    finally:
+        resource.setrlimit(resource.RLIMIT_CPU, (hard, hard))
+
+
+class ToolProcessPool:
+    '''预先启动的工具进程池，用于CPU密集或需要隔离的工具（@tool(backend="process")）。
+
+    工作进程启动时加载工具注册表，可限制内存和单次调用的CPU时间；累计调用 max_workers*max_calls_per_worker 次后整体换成新的进程池。
+    '''
+    def __init__(self, max_workers: int, max_calls_per_worker: int = 0, memory_limit_mb: int = 0, cpu_time_limit_seconds: int = 0):
+        self.max_workers = max_workers
+        self.max_calls_per_worker = max_calls_per_worker
+        self.memory_limit_mb = memory_limit_mb
+        self.cpu_time_limit_seconds = cpu_time_limit_seconds
+        self.calls = 0
+        self.recycles = 0
+        self.pool = self._new_pool()
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker, initargs=(self.memory_limit_mb,))
+        for _ in range(self.max_workers):   # 预热，让所有工作进程提前启动并加载好工具
+            pool.submit(_ping)
+        return pool
+
+    def recycle(self):
+        '''换成新的进程池，例如工具重新加载后让工作进程加载新的工具'''
+        self._recycle(self.pool)
+
+    def _recycle(self, pool: ProcessPoolExecutor):
+        if pool is not self.pool:
+            return
+        self.calls = 0
+        self.recycles += 1
+        self.pool = self._new_pool()
+        pool.shutdown(wait=False)   # 已提交的调用继续在旧进程中完成
+
+    async def submit(self, tool_call: Union[ChatCompletionMessageToolCall, ChoiceDeltaToolCall]) -> ToolCallResult:
+        self.calls += 1
+        if self.max_calls_per_worker and self.calls > self.max_workers * self.max_calls_per_worker:
+            self._recycle(self.pool)
+        pool = self.pool
+        try:
+            return await asyncio.wrap_future(pool.submit(_call_in_worker, tool_call, self.cpu_time_limit_seconds))
+        except BrokenProcessPool as e:
+            logger.warning("process pool broken when call [%s]: %s" % (tool_call.function.name, e))
+            self._recycle(pool)
+            return error_result(tool_call)
+
+    def stats(self) -> dict:
+        return {"max_workers": self.max_workers, "calls": self.calls, "recycles": self.recycles}
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -7,4 +7,72 @@ env.read_env()
 LOG_LEVEL = env.str('LOG_LEVEL', 'INFO')
 FAKE_ALL_MODEL = env.bool('FAKE_ALL_MODEL', False)
 NO_FAKE_MODELS = env.list("NO_FAKE_MODELS", [])
-WEB_SEARCH_ENGINE = env.str('WEB_SEARCH_ENGINE', 'bing')
\ No newline at end of file
+WEB_SEARCH_ENGINE = env.str('WEB_SEARCH_ENGINE', 'bing')
+WEB_SEARCH_ENGINES = [e.lower() for e in env.list('WEB_SEARCH_ENGINES', [WEB_SEARCH_ENGINE])]  # bing、google、duckduckgo，多个时并行查询
+WEB_SEARCH_MODE = env.str('WEB_SEARCH_MODE', 'first')  # first：返回最先得到的结果；merge：合并各引擎的结果
+WEB_SEARCH_TIMEOUT_SECONDS = env.float('WEB_SEARCH_TIMEOUT_SECONDS', 10)  # 超过时返回已得到的结果
+STREAMING_PROXY = env.bool('STREAMING_PROXY', True)  # stream请求边读边转发，不再整体缓冲上游响应
+STREAM_HEARTBEAT_SECONDS = env.float('STREAM_HEARTBEAT_SECONDS', 0)  # 大于0时立即打开SSE响应，等待上游和工具期间按此间隔发送心跳注释
+STREAM_TOOL_EVENTS = env.bool('STREAM_TOOL_EVENTS', False)  # 服务端工具开始/结束时发送 event: tool_call 事件
+VALIDATE_STREAM_CHUNKS = env.bool('VALIDATE_STREAM_CHUNKS', False)  # 调试用，用pydantic完整校验上游的每个chunk
+
+UPSTREAM_MAX_CONNECTIONS = env.int('UPSTREAM_MAX_CONNECTIONS', 100)  # 每个上游的连接池
+UPSTREAM_HOST_MAX_CONNECTIONS = env.dict('UPSTREAM_HOST_MAX_CONNECTIONS', {}, subcast_values=int)  # 按主机覆盖，如 api.openai.com=200,localhost=10
+UPSTREAM_MAX_KEEPALIVE_CONNECTIONS = env.int('UPSTREAM_MAX_KEEPALIVE_CONNECTIONS', 20)
+UPSTREAM_KEEPALIVE_EXPIRY_SECONDS = env.float('UPSTREAM_KEEPALIVE_EXPIRY_SECONDS', 30)
+UPSTREAM_HTTP2 = env.bool('UPSTREAM_HTTP2', False)  # 需要安装 httpx[http2]
+UPSTREAM_MAX_CONCURRENCY = env.int('UPSTREAM_MAX_CONCURRENCY', 0)  # 每个上游同时处理的代理请求数（流式请求到响应结束），0 表示不限制
+UPSTREAM_HOST_MAX_CONCURRENCY = env.dict('UPSTREAM_HOST_MAX_CONCURRENCY', {}, subcast_values=int)  # 按主机覆盖
+UPSTREAM_MAX_QUEUE = env.int('UPSTREAM_MAX_QUEUE', 100)  # 超过并发上限时最多排队的请求数，队列满时返回429
+UPSTREAM_QUEUE_TIMEOUT_SECONDS = env.float('UPSTREAM_QUEUE_TIMEOUT_SECONDS', 10)  # 排队超过该时间返回503
+UPSTREAM_MIRRORS = env.json('UPSTREAM_MIRRORS', {})  # 等价的上游地址，用于对冲和故障转移，如 {"https://api.a.com/v1": ["https://mirror.a.com/v1"]}
+UPSTREAM_HEDGE_PERCENTILE = env.float('UPSTREAM_HEDGE_PERCENTILE', 95)  # 主请求超过首字节耗时的该分位数时向镜像发对冲请求，0 表示不对冲只做故障转移
+UPSTREAM_HEDGE_MIN_SECONDS = env.float('UPSTREAM_HEDGE_MIN_SECONDS', 1)  # 对冲等待时间的下限
+UPSTREAM_MAX_FAILURES = env.int('UPSTREAM_MAX_FAILURES', 3)  # 连续失败该次数后暂停使用该地址，0 表示不暂停
+UPSTREAM_EJECT_SECONDS = env.float('UPSTREAM_EJECT_SECONDS', 30)
+UPSTREAM_CONNECT_TIMEOUT_SECONDS = env.float('UPSTREAM_CONNECT_TIMEOUT_SECONDS', 10)
+UPSTREAM_READ_TIMEOUT_SECONDS = env.float('UPSTREAM_READ_TIMEOUT_SECONDS', 600)
+UPSTREAM_WRITE_TIMEOUT_SECONDS = env.float('UPSTREAM_WRITE_TIMEOUT_SECONDS', 60)
+UPSTREAM_POOL_TIMEOUT_SECONDS = env.float('UPSTREAM_POOL_TIMEOUT_SECONDS', 30)  # 等待空闲连接的时间
+
+CHAT_PROXY_CACHE_TTL_SECONDS = env.float('CHAT_PROXY_CACHE_TTL_SECONDS', 5*60)
+CHAT_PROXY_CACHE_MAX_ENTRIES = env.int('CHAT_PROXY_CACHE_MAX_ENTRIES', 10000)
+CHAT_PROXY_CACHE_MAX_BYTES = env.int('CHAT_PROXY_CACHE_MAX_BYTES', 256*1024*1024)
+TOOLCALLS_CACHE_TTL_SECONDS = env.float('TOOLCALLS_CACHE_TTL_SECONDS', 60)
+TOOLCALLS_CACHE_MAX_ENTRIES = env.int('TOOLCALLS_CACHE_MAX_ENTRIES', 10000)
+
+STATE_BACKEND = env.str('STATE_BACKEND', 'memory')  # memory 或 sqlite，多个worker时用 sqlite 共享状态
+STATE_SQLITE_PATH = env.str('STATE_SQLITE_PATH', '')  # 默认在临时目录下
+STATE_PENDING_TIMEOUT_SECONDS = env.float('STATE_PENDING_TIMEOUT_SECONDS', 60)  # 等待其他worker中服务端工具结果的最长时间
+
+TOOLS_RELOAD_INTERVAL_SECONDS = env.float('TOOLS_RELOAD_INTERVAL_SECONDS', 0)  # 定期检查tools目录，重新加载修改过的工具模块，0 表示只在 POST /tools/reload 时重新加载
+REMOTE_FUNCTION_SERVERS = env.list('REMOTE_FUNCTION_SERVERS', [])  # 级联模式，合并这些function server的工具，如 http://gpu-tools:8000,http://browser-tools:8000
+REMOTE_TOOLS_REFRESH_SECONDS = env.float('REMOTE_TOOLS_REFRESH_SECONDS', 60)  # 重新验证远程工具列表的间隔，0 表示只在启动时获取
+
+FUNCTION_EXECUTOR_MAX_WORKERS = env.int('FUNCTION_EXECUTOR_MAX_WORKERS', 5)
+TOOLCALLS_MAX_CONCURRENCY = env.int('TOOLCALLS_MAX_CONCURRENCY', 10)  # /toolcalls 一批调用的最大并发
+TOOL_CALL_TIMEOUT_SECONDS = env.float('TOOL_CALL_TIMEOUT_SECONDS', 0)  # 0 表示不限制
+TOOL_MAX_CONCURRENCY = env.int('TOOL_MAX_CONCURRENCY', 0)  # 每个工具同时执行的调用数，@tool(max_concurrency=...) 覆盖，0 表示不限制
+TOOL_MAX_QUEUE = env.int('TOOL_MAX_QUEUE', 100)  # 超过并发上限时每个工具最多排队的调用数，超出的调用直接返回错误结果
+TOOL_QUEUE_TIMEOUT_SECONDS = env.float('TOOL_QUEUE_TIMEOUT_SECONDS', 10)
+
+TOOL_RESULT_MAX_TOKENS = env.int('TOOL_RESULT_MAX_TOKENS', 0)  # 单个工具结果发回上游的token上限，@tool(max_result_tokens=...) 覆盖，0 表示不限制
+TOOL_RESULTS_REQUEST_MAX_TOKENS = env.int('TOOL_RESULTS_REQUEST_MAX_TOKENS', 0)  # 一个请求的工具循环中全部工具结果的token上限，0 表示不限制
+TOOL_RESULTS_DEDUP = env.bool('TOOL_RESULTS_DEDUP', True)  # 与之前完全相同的工具结果只引用之前的工具调用id
+TOKENIZER_ENCODING = env.str('TOKENIZER_ENCODING', 'cl100k_base')  # 安装了tiktoken时用于计数，否则按4个字符一个token估算
+
+PROCESS_POOL_MAX_WORKERS = env.int('PROCESS_POOL_MAX_WORKERS', 2)  # 只在有backend="process"的工具时启动，每个uvicorn worker一个进程池
+PROCESS_POOL_MAX_CALLS_PER_WORKER = env.int('PROCESS_POOL_MAX_CALLS_PER_WORKER', 100)  # 0 表示不回收
+PROCESS_POOL_MEMORY_LIMIT_MB = env.int('PROCESS_POOL_MEMORY_LIMIT_MB', 1024)  # 工作进程的地址空间上限，0 表示不限制
+PROCESS_POOL_CPU_TIME_LIMIT_SECONDS = env.int('PROCESS_POOL_CPU_TIME_LIMIT_SECONDS', 10)  # 单次调用，0 表示不限制
+CALCULATOR_TOOL = env.bool('CALCULATOR_TOOL', False)  # 启用示例工具calculator（在进程池中执行）
+
+PROMPT_TIME_GRANULARITY_SECONDS = env.int('PROMPT_TIME_GRANULARITY_SECONDS', 3600)  # 伪装提示词中当前时间的精度
+
+TRACE_SAMPLE_RATE = env.float('TRACE_SAMPLE_RATE', 0)  # 按此比例抽样记录chat请求的完整追踪，由 /debug/traces 查看，0 表示不记录
+TRACE_MAX_ENTRIES = env.int('TRACE_MAX_ENTRIES', 100)  # 保留最近的追踪条数
+TRACE_MAX_BODY_CHARS = env.int('TRACE_MAX_BODY_CHARS', 64*1024)  # 追踪中每个请求/响应体/工具结果保留的最大字符数
+
+AUTO_INSTALL_TOOL_REQUIREMENTS = env.bool('AUTO_INSTALL_TOOL_REQUIREMENTS', False)  # 启动时安装工具依赖，建议改用 install-tools
+
+COALESCE_IGNORE_FIELDS = env.list('COALESCE_IGNORE_FIELDS', ['user', 'stream_options'])  # 合并相同请求时忽略的字段，嵌套字段用 a.b
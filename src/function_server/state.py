@@ -0,0 +1,191 @@
+import os
+import time
+import json
+import asyncio
+import sqlite3
+import tempfile
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Union
+import httpx
+from loguru import logger
+from .function_calling import ToolCallResult
+from .utils import Cache, ReReadbleHttpxSuccessfulResponse
+
+
+PendingToolCallResults = List[Union[str, ToolCallResult, asyncio.Future]]  # 客户端工具调用为其id，服务端工具调用为结果或未完成的Future
+
+class StateBackend:
+    '''多个请求（及多个worker进程）间共享的状态：
+    - 交给客户端执行工具时，同一批中服务端工具的结果，等客户端带着工具结果再次请求时取回
+    - 已完成的chat响应，相同请求可直接复用
+    '''
+    async def put_tool_call_results(self, tool_call_results: PendingToolCallResults):
+        raise NotImplementedError
+
+    async def pop_tool_call_results(self, tool_call_id: str) -> Optional[List[Union[str, ToolCallResult]]]:
+        '''按客户端工具调用id取出整批结果，不存在时返回None'''
+        raise NotImplementedError
+
+    async def get_response(self, key: str) -> Optional[ReReadbleHttpxSuccessfulResponse]:
+        raise NotImplementedError
+
+    async def put_response(self, key: str, response: ReReadbleHttpxSuccessfulResponse):
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        return {}
+
+    async def aclose(self):
+        pass
+
+
+class MemoryStateBackend(StateBackend):
+    '''进程内状态，单worker时使用。已完成的响应由进程内的chat_proxy_cache保留，这里不再重复保存'''
+    def __init__(self, toolcalls_in_process: Cache):
+        self.toolcalls_in_process = toolcalls_in_process
+
+    async def put_tool_call_results(self, tool_call_results: PendingToolCallResults):
+        for tc in tool_call_results:
+            if isinstance(tc, str):
+                self.toolcalls_in_process.put(tc, tool_call_results)
+
+    async def pop_tool_call_results(self, tool_call_id: str):
+        return self.toolcalls_in_process.pop(tool_call_id)
+
+    async def get_response(self, key: str):
+        return None
+
+    async def put_response(self, key: str, response: ReReadbleHttpxSuccessfulResponse):
+        pass
+
+    def stats(self) -> dict:
+        return {"backend": "memory", "toolcalls_in_process": self.toolcalls_in_process.stats()}
+
+
+class SqliteStateBackend(StateBackend):
+    '''SQLite（WAL模式）文件中的状态，同一台机器上的多个uvicorn worker共享，不需要外部服务。
+
+    服务端工具还在执行时先写入占位行，全部完成后写入结果；其他worker取结果时遇到占位行会等待到pending_timeout。
+    '''
+    def __init__(self, path: str, toolcalls_ttl: float, response_ttl: float, pending_timeout: float):
+        self.path = path
+        self.toolcalls_ttl = toolcalls_ttl
+        self.response_ttl = response_ttl
+        self.pending_timeout = pending_timeout
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite_state")  # 连接只在这个线程中使用
+        self.conn: sqlite3.Connection = None
+        self.background_tasks = set()
+        self.hits = 0
+        self.misses = 0
+        self.executor.submit(self._connect).result()
+
+    def _connect(self):
+        self.conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS tool_call_results (tool_call_id TEXT PRIMARY KEY, results TEXT, expire_at REAL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, status_code INTEGER, headers TEXT, content BLOB, expire_at REAL)")
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def put_tool_call_results(self, tool_call_results: PendingToolCallResults):
+        ids = [tc for tc in tool_call_results if isinstance(tc, str)]
+        await self._run(self._put_tool_call_results, ids, None)
+        task = asyncio.ensure_future(self._put_when_done(ids, tool_call_results))
+        self._add_background_task(task)
+        task.add_done_callback(partial(self._on_put_done, ids))
+
+    def _add_background_task(self, task: asyncio.Future):
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    def _on_put_done(self, ids: List[str], task: asyncio.Future):
+        '''服务端工具被取消或出错时删除占位行，其他worker不用等到pending_timeout'''
+        if not task.cancelled() and task.exception() is None:
+            return
+        logger.warning("pending tool call results of [%s] failed: %r" % (", ".join(ids), "cancelled" if task.cancelled() else task.exception()))
+        self._add_background_task(asyncio.ensure_future(self._run(self._delete_pending_tool_call_results, ids)))
+
+    async def _put_when_done(self, ids: List[str], tool_call_results: PendingToolCallResults):
+        results = []
+        for tc in tool_call_results:
+            if isinstance(tc, str):
+                results.append(tc)
+            elif isinstance(tc, ToolCallResult):
+                results.append(tc.model_dump(mode="json"))
+            else:
+                results.append((await tc).model_dump(mode="json"))
+        await self._run(self._put_tool_call_results, ids, json.dumps(results))
+
+    def _put_tool_call_results(self, ids: List[str], results: Optional[str]):
+        now = time.time()
+        self.conn.execute("DELETE FROM tool_call_results WHERE expire_at < ?", (now,))
+        self.conn.executemany("INSERT OR REPLACE INTO tool_call_results VALUES (?, ?, ?)", [(id, results, now + self.toolcalls_ttl) for id in ids])
+
+    async def pop_tool_call_results(self, tool_call_id: str):
+        deadline = time.time() + self.pending_timeout
+        while True:
+            row = await self._run(self._get_tool_call_results, tool_call_id)
+            if row is None:
+                self.misses += 1
+                return None
+            if row[0] is not None:
+                break
+            if time.time() > deadline:
+                logger.warning("pending tool call results of [%s] timeout" % tool_call_id)
+                self.misses += 1
+                return None
+            await asyncio.sleep(0.05)
+
+        await self._run(self._delete_tool_call_results, tool_call_id)
+        self.hits += 1
+        return [r if isinstance(r, str) else ToolCallResult.model_validate(r) for r in json.loads(row[0])]
+
+    def _get_tool_call_results(self, tool_call_id: str):
+        return self.conn.execute("SELECT results FROM tool_call_results WHERE tool_call_id = ? AND expire_at >= ?", (tool_call_id, time.time())).fetchone()
+
+    def _delete_tool_call_results(self, tool_call_id: str):
+        self.conn.execute("DELETE FROM tool_call_results WHERE tool_call_id = ?", (tool_call_id,))
+
+    def _delete_pending_tool_call_results(self, ids: List[str]):
+        self.conn.executemany("DELETE FROM tool_call_results WHERE tool_call_id = ? AND results IS NULL", [(id,) for id in ids])
+
+    async def get_response(self, key: str):
+        row = await self._run(self._get_response, key)
+        if row is None:
+            return None
+        status_code, headers, content = row
+        return ReReadbleHttpxSuccessfulResponse(httpx.Response(status_code=status_code, headers=json.loads(headers), content=content))
+
+    def _get_response(self, key: str):
+        return self.conn.execute("SELECT status_code, headers, content FROM responses WHERE key = ? AND expire_at >= ?", (key, time.time())).fetchone()
+
+    async def put_response(self, key: str, response: ReReadbleHttpxSuccessfulResponse):
+        headers = [(k, v) for k, v in response.headers.items() if k.lower() not in ['content-length', 'content-encoding', 'transfer-encoding', 'connection']]
+        await self._run(self._put_response, key, response.status_code, json.dumps(headers), response.content)
+
+    def _put_response(self, key: str, status_code: int, headers: str, content: bytes):
+        now = time.time()
+        self.conn.execute("DELETE FROM responses WHERE expire_at < ?", (now,))
+        self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)", (key, status_code, headers, content, now + self.response_ttl))
+
+    def stats(self) -> dict:
+        return {"backend": "sqlite", "path": self.path, "hits": self.hits, "misses": self.misses}
+
+    async def aclose(self):
+        if self.background_tasks:
+            await asyncio.wait(list(self.background_tasks), timeout=self.pending_timeout)
+        await self._run(self.conn.close)
+        self.executor.shutdown(wait=False)
+
+
+def create_state_backend(backend: str, toolcalls_in_process: Cache, sqlite_path: str, toolcalls_ttl: float, response_ttl: float, pending_timeout: float) -> StateBackend:
+    if backend == "sqlite":
+        path = sqlite_path or os.path.join(tempfile.gettempdir(), "function_server_state.db")
+        logger.info("use sqlite state backend: %s" % path)
+        return SqliteStateBackend(path, toolcalls_ttl, response_ttl, pending_timeout)
+    elif backend == "memory":
+        return MemoryStateBackend(toolcalls_in_process)
+    raise ValueError("unknown state backend: %s" % backend)
@@ -0,0 +1,288 @@
+import time
+import codecs
+import asyncio
+from io import StringIO
+from typing import AsyncIterator, Callable, Iterator, List, NamedTuple, Optional, Union
+import httpx
+from openai.types.chat.chat_completion_chunk import ChatCompletionChunk, ChoiceDeltaToolCall
+from openai.types.chat.chat_completion_message_tool_call import ChatCompletionMessageToolCall
+from pydantic import ValidationError
+from pydantic_core import from_json, to_json
+from loguru import logger
+from .fake_messages import parse_tool_calls_from_message_content
+from .settings import VALIDATE_STREAM_CHUNKS
+
+
+def is_event_stream(response: httpx.Response) -> bool:
+    return response.headers.get("content-type", "").lower().startswith("text/event-stream")
+
+def sse_data(line: str) -> Optional[str]:
+    '''取出SSE行中的data内容，非data行返回None'''
+    if len(line) < 6 or line[:6] != "data: ":
+        return None
+    return line[6:].removesuffix("\r")
+
+class ChunkFields(NamedTuple):
+    '''chunk中工具调用循环用到的字段'''
+    chunk: dict
+    has_choices: bool
+    content: Optional[str] = None
+    tool_calls: Optional[List[dict]] = None
+    finish_reason: Optional[str] = None
+
+def decode_chunk(data: Union[str, bytes]) -> ChunkFields:
+    '''解析一个chunk，只取出 delta.content、delta.tool_calls 和 finish_reason，不构造pydantic对象；VALIDATE_STREAM_CHUNKS 时额外做完整校验'''
+    try:
+        chunk_dict = from_json(data, cache_strings=False)     # chunk很小，字符串缓存反而更慢
+    except ValueError:
+        chunk_dict = from_json(data, cache_strings=False, allow_partial=True)
+    choices = chunk_dict.get("choices")
+    if not choices:
+        return ChunkFields(chunk_dict, False)
+
+    choice = choices[0]
+    if choice.get("index") is None:   # for some proxy miss the index attribute
+        choice["index"] = 0
+    delta = choice.get("delta") or {}
+    tool_calls = delta.get("tool_calls")
+    if tool_calls and tool_calls[0].get("index") is None:
+        tool_calls[0]["index"] = 0
+    if VALIDATE_STREAM_CHUNKS:
+        try:
+            ChatCompletionChunk.model_validate(chunk_dict)
+        except ValidationError as e:
+            logger.warning("invalid chunk from upstream: %s\n%s" % (data, e))
+    return ChunkFields(chunk_dict, True, delta.get("content"), tool_calls, choice.get("finish_reason"))
+
+def format_sse(obj) -> str:
+    return "data: %s\n\n" % to_json(obj).decode()
+
+def format_sse_event(event: str, obj) -> str:
+    return "event: %s\ndata: %s\n\n" % (event, to_json(obj).decode())
+
+SSE_DONE = "data: [DONE]\n\n"
+SSE_HEARTBEAT = ": keep-alive\n\n"   # SSE注释，客户端会忽略
+
+
+def completion_to_chunk(completion: dict) -> dict:
+    '''把非流式的chat.completion转成一个chunk，用于上游忽略stream参数时'''
+    choices = []
+    for choice in completion.get("choices") or []:
+        delta = dict(choice.get("message") or {})
+        if delta.get("tool_calls"):
+            delta["tool_calls"] = [dict(tc, index=i) for i, tc in enumerate(delta["tool_calls"])]
+        choices.append({"index": choice.get("index", 0), "delta": delta, "finish_reason": choice.get("finish_reason")})
+    chunk = {k: v for k, v in completion.items() if k not in ("choices", "object")}
+    chunk.update(object="chat.completion.chunk", choices=choices)
+    return chunk
+
+async def iter_heartbeat(future: asyncio.Future, interval: float) -> AsyncIterator[str]:
+    '''等待future完成，期间每interval秒产出一次心跳；客户端断开时取消future'''
+    try:
+        while interval and not future.done():
+            done, _ = await asyncio.wait([future], timeout=interval)
+            if not done:
+                yield SSE_HEARTBEAT
+    except BaseException:
+        future.cancel()
+        raise
+
+async def iter_tool_progress(tool_calls: List[Union[ChatCompletionMessageToolCall, ChoiceDeltaToolCall]], futures: List[asyncio.Future], heartbeat_seconds: float, tool_events: bool) -> AsyncIterator[str]:
+    '''等待服务端工具执行完，期间产出心跳，tool_events时每个工具开始和结束各产出一个tool_call事件'''
+    tool_call_of = dict(zip(futures, tool_calls))
+    if tool_events:
+        for tc in tool_calls:
+            yield format_sse_event("tool_call", {"id": tc.id, "name": tc.function.name, "status": "running"})
+    pending = set(futures)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=heartbeat_seconds or None, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                yield SSE_HEARTBEAT
+            elif tool_events:
+                for future in done:
+                    tc = tool_call_of[future]
+                    failed = future.cancelled() or future.exception() is not None or future.result()._is_error
+                    yield format_sse_event("tool_call", {"id": tc.id, "name": tc.function.name, "status": "error" if failed else "done"})
+    except BaseException:
+        for future in pending:
+            future.cancel()
+        raise
+
+
+async def aiter_lines_keep_content(response: httpx.Response) -> AsyncIterator[str]:
+    '''逐行读取SSE响应，同时保留响应体，读完后response.content仍然可用'''
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    parts = []
+    buffer = ""
+    async for part in response.aiter_bytes():
+        parts.append(part)
+        buffer += decoder.decode(part)
+        lines = buffer.split("\n")
+        buffer = lines.pop()
+        for line in lines:
+            yield line.removesuffix("\r")
+    buffer += decoder.decode(b"", final=True)
+    response._content = b"".join(parts)
+    if buffer:
+        yield buffer.removesuffix("\r")
+
+
+class ToolCallAssembler:
+    '''按index合并流式的tool_calls增量。某个调用的参数完整（出现下一个index，或参数能完整解析为JSON对象）时调用on_complete'''
+
+    def __init__(self, on_complete: Callable[[ChoiceDeltaToolCall], None] = None):
+        self.calls: List[dict] = []     # 合并中的调用，arguments为字符串片段列表，需要时才构造ChoiceDeltaToolCall
+        self.on_complete = on_complete
+        self.completed = set()
+        self._tool_calls: List[ChoiceDeltaToolCall] = None
+
+    def feed(self, tcchunklist: List[dict]):
+        self._tool_calls = None
+        for tcchunk in tcchunklist:
+            index = tcchunk.get("index") or 0
+            function = tcchunk.get("function") or {}
+            if len(self.calls) <= index:
+                for i in range(len(self.calls)):
+                    self._complete(i)
+                self.calls.append({"index": index, "id": tcchunk.get("id") or "", "type": tcchunk.get("type") or "function",
+                                   "name": function.get("name") or "", "arguments": [function.get("arguments") or ""]})
+                index = len(self.calls) - 1
+            else:
+                call = self.calls[index]
+                if tcchunk.get("id"):
+                    call["id"] += tcchunk["id"]
+                if function.get("name"):
+                    call["name"] += function["name"]
+                if function.get("arguments"):
+                    call["arguments"].append(function["arguments"])
+            if self.on_complete is not None and index not in self.completed and self.calls[index]["arguments"][-1].rstrip().endswith("}"):
+                try:
+                    if isinstance(from_json("".join(self.calls[index]["arguments"])), dict):
+                        self._complete(index)
+                except ValueError:
+                    pass
+
+    def _build(self, call: dict) -> ChoiceDeltaToolCall:
+        return ChoiceDeltaToolCall(index=call["index"], id=call["id"], type=call["type"], function={"name": call["name"], "arguments": "".join(call["arguments"])})
+
+    def _complete(self, i: int):
+        call = self.calls[i]
+        if self.on_complete is None or i in self.completed or not call["id"] or not call["name"]:
+            return
+        self.completed.add(i)
+        self.on_complete(self._build(call))
+
+    @property
+    def tool_calls(self) -> List[ChoiceDeltaToolCall]:
+        if self._tool_calls is None:
+            self._tool_calls = [self._build(call) for call in self.calls]
+        return self._tool_calls
+
+
+def split_fake_tool_calls(text: str) -> tuple[str, str, bool]:
+    '''伪装模式下把文本分成可以立即转发的部分和需要暂存的部分。只有 [ 之后（跳过空白）是 { 时才可能是工具调用数组，
+    返回(转发的文本, 暂存的文本, 是否确定是工具调用)；[ 之后还没有非空白字符时暂存但未确定'''
+    start = 0
+    while True:
+        i = text.find("[", start)
+        if i < 0:
+            return text, "", False
+        rest = text[i+1:].lstrip()
+        if not rest or rest[0] == "{":
+            return text[:i], text[i:], bool(rest)
+        start = i + 1
+
+
+class ChatStreamTurn:
+    '''上游的一次流式响应。文本增量立即转发给客户端，tool_calls增量暂存，读完后再决定是否进入工具调用循环'''
+
+    def __init__(self, response: httpx.Response, fake_mode: bool, on_tool_call_complete: Callable[[ChoiceDeltaToolCall], None] = None):
+        self.response = response
+        self.fake_mode = fake_mode  # 伪装模式下工具调用以 [{...}] 的形式出现在content中，从 [ 开始暂存
+        self.content_builder = StringIO()
+        self.tool_call_assembler = ToolCallAssembler(on_tool_call_complete)
+        self.held_chunks: List[dict] = []
+        self.last_chunk: dict = {}
+        self.is_holding = False
+        self.pending_index: Optional[int] = None  # 伪装模式下还不能确定是否工具调用的暂存chunk（如只收到了 [ ）
+        self.tool_calls_start = 0   # 伪装模式下工具调用数组在content中的起始位置
+
+    async def aiter_forward(self) -> AsyncIterator[str]:
+        '''逐个产出可以立即转发给客户端的SSE事件'''
+        async for line in self.response.aiter_lines():
+            data = sse_data(line)
+            if data is None:
+                continue
+            if data.startswith("[DONE]"):
+                break
+
+            fields = decode_chunk(data)
+            chunk_dict = fields.chunk
+            self.last_chunk = chunk_dict
+            if not fields.has_choices:
+                self.held_chunks.append(chunk_dict)
+                continue
+
+            if fields.tool_calls:
+                self.tool_call_assembler.feed(fields.tool_calls)
+                self.is_holding = True
+            content = fields.content
+            if content:
+                self.content_builder.write(content)
+
+            if self.is_holding or fields.finish_reason:
+                self.held_chunks.append(chunk_dict)
+            elif content and self.fake_mode and (self.pending_index is not None or "[" in content):
+                text = content
+                if self.pending_index is not None:
+                    text = self.held_chunks.pop(self.pending_index)["choices"][0]["delta"]["content"] + content
+                    self.pending_index = None
+                forward, held, self.is_holding = split_fake_tool_calls(text)
+                if held:
+                    held_chunk = decode_chunk(data).chunk
+                    held_chunk["choices"][0]["delta"]["content"] = held
+                    if self.is_holding:
+                        self.tool_calls_start = self.content_builder.tell() - len(held)
+                    else:
+                        self.pending_index = len(self.held_chunks)
+                    self.held_chunks.append(held_chunk)
+                if forward:
+                    chunk_dict["choices"][0]["delta"]["content"] = forward
+                    yield format_sse(chunk_dict)
+            else:
+                yield "data: %s\n\n" % data
+
+    def get_response_text(self) -> str:
+        '''本轮响应的文本和工具调用，用于追踪'''
+        text = self.content_builder.getvalue()
+        if self.tool_call_assembler.calls:
+            text += to_json([tc.model_dump() for tc in self.tool_call_assembler.tool_calls]).decode()
+        return text
+
+    def get_tool_calls(self) -> List[Union[ChatCompletionMessageToolCall, ChoiceDeltaToolCall]]:
+        if self.tool_call_assembler.tool_calls:
+            return self.tool_call_assembler.tool_calls
+        return parse_tool_calls_from_message_content(self.content_builder.getvalue()[self.tool_calls_start:])
+
+    def iter_held(self) -> Iterator[str]:
+        '''本轮不是工具调用时，补发暂存的事件'''
+        for chunk_dict in self.held_chunks:
+            yield format_sse(chunk_dict)
+        yield SSE_DONE
+
+    def iter_client_tool_calls(self, client_tool_calls: List[Union[ChatCompletionMessageToolCall, ChoiceDeltaToolCall]]) -> Iterator[str]:
+        '''把客户端工具调用作为最后一个chunk发给客户端'''
+        tool_calls = []
+        for i, tc in enumerate(client_tool_calls):
+            tc_dict = tc.model_dump()
+            tc_dict["index"] = i
+            tool_calls.append(tc_dict)
+        yield format_sse({
+            "id": self.last_chunk.get("id", ""),
+            "object": "chat.completion.chunk",
+            "created": self.last_chunk.get("created", int(time.time())),
+            "model": self.last_chunk.get("model", ""),
+            "choices": [{"index": 0, "delta": {"role": "assistant", "content": "", "tool_calls": tool_calls}, "finish_reason": "tool_calls"}]
+        })
+        yield SSE_DONE
@@ -0,0 +1,138 @@
+'''工具结果发回上游前的压缩：按工具和按请求的token预算截断，去掉工具循环中重复的结果'''
+import hashlib
+from functools import lru_cache
+from typing import Dict, List, Union
+from pydantic_core import from_json, to_json
+from loguru import logger
+from .function_calling import ToolCallResult, current_tools
+from .metrics import TOOL_RESULT_TOKENS, TOOL_RESULT_TOKENS_SAVED
+from .settings import TOOL_RESULT_MAX_TOKENS, TOKENIZER_ENCODING
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+@lru_cache(maxsize=1)
+def get_encoding():
+    '''安装了tiktoken时使用TOKENIZER_ENCODING，否则返回None，按4个字符一个token估算'''
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception as e:
+        logger.warning("load tokenizer [%s] error, fallback to estimating by length: %s" % (TOKENIZER_ENCODING, e))
+        return None
+
+def count_tokens(text: str) -> int:
+    encoding = get_encoding()
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    '''确定性地截断到max_tokens以内：JSON数组保留前面放得下的元素，其他文本保留开头和结尾'''
+    if count_tokens(text) <= max_tokens:
+        return text
+    if text.startswith("["):
+        try:
+            items = from_json(text)
+        except ValueError:
+            items = None
+        if isinstance(items, list):
+            return _truncate_json_list(items, max_tokens)
+    return _truncate_text(text, max_tokens)
+
+def _truncate_json_list(items: list, max_tokens: int) -> str:
+    kept, used = [], 2
+    for item in items:
+        item_tokens = count_tokens(to_json(item).decode()) + 1
+        if used + item_tokens > max_tokens - 16:   # 给截断说明留出位置
+            break
+        kept.append(item)
+        used += item_tokens
+    if not kept:    # 第一个元素就放不下时按文本截断
+        return _truncate_text(to_json(items).decode(), max_tokens)
+    return "%s\n...(%s more items truncated)" % (to_json(kept).decode(), len(items) - len(kept))
+
+def _truncate_text(text: str, max_tokens: int) -> str:
+    marker = "\n...[truncated %s tokens]...\n"
+    budget = max(max_tokens - 16, 0)
+    head, tail = budget * 2 // 3, budget - budget * 2 // 3
+    encoding = get_encoding()
+    if encoding is None:
+        total = count_tokens(text)
+        head_text, tail_text = text[:head*4], text[len(text) - tail*4:] if tail else ""
+    else:
+        tokens = encoding.encode(text, disallowed_special=())
+        total = len(tokens)
+        head_text, tail_text = encoding.decode(tokens[:head]), encoding.decode(tokens[total - tail:]) if tail else ""
+    return head_text + marker % (total - head - tail) + tail_text
+
+
+class ToolResultBudget:
+    '''一个请求的工具循环中，服务端工具结果发回上游前的处理：
+    - 单个结果超过工具的max_result_tokens（默认TOOL_RESULT_MAX_TOKENS）时截断
+    - 全部结果超过request_max_tokens时，后面的结果截断到剩余的预算
+    - 与之前某个结果完全相同时只引用之前的id
+    '''
+    def __init__(self, request_max_tokens: int = 0, dedup: bool = True, client_tools_names: List[str] = ()):
+        self.request_max_tokens = request_max_tokens
+        self.dedup = dedup
+        self.client_tools_names = client_tools_names
+        self.used_tokens = 0
+        self.saved_tokens = 0
+        self.rounds = 0
+        self.seen: Dict[str, tuple[int, str]] = {}  # 结果摘要 -> 第一次出现的(轮次, 工具调用id)
+        self.id_rounds: Dict[str, List[int]] = {}   # 工具调用id -> 出现过的轮次，fake模式每轮的id都从call_0开始
+
+    def apply(self, tool_call_results: List[Union[str, ToolCallResult]]) -> List[Union[str, ToolCallResult]]:
+        saved_tokens = self.saved_tokens
+        tcrs = [tcr for tcr in tool_call_results if isinstance(tcr, ToolCallResult)]
+        if tcrs:
+            self.rounds += 1
+            for tcr in tcrs:
+                self.id_rounds.setdefault(tcr.id, []).append(self.rounds)
+        tool_call_results = [self._apply(tcr) if isinstance(tcr, ToolCallResult) else tcr for tcr in tool_call_results]
+        if self.saved_tokens > saved_tokens:
+            logger.info("tool results: saved %s tokens (%s in this request)" % (self.saved_tokens - saved_tokens, self.saved_tokens))
+        return tool_call_results
+
+    def _apply(self, tcr: ToolCallResult) -> ToolCallResult:
+        tool_name = tcr.tool_call.function.name
+        tools = current_tools()
+        if tool_name in self.client_tools_names or tool_name not in tools:
+            return tcr
+        result = tcr.result
+
+        if self.dedup and len(result) > 64:
+            digest = hashlib.sha1(result.encode()).hexdigest()
+            first_round, first_id = self.seen.setdefault(digest, (self.rounds, tcr.id))
+            if (first_round, first_id) != (self.rounds, tcr.id):
+                if len(self.id_rounds[first_id]) > 1:   # id在多轮中出现过，需指明是哪一轮
+                    result = "(same result as tool call `%s` in tool results round %s)" % (first_id, first_round)
+                else:
+                    result = "(same result as tool call `%s`)" % first_id
+                self._saved(tool_name, "deduplicated", count_tokens(tcr.result) - count_tokens(result))
+                return tcr.model_copy(update={"result": result})
+
+        func, _ = tools[tool_name]
+        max_tokens = getattr(func, "max_result_tokens", None) or TOOL_RESULT_MAX_TOKENS
+        if self.request_max_tokens:
+            remaining = max(self.request_max_tokens - self.used_tokens, 0)
+            max_tokens = min(max_tokens, remaining) if max_tokens else remaining
+        if max_tokens or self.request_max_tokens:
+            tokens = count_tokens(result)
+            if tokens > max_tokens:
+                result = truncate_to_tokens(result, max_tokens) if max_tokens else "(result truncated: tool results token budget exhausted)"
+                truncated_tokens = count_tokens(result)
+                self._saved(tool_name, "truncated", tokens - truncated_tokens)
+                tokens = truncated_tokens
+            self.used_tokens += tokens
+            TOOL_RESULT_TOKENS.inc(tokens, tool=tool_name)
+        return tcr if result is tcr.result else tcr.model_copy(update={"result": result})
+
+    def _saved(self, tool_name: str, reason: str, tokens: int):
+        self.saved_tokens += tokens
+        TOOL_RESULT_TOKENS_SAVED.inc(tokens, tool=tool_name, reason=reason)
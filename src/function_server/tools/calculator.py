@@ -0,0 +1,42 @@
+import ast
+import math
+import operator
+from ..function_calling import tool
+from ..settings import CALCULATOR_TOOL
+
+
+OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+}
+FUNCTIONS = {name: getattr(math, name) for name in ["sqrt", "exp", "log", "log2", "log10", "sin", "cos", "tan", "asin", "acos", "atan", "floor", "ceil", "factorial", "gcd", "comb", "perm"]}
+FUNCTIONS.update({"abs": abs, "round": round, "min": min, "max": max})
+CONSTANTS = {"pi": math.pi, "e": math.e, "tau": math.tau}
+
+def evaluate(node):
+    '''只允许数字、运算符和白名单中的数学函数'''
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+        return node.value
+    if isinstance(node, ast.BinOp) and type(node.op) in OPERATORS:
+        return OPERATORS[type(node.op)](evaluate(node.left), evaluate(node.right))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in OPERATORS:
+        return OPERATORS[type(node.op)](evaluate(node.operand))
+    if isinstance(node, ast.Name) and node.id in CONSTANTS:
+        return CONSTANTS[node.id]
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS and not node.keywords:
+        return FUNCTIONS[node.func.id](*[evaluate(arg) for arg in node.args])
+    raise ValueError("unsupported expression: %s" % ast.dump(node))
+
+def calculator(expression: str) -> str:
+    '''a calculator. useful when you need to do exact math. input should be a math expression in python syntax, e.g. `2**10 * sqrt(3) / (1 + pi)`.'''
+    return str(evaluate(ast.parse(expression, mode="eval").body))
+
+if CALCULATOR_TOOL:     # backend="process"的示例工具，默认不启用，不启用时不会启动进程池
+    calculator = tool(calculator, backend="process")
@@ -1,9 +1,14 @@
-from typing import Iterator
-from ..function_calling import tool
-from search_engines import Google, Bing, config
-import os
+import time
 import random
-from ..settings import WEB_SEARCH_ENGINE
+import asyncio
+import argparse
+import urllib.parse
+from dataclasses import dataclass
+from typing import Callable, Dict, List
+import httpx
+from bs4 import BeautifulSoup
+from ..function_calling import tool, get_tool_context
+from ..settings import WEB_SEARCH_ENGINES, WEB_SEARCH_MODE, WEB_SEARCH_TIMEOUT_SECONDS
 from loguru import logger
 
 
@@ -16,37 +21,123 @@ USER_AGENTS = [
     "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_5; rv:123.0esr) Gecko/20100101 Firefox/123.0esr",
     "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36 Edg/123.0.0.0"
 ]
+MAX_RESULTS = 10
 
-class MyGoogle(Google):
-    def _selectors(self, element):
-        '''Returns the appropriate CSS selector.'''
-        selectors = {
-            'url': 'a[href]', 
-            'title': 'h3', 
-            'text': 'div[style="-webkit-line-clamp:2"]',
-            'links': 'div#search div.g', 
-            'next': 'a[href][aria-label="Page {page}"]'
-        }
-        return selectors[element]
-
-@tool
-def web_search(input: str) -> Iterator[dict]:
-    '''a search engine. useful when you need to answer questions about current events or are unsure or uncertain about certain things. input should be a search query.'''
-    if WEB_SEARCH_ENGINE.lower() == "google":
-        engine = MyGoogle()
-    else:
-        engine = Bing()
 
-    i = random.randint(0, len(USER_AGENTS)-1)
-    logger.info("FAKE_USER_AGENT: %s" % i)
-    config.FAKE_USER_AGENT = USER_AGENTS[i]
-    results = engine.search(input, 1)
+def _text(element) -> str:
+    return element.get_text(" ", strip=True) if element is not None else ""
+
+def parse_bing(html: str) -> List[dict]:
+    soup = BeautifulSoup(html, "html.parser")
+    results = []
+    for item in soup.select("li.b_algo"):
+        link = item.select_one("h2 a[href]")
+        if link is None:
+            continue
+        results.append({"title": _text(link), "url": link["href"], "text": _text(item.select_one("div.b_caption p") or item.select_one("p"))})
+    return results
+
+def parse_google(html: str) -> List[dict]:
+    soup = BeautifulSoup(html, "html.parser")
+    results = []
+    for item in soup.select("div#search div.g"):
+        link = item.select_one("a[href]")
+        title = item.select_one("h3")
+        if link is None or title is None:
+            continue
+        results.append({"title": _text(title), "url": link["href"], "text": _text(item.select_one('div[style="-webkit-line-clamp:2"]') or item.select_one("div.VwiC3b"))})
+    return results
+
+def parse_duckduckgo(html: str) -> List[dict]:
+    soup = BeautifulSoup(html, "html.parser")
+    results = []
+    for item in soup.select("div.result"):
+        link = item.select_one("a.result__a[href]")
+        if link is None:
+            continue
+        url = link["href"]
+        if url.startswith("//duckduckgo.com/l/"):     # 跳转链接，真实地址在uddg参数中
+            url = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query).get("uddg", [url])[0]
+        results.append({"title": _text(link), "url": url, "text": _text(item.select_one(".result__snippet"))})
+    return results
+
+@dataclass
+class SearchEngine:
+    url: str    # {query} 为转义后的查询
+    parse: Callable[[str], List[dict]]
+
+ENGINES: Dict[str, SearchEngine] = {
+    "bing": SearchEngine("https://www.bing.com/search?q={query}", parse_bing),
+    "google": SearchEngine("https://www.google.com/search?q={query}&hl=en", parse_google),
+    "duckduckgo": SearchEngine("https://html.duckduckgo.com/html/?q={query}", parse_duckduckgo),
+}
+
 
-    return [{"url": r.get('link'), "text": r.get('text')} for r in results.results() if r.get('text')][:10]
+async def search_engine(client: httpx.AsyncClient, name: str, query: str, timeout: float) -> List[dict]:
+    '''每次调用随机选一个User-Agent，只放在这次请求的header中'''
+    engine = ENGINES[name]
+    headers = {"user-agent": random.choice(USER_AGENTS), "accept-language": "en-US,en;q=0.9,zh-CN;q=0.8"}
+    resp = await client.get(engine.url.format(query=urllib.parse.quote_plus(query)), headers=headers, timeout=timeout, follow_redirects=True)
+    resp.raise_for_status()
+    return [r for r in engine.parse(resp.text) if r["text"]]
+
+async def search(client: httpx.AsyncClient, query: str, engines: List[str], mode: str, timeout: float) -> List[dict]:
+    '''多个搜索引擎并行查询。mode为first时返回最先得到的非空结果并取消其他查询，为merge时按排名交替合并并按url去重；
+    超过timeout时返回已得到的结果'''
+    deadline = time.perf_counter() + timeout
+    tasks = {asyncio.ensure_future(search_engine(client, name, query, timeout)): name for name in engines}
+    results: Dict[str, List[dict]] = {}
+    pending = set(tasks)
+    try:
+        while pending:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                logger.warning("web search [%s] timeout, pending engines: %s" % (query, ", ".join(tasks[t] for t in pending)))
+                break
+            done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    logger.warning("web search [%s] on %s error: %s" % (query, tasks[task], task.exception()))
+                    continue
+                results[tasks[task]] = task.result()
+                if mode == "first" and task.result():
+                    return task.result()[:MAX_RESULTS]
+    finally:
+        for task in pending:
+            task.cancel()
+    return merge_results([results[name] for name in engines if name in results])[:MAX_RESULTS]
+
+def merge_results(result_lists: List[List[dict]]) -> List[dict]:
+    merged, seen = [], set()
+    for rank in range(max((len(results) for results in result_lists), default=0)):
+        for results in result_lists:
+            if rank < len(results) and results[rank]["url"] not in seen:
+                seen.add(results[rank]["url"])
+                merged.append(results[rank])
+    return merged
+
+@tool(cache_ttl=600)
+async def web_search(input: str) -> List[dict]:
+    '''a search engine. useful when you need to answer questions about current events or are unsure or uncertain about certain things. input should be a search query.'''
+    return await search(get_tool_context().http_client, input, WEB_SEARCH_ENGINES, WEB_SEARCH_MODE, WEB_SEARCH_TIMEOUT_SECONDS)
 
-# requirements = """
-#     googlesearch-python>=1.2.3
-# """
 
 def main():
-    print(web_search("张学友"))
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="web search, or parse a saved result page with --html")
+    parser.add_argument("query", nargs="?", default="张学友")
+    parser.add_argument("--engine", action="append", choices=list(ENGINES), help="repeatable, defaults to WEB_SEARCH_ENGINES")
+    parser.add_argument("--mode", choices=["first", "merge"], default=WEB_SEARCH_MODE)
+    parser.add_argument("--timeout", type=float, default=WEB_SEARCH_TIMEOUT_SECONDS)
+    parser.add_argument("--html", help="parse a local HTML file with the (first) engine's parser instead of searching")
+    args = parser.parse_args()
+    engines = args.engine or WEB_SEARCH_ENGINES
+
+    if args.html:
+        with open(args.html, encoding="utf-8") as f:
+            print(ENGINES[engines[0]].parse(f.read()))
+        return
+
+    async def run():
+        async with httpx.AsyncClient() as client:
+            return await search(client, args.query, engines, args.mode, args.timeout)
+    print(asyncio.run(run()))
@@ -0,0 +1,79 @@
+'''按比例抽样的请求追踪：记录每轮上游请求/响应和工具耗时，最近的若干条保存在内存环形缓冲区中，由 /debug/traces 查看'''
+import time
+import random
+import itertools
+from collections import deque
+from contextvars import ContextVar
+from typing import Deque, List, Optional
+from .settings import TRACE_SAMPLE_RATE, TRACE_MAX_ENTRIES, TRACE_MAX_BODY_CHARS
+
+
+def clip(text: str) -> str:
+    if len(text) <= TRACE_MAX_BODY_CHARS:
+        return text
+    return text[:TRACE_MAX_BODY_CHARS] + "...(%s chars truncated)" % (len(text) - TRACE_MAX_BODY_CHARS)
+
+
+class RequestTrace:
+    '''一个chat请求的追踪，iterations中每轮上游请求一项，工具调用记录在发起它的那一轮中'''
+    _ids = itertools.count(1)
+
+    def __init__(self, target_url: str, chat_request: dict):
+        self.id = next(self._ids)
+        self.target_url = target_url
+        self.model = chat_request.get("model")
+        self.stream = bool(chat_request.get("stream"))
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.seconds: float = None
+        self.status_code: int = None
+        self.error: str = None
+        self.iterations: List[dict] = []
+
+    def start_iteration(self, body: bytes):
+        self.iterations.append({"offset_seconds": round(time.perf_counter() - self.start, 6), "request": clip(body.decode(errors="replace")),
+                                "status_code": None, "ttfb_seconds": None, "seconds": None, "response": None, "tool_calls": []})
+
+    def update_iteration(self, **fields):
+        if self.iterations:
+            self.iterations[-1].update(fields)
+
+    def end_iteration(self, seconds: float, response: str):
+        self.update_iteration(seconds=round(seconds, 6), response=clip(response))
+
+    def add_tool_call(self, id: str, name: str, arguments: str, seconds: float, result: Optional[str], is_error: bool):
+        tool_call = {"id": id, "name": name, "arguments": clip(arguments or ""), "seconds": round(seconds, 6), "error": is_error,
+                     "result": clip(result) if result is not None else None}
+        if self.iterations:
+            self.iterations[-1]["tool_calls"].append(tool_call)
+
+    def finish(self, status_code: int, error: BaseException = None):
+        '''error为发送响应（如流式响应中途）时的异常'''
+        self.seconds = round(time.perf_counter() - self.start, 6)
+        self.status_code = status_code
+        self.error = repr(error) if error is not None else None
+        TRACES.append(self)
+
+    def to_dict(self) -> dict:
+        return {"id": self.id, "target_url": self.target_url, "model": self.model, "stream": self.stream, "started_at": self.started_at,
+                "seconds": self.seconds, "status_code": self.status_code, "error": self.error, "iterations": self.iterations}
+
+
+TRACES: Deque[RequestTrace] = deque(maxlen=TRACE_MAX_ENTRIES)
+CURRENT_TRACE: ContextVar[Optional[RequestTrace]] = ContextVar("current_trace", default=None)
+
+def start_trace(target_url: str, chat_request: dict) -> Optional[RequestTrace]:
+    '''按TRACE_SAMPLE_RATE抽样，抽中时创建追踪并设为当前请求的追踪（其中创建的Task都会继承）'''
+    if not TRACE_SAMPLE_RATE or random.random() >= TRACE_SAMPLE_RATE:
+        return None
+    trace = RequestTrace(target_url, chat_request)
+    CURRENT_TRACE.set(trace)
+    return trace
+
+def get_trace() -> Optional[RequestTrace]:
+    return CURRENT_TRACE.get()
+
+def list_traces(min_seconds: float = 0, limit: int = 0) -> List[dict]:
+    '''最新的在前'''
+    traces = [t.to_dict() for t in reversed(TRACES) if (t.seconds or 0) >= min_seconds]
+    return traces[:limit] if limit else traces
@@ -0,0 +1,226 @@
+import time
+import asyncio
+import urllib.parse
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional
+import httpx
+from loguru import logger
+from .metrics import UPSTREAM_HEDGES, UPSTREAM_FAILOVERS
+
+try:
+    import h2  # noqa: F401
+except ImportError:
+    h2 = None
+
+
+def upstream_key(url: str) -> str:
+    '''按 scheme://host:port 区分上游'''
+    parts = urllib.parse.urlsplit(url)
+    return "%s://%s" % (parts.scheme.lower(), parts.netloc.lower())
+
+
+class UpstreamClients:
+    '''每个上游一个httpx.AsyncClient连接池，某个上游慢或突发时不会占满其他上游的连接'''
+    def __init__(self, max_connections: int, max_keepalive_connections: int, keepalive_expiry: float, http2: bool,
+                 connect_timeout: float, read_timeout: float, write_timeout: float, pool_timeout: float,
+                 host_max_connections: Dict[str, int] = None):
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2
+        if http2 and h2 is None:
+            logger.warning("UPSTREAM_HTTP2 needs the h2 package (pip install httpx[http2]), fallback to HTTP/1.1")
+            self.http2 = False
+        self.timeout = httpx.Timeout(connect=connect_timeout, read=read_timeout, write=write_timeout, pool=pool_timeout)
+        self.host_max_connections = host_max_connections or {}
+        self.clients: Dict[str, httpx.AsyncClient] = {}
+
+    def get(self, url: str) -> httpx.AsyncClient:
+        key = upstream_key(url)
+        client = self.clients.get(key)
+        if client is None:
+            max_connections = self.host_max_connections.get(urllib.parse.urlsplit(key).hostname, self.max_connections)
+            limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=min(self.max_keepalive_connections, max_connections), keepalive_expiry=self.keepalive_expiry)
+            client = self.clients[key] = httpx.AsyncClient(timeout=self.timeout, limits=limits, http2=self.http2)
+            logger.info("create connection pool for [%s]: max_connections=%s http2=%s" % (key, max_connections, self.http2))
+        return client
+
+    def stats(self) -> Dict[str, dict]:
+        stats = {}
+        for key, client in self.clients.items():
+            pool = getattr(client._transport, "_pool", None)   # httpcore.AsyncConnectionPool
+            connections = list(getattr(pool, "connections", []))
+            requests = list(getattr(pool, "_requests", []))
+            idle = sum(1 for c in connections if c.is_idle())
+            queued = sum(1 for r in requests if r.is_queued())
+            stats[key] = {
+                "max_connections": getattr(pool, "_max_connections", None),
+                "connections": len(connections),
+                "active": len(connections) - idle,
+                "idle": idle,
+                "http2": sum(1 for c in connections if getattr(c, "_connection", None) is not None and "HTTP2" in type(c._connection).__name__),
+                "requests": len(requests) - queued,
+                "queued": queued,
+            }
+        return stats
+
+    async def aclose(self):
+        for client in self.clients.values():
+            await client.aclose()
+        self.clients.clear()
+
+
+class UpstreamHealth:
+    '''一个上游地址的健康状态：连续失败达到上限后暂停使用一段时间，并记录最近成功请求的首字节耗时'''
+    def __init__(self):
+        self.ttfb: Deque[float] = deque(maxlen=200)
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+
+    def is_healthy(self) -> bool:
+        return time.time() >= self.ejected_until
+
+    def percentile(self, p: float) -> Optional[float]:
+        if len(self.ttfb) < 20:     # 样本太少时不对冲
+            return None
+        samples = sorted(self.ttfb)
+        return samples[min(int(len(samples) * p / 100), len(samples) - 1)]
+
+    def stats(self) -> dict:
+        return {"healthy": self.is_healthy(), "requests": self.requests, "failures": self.failures, "consecutive_failures": self.consecutive_failures,
+                "ttfb_p50": self.percentile(50), "ttfb_p95": self.percentile(95)}
+
+
+class UpstreamMirrors:
+    '''把一个上游base URL映射到多个等价的base URL（如同一服务商的多个镜像）：
+    - 对冲：主请求超过该地址首字节耗时的hedge_percentile分位数（不低于hedge_min_seconds）还没有响应头时，向下一个地址发同样的请求，先成功的胜出，另一个取消
+    - 故障转移：5xx或连接错误时换下一个地址，全部失败时返回最后一个5xx响应或抛出最后的错误
+    - 每个地址连续失败max_failures次后暂停eject_seconds秒，暂停的地址排在后面
+    '''
+    def __init__(self, mirrors: Dict[str, List[str]], hedge_percentile: float, hedge_min_seconds: float, max_failures: int, eject_seconds: float):
+        self.mirrors = {base.rstrip("/"): [base.rstrip("/")] + [m.rstrip("/") for m in urls if m.rstrip("/") != base.rstrip("/")] for base, urls in mirrors.items()}
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_seconds = hedge_min_seconds
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.health: Dict[str, UpstreamHealth] = {}
+
+    def _match(self, url: str) -> Optional[str]:
+        for base in self.mirrors:
+            if url == base or url.startswith(base + "/"):
+                return base
+        return None
+
+    def is_mirrored(self, url: str) -> bool:
+        return self._match(url) is not None
+
+    def candidates(self, url: str) -> List[str]:
+        '''等价的完整URL，健康的在前，同等健康时保持配置顺序'''
+        base = self._match(url)
+        if base is None:
+            return [url]
+        urls = [b + url[len(base):] for b in self.mirrors[base]]
+        return sorted(urls, key=lambda u: not self._health(u).is_healthy())
+
+    def _health(self, url: str) -> UpstreamHealth:
+        key = upstream_key(url)
+        health = self.health.get(key)
+        if health is None:
+            health = self.health[key] = UpstreamHealth()
+        return health
+
+    def hedge_delay(self, url: str) -> Optional[float]:
+        if not self.hedge_percentile:
+            return None
+        delay = self._health(url).percentile(self.hedge_percentile)
+        return None if delay is None else max(delay, self.hedge_min_seconds)
+
+    async def send(self, clients: UpstreamClients, url: str, build_request: Callable[[httpx.AsyncClient, str], httpx.Request]) -> httpx.Response:
+        urls = self.candidates(url)
+        if len(urls) == 1:
+            client = clients.get(url)
+            return await client.send(build_request(client, url), stream=True)
+
+        upstream = upstream_key(url)
+        pending: Dict[asyncio.Future, str] = {}
+        next_index = 0
+        hedged = False
+        last_response, last_error = None, None
+
+        def launch():
+            nonlocal next_index
+            pending[asyncio.ensure_future(self._send_one(clients, urls[next_index], build_request))] = urls[next_index]
+            next_index += 1
+
+        launch()
+        delay = self.hedge_delay(urls[0])
+        try:
+            while pending:
+                can_hedge = delay is not None and not hedged and next_index < len(urls)
+                done, _ = await asyncio.wait(pending, timeout=delay if can_hedge else None, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    UPSTREAM_HEDGES.inc(upstream=upstream, result="sent")
+                    launch()
+                    continue
+                for task in done:
+                    task_url = pending.pop(task)
+                    if task.exception() is not None:
+                        last_error = task.exception()
+                        logger.warning("upstream [%s] error: %r" % (task_url, last_error))
+                        continue
+                    response = task.result()
+                    if response.status_code < 500:
+                        if hedged:
+                            UPSTREAM_HEDGES.inc(upstream=upstream, result="won" if task_url != urls[0] else "lost")
+                        return response
+                    logger.warning("upstream [%s] error: %s" % (task_url, response.status_code))
+                    if last_response is not None:
+                        await last_response.aclose()
+                    last_response = response
+                if not pending and next_index < len(urls):
+                    UPSTREAM_FAILOVERS.inc(upstream=upstream)
+                    launch()
+            if last_response is not None:
+                response, last_response = last_response, None
+                return response
+            raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
+                task.add_done_callback(_close_response)   # 已经拿到响应的输家关闭响应，归还连接
+            if last_response is not None:   # 其他地址成功了或者被取消时，关闭之前的5xx响应
+                asyncio.ensure_future(last_response.aclose())
+
+    async def _send_one(self, clients: UpstreamClients, url: str, build_request: Callable[[httpx.AsyncClient, str], httpx.Request]) -> httpx.Response:
+        health = self._health(url)
+        health.requests += 1
+        client = clients.get(url)
+        start = time.perf_counter()
+        try:
+            response = await client.send(build_request(client, url), stream=True)
+        except httpx.HTTPError:
+            self._failed(url, health)
+            raise
+        if response.status_code >= 500:
+            self._failed(url, health)
+        else:
+            health.consecutive_failures = 0
+            health.ttfb.append(time.perf_counter() - start)
+        return response
+
+    def _failed(self, url: str, health: UpstreamHealth):
+        health.failures += 1
+        health.consecutive_failures += 1
+        if self.max_failures and health.consecutive_failures >= self.max_failures and health.is_healthy():
+            health.ejected_until = time.time() + self.eject_seconds
+            logger.warning("upstream [%s] failed %s times in a row, eject for %ss" % (upstream_key(url), health.consecutive_failures, self.eject_seconds))
+
+    def stats(self) -> Dict[str, dict]:
+        return {key: health.stats() for key, health in self.health.items()}
+
+def _close_response(task: asyncio.Future):
+    if not task.cancelled() and task.exception() is None:
+        asyncio.ensure_future(task.result().aclose())
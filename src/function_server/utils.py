@@ -1,13 +1,26 @@
 import os
 import sys
 import time
+import heapq
+import json
+import hashlib
 import httpx
+from collections import OrderedDict
 from types import FrameType
-from typing import cast
+from typing import Any, Callable, List, cast
 import logging
 from loguru import logger
 from .settings import LOG_LEVEL
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
 
 def init_logger():
     logger.remove()
@@ -49,37 +62,130 @@ class InterceptHandler(logging.Handler):
         )
 
 class Cache:
-    def __init__(self, expire_milliseconds: float):
-        self.cache = {}
+    '''TTL + LRU缓存。过期条目按到期时间堆惰性清理，超过条目数或字节数上限时淘汰最久未使用的条目'''
+    def __init__(self, expire_milliseconds: float, max_entries: int = 0, max_bytes: int = 0, sizeof: Callable[[Any], int] = None):
+        self.cache: OrderedDict = OrderedDict()    # key -> (obj, expire_at, size)
+        self.expire_heap = []   # (expire_at, key)，条目被覆盖或删除后留下的旧记录在出堆时丢弃
         self.expire_milliseconds = expire_milliseconds
+        self.max_entries = max_entries  # 0 表示不限制
+        self.max_bytes = max_bytes  # 0 表示不限制
+        self.sizeof = sizeof
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
     
-    def put(self, key: str, obj, expire_at = None):
+    def put(self, key: str, obj, expire_at = None, size: int = None):
+        self.__check_if_expire()
         if expire_at is None:
             expire_at = time.time()*1000 + self.expire_milliseconds
-        self.cache[key] = (obj, expire_at)
-        self.__check_if_expire()
+        if size is None:
+            size = self.sizeof(obj) if self.sizeof else 0
+        self.__remove(key)
+        self.cache[key] = (obj, expire_at, size)
+        self.total_bytes += size
+        heapq.heappush(self.expire_heap, (expire_at, key))
+        self.__check_if_full()
     
     def get(self, key: str):
         self.__check_if_expire()
-        t = self.cache.get(key, (None, None))
+        t = self.cache.get(key)
+        if t is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.cache.move_to_end(key)
         return t[0]
     
     def pop(self, key: str):
         self.__check_if_expire()
-        t = self.cache.pop(key, (None, None))
+        t = self.__remove(key)
+        if t is None:
+            self.misses += 1
+            return None
+        self.hits += 1
         return t[0]
+
+    def resize(self, key: str, size: int):
+        '''对象的大小在put之后才确定时（如尚未完成的Task），在此更新'''
+        t = self.cache.get(key)
+        if t is None:
+            return
+        self.total_bytes += size - t[2]
+        self.cache[key] = (t[0], t[1], size)
+        self.__check_if_full()
     
     def clear(self):
         self.cache.clear()
+        self.expire_heap.clear()
+        self.total_bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.cache),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __remove(self, key: str):
+        t = self.cache.pop(key, None)
+        if t is not None:
+            self.total_bytes -= t[2]
+        return t
     
     def __check_if_expire(self):
         now = time.time()*1000
-        keys = []
-        for k,v in self.cache.items():
-            if now > v[1]:
-                keys.append(k)
-        for k in keys:
-            self.cache.pop(k, None)
+        while self.expire_heap and self.expire_heap[0][0] < now:
+            expire_at, key = heapq.heappop(self.expire_heap)
+            t = self.cache.get(key)
+            if t is not None and t[1] == expire_at:
+                self.__remove(key)
+                self.expirations += 1
+        if len(self.expire_heap) > 2 * len(self.cache) + 64:   # 旧记录过多时重建
+            self.expire_heap = [(t[1], k) for k, t in self.cache.items()]
+            heapq.heapify(self.expire_heap)
+
+    def __check_if_full(self):
+        while self.cache and ((self.max_entries and len(self.cache) > self.max_entries) or (self.max_bytes and self.total_bytes > self.max_bytes)):
+            key, t = self.cache.popitem(last=False)
+            self.total_bytes -= t[2]
+            self.evictions += 1
+
+def canonical_json(obj) -> bytes:
+    '''键排序、无空白的JSON，键顺序或空白不同的相同对象得到相同结果'''
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+        except TypeError:   # orjson不支持超过64位的整数等，退回标准库
+            pass
+    return json.dumps(obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode()
+
+def canonical_hash(obj: dict, ignore_fields: List[str] = ()) -> str:
+    '''规范化JSON的哈希。ignore_fields中的字段不参与计算，可用 a.b 表示嵌套字段'''
+    for field in ignore_fields:
+        obj = _without_field(obj, field.split("."))
+    data = canonical_json(obj)
+    if xxhash is not None:
+        return xxhash.xxh3_128_hexdigest(data)
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def _without_field(obj: dict, path: List[str]) -> dict:
+    '''返回去掉path字段的浅拷贝，不修改原对象'''
+    if not isinstance(obj, dict) or path[0] not in obj:
+        return obj
+    obj = dict(obj)
+    if len(path) == 1:
+        del obj[path[0]]
+    else:
+        obj[path[0]] = _without_field(obj[path[0]], path[1:])
+    return obj
 
 class ReReadbleHttpxSuccessfulResponse:    
     def __init__(self, response: httpx.Response):
@@ -0,0 +1,58 @@
+import asyncio
+import pytest
+from function_server.admission import AdmissionLimiter, AdmissionLimiters, Overloaded
+
+
+def test_queue_and_reject():
+    async def run():
+        limiter = AdmissionLimiter("tool", "t", 1, 1, 0.05)
+        acquired_at = await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded) as queue_full:
+            await limiter.acquire()
+        assert queue_full.value.status_code == 429
+        limiter.release(acquired_at)
+        limiter.release(await waiter)
+        assert (limiter.active, len(limiter.waiters)) == (0, 0)
+
+        acquired_at = await limiter.acquire()
+        with pytest.raises(Overloaded) as queue_timeout:
+            await limiter.acquire()
+        assert queue_timeout.value.status_code == 503
+        limiter.release(acquired_at)
+        assert (limiter.active, len(limiter.waiters), limiter.rejected) == (0, 0, 2)
+    asyncio.run(run())
+
+
+def test_release_after_lowering_max_concurrency():
+    async def run():
+        limiter = AdmissionLimiter("tool", "t", 2, 10, 0)
+        first, second = await limiter.acquire(), await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        limiter.set_max_concurrency(1)
+        limiter.release(first)
+        await asyncio.sleep(0)
+        # 占用还没有降到新上限以下，排队的继续等待
+        assert (limiter.active, len(limiter.waiters), waiter.done()) == (1, 1, False)
+        limiter.release(second)
+        limiter.release(await waiter)
+        assert (limiter.active, len(limiter.waiters)) == (0, 0)
+    asyncio.run(run())
+
+
+def test_raise_max_concurrency_wakes_waiters():
+    async def run():
+        max_concurrency = {"t": 1}
+        limiters = AdmissionLimiters("tool", lambda name: max_concurrency[name], 10, 0)
+        limiter = limiters.get("t")
+        acquired_at = await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        max_concurrency["t"] = 2
+        limiters.refresh("t")
+        limiter.release(await waiter)
+        limiter.release(acquired_at)
+        assert limiters.get("t") is limiter and limiter.active == 0
+    asyncio.run(run())
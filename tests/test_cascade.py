@@ -0,0 +1,46 @@
+import json
+import asyncio
+import httpx
+from openai.types.chat.chat_completion_message_tool_call import ChatCompletionMessageToolCall
+from function_server.cascade import RemoteFunctionServer
+
+
+class MockClients:
+    '''代替UpstreamClients，所有请求交给MockTransport'''
+    def __init__(self, handler):
+        self.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    def get(self, url: str) -> httpx.AsyncClient:
+        return self.client
+
+
+def tool_call(id: str, text: str) -> ChatCompletionMessageToolCall:
+    return ChatCompletionMessageToolCall(id=id, type="function", function={"name": "remote_echo", "arguments": json.dumps({"input": text})})
+
+
+def test_batch_with_duplicate_ids():
+    bodies = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        bodies.append(body)
+        results = [{"id": tc["id"], "result": tc["function"]["arguments"], "error": tc["id"] == "1"} for tc in body]
+        return httpx.Response(200, json={"results": list(reversed(results))})
+
+    async def run():
+        server = RemoteFunctionServer("http://remote", MockClients(handler))
+        # 两个并发请求的工具调用id相同，进入同一批
+        return await asyncio.gather(server.call(tool_call("call_0", "A")), server.call(tool_call("call_0", "B")))
+
+    a, b = asyncio.run(run())
+    assert len(bodies) == 1 and len(bodies[0]) == 2
+    assert (a.id, json.loads(a.result), a._is_error) == ("call_0", {"input": "A"}, False)
+    assert (b.id, json.loads(b.result), b._is_error) == ("call_0", {"input": "B"}, True)
+
+
+def test_batch_error():
+    async def run():
+        server = RemoteFunctionServer("http://remote", MockClients(lambda request: httpx.Response(500, text="boom")))
+        return await server.call(tool_call("call_0", "A")), server
+    result, server = asyncio.run(run())
+    assert result._is_error and server.errors == 1
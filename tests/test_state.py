@@ -0,0 +1,40 @@
+import time
+import asyncio
+from openai.types.chat.chat_completion_message_tool_call import ChatCompletionMessageToolCall
+from function_server.function_calling import ToolCallResult
+from function_server.state import SqliteStateBackend
+
+
+def result(id: str) -> ToolCallResult:
+    tool_call = ChatCompletionMessageToolCall(id=id, type="function", function={"name": "lookup", "arguments": "{}"})
+    return ToolCallResult(id=id, result="result of %s" % id, tool_call=tool_call)
+
+
+def test_pending_results(tmp_path):
+    async def run():
+        backend = SqliteStateBackend(str(tmp_path / "state.db"), 60, 60, 5)
+        future = asyncio.get_running_loop().create_future()
+        await backend.put_tool_call_results(["client_0", result("server_0"), future])
+        # 服务端工具还在执行，取结果的一方等待占位行被结果替换
+        pop = asyncio.ensure_future(backend.pop_tool_call_results("client_0"))
+        await asyncio.sleep(0.1)
+        assert not pop.done()
+        future.set_result(result("server_1"))
+        results = await pop
+        assert [r if isinstance(r, str) else (r.id, r.result) for r in results] == ["client_0", ("server_0", "result of server_0"), ("server_1", "result of server_1")]
+        assert await backend.pop_tool_call_results("client_0") is None
+        await backend.aclose()
+    asyncio.run(run())
+
+
+def test_failed_pending_results_drop_placeholder(tmp_path):
+    async def run():
+        backend = SqliteStateBackend(str(tmp_path / "state.db"), 60, 60, 5)
+        future = asyncio.get_running_loop().create_future()
+        await backend.put_tool_call_results(["client_0", future])
+        future.set_exception(RuntimeError("tool failed"))
+        start = time.time()
+        assert await backend.pop_tool_call_results("client_0") is None
+        assert time.time() - start < 1     # 不用等到pending_timeout
+        await backend.aclose()
+    asyncio.run(run())
@@ -0,0 +1,80 @@
+import json
+import asyncio
+from typing import List
+import httpx
+from function_server.streaming import ChatStreamTurn, ToolCallAssembler, split_fake_tool_calls
+
+
+def sse_response(contents: List[str]) -> httpx.Response:
+    chunks = [{"id": "c1", "object": "chat.completion.chunk", "created": 1, "model": "m",
+               "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}]} for content in contents]
+    chunks.append({"id": "c1", "object": "chat.completion.chunk", "created": 1, "model": "m", "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+    body = "".join("data: %s\n\n" % json.dumps(chunk) for chunk in chunks) + "data: [DONE]\n\n"
+    return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=body.encode())
+
+
+def forward(contents: List[str]) -> tuple[List[str], ChatStreamTurn]:
+    '''返回立即转发的文本和本轮'''
+    turn = ChatStreamTurn(sse_response(contents), True)
+
+    async def run():
+        return [event async for event in turn.aiter_forward()]
+    events = asyncio.run(run())
+    return ["".join(c["delta"].get("content") or "" for c in json.loads(event[6:])["choices"]) for event in events], turn
+
+
+def held_text(turn: ChatStreamTurn) -> str:
+    return "".join(c["choices"][0]["delta"].get("content") or "" for c in turn.held_chunks if c.get("choices"))
+
+
+def test_split_fake_tool_calls():
+    assert split_fake_tool_calls("see [1] and [2]") == ("see [1] and [2]", "", False)
+    assert split_fake_tool_calls("see [") == ("see ", "[", False)
+    assert split_fake_tool_calls("see [1] [\n ") == ("see [1] ", "[\n ", False)
+    assert split_fake_tool_calls("ok [ {\"id\"") == ("ok ", "[ {\"id\"", True)
+
+
+def test_brackets_in_answer_are_forwarded():
+    forwarded, turn = forward(["see [", "1] for details", ", and [2", "] too"])
+    assert "".join(forwarded) == "see [1] for details, and [2] too"
+    assert not turn.is_holding and held_text(turn) == ""
+    assert turn.get_tool_calls() is None
+
+
+def test_trailing_bracket_is_held_until_the_end():
+    forwarded, turn = forward(["see [1] and [", " "])
+    assert "".join(forwarded) == "see [1] and "
+    assert held_text(turn) == "[ "
+    assert turn.get_tool_calls() is None
+
+
+def test_tool_calls_are_held():
+    tool_calls = '[{"index": 0, "id": "call_0", "type": "function", "function": {"name": "search", "arguments": {"q": "x"}}}]'
+    forwarded, turn = forward(["see [1]. ", "[", tool_calls[1:20], tool_calls[20:]])
+    assert "".join(forwarded) == "see [1]. "
+    assert turn.is_holding and held_text(turn) == tool_calls
+    assert [(tc.id, tc.function.name, json.loads(tc.function.arguments)) for tc in turn.get_tool_calls()] == [("call_0", "search", {"q": "x"})]
+
+
+def test_tool_call_assembler_completes_each_call_once():
+    completed = []
+    assembler = ToolCallAssembler(completed.append)
+    assembler.feed([{"index": 0, "id": "call_0", "type": "function", "function": {"name": "search", "arguments": ""}}])
+    assembler.feed([{"index": 0, "function": {"arguments": '{"q": '}}])
+    assert completed == []
+    assembler.feed([{"index": 0, "function": {"arguments": '"x"}'}}])
+    assert [(tc.id, tc.function.arguments) for tc in completed] == [("call_0", '{"q": "x"}')]
+    # 参数不是JSON对象时，出现下一个index才算完整
+    assembler.feed([{"index": 1, "id": "call_1", "type": "function", "function": {"name": "lookup", "arguments": '{"k": "}'}}])
+    assembler.feed([{"index": 1, "function": {"arguments": 'v"'}}])
+    assert [tc.id for tc in completed] == ["call_0"]
+    assembler.feed([{"index": 2, "id": "call_2", "type": "function", "function": {"name": "lookup", "arguments": "[1]"}}])
+    assert [tc.id for tc in completed] == ["call_0", "call_1"]
+    assert [(tc.index, tc.id, tc.function.name, tc.function.arguments) for tc in assembler.tool_calls] == [
+        (0, "call_0", "search", '{"q": "x"}'), (1, "call_1", "lookup", '{"k": "}v"'), (2, "call_2", "lookup", "[1]")]
+
+
+def test_tool_call_assembler_without_callback():
+    assembler = ToolCallAssembler()
+    assembler.feed([{"id": "call_0", "function": {"name": "search", "arguments": "{}"}}])
+    assert [(tc.index, tc.type, tc.function.arguments) for tc in assembler.tool_calls] == [(0, "function", "{}")]
@@ -0,0 +1,46 @@
+import json
+import pytest
+from openai.types.chat.chat_completion_message_tool_call import ChatCompletionMessageToolCall
+from function_server.function_calling import PINNED_TOOLS, ToolCallResult, tool
+from function_server.tool_results import ToolResultBudget
+
+
+@tool
+def lookup(key: str) -> str:
+    '''lookup'''
+    return key
+
+
+@pytest.fixture(autouse=True)
+def tools():
+    token = PINNED_TOOLS.set({"lookup": (lookup, {"type": "function", "function": {"name": "lookup"}})})
+    yield
+    PINNED_TOOLS.reset(token)
+
+
+def result(id: str, text: str) -> ToolCallResult:
+    tool_call = ChatCompletionMessageToolCall(id=id, type="function", function={"name": "lookup", "arguments": json.dumps({"key": id})})
+    return ToolCallResult(id=id, result=text * 100, tool_call=tool_call)
+
+
+def test_dedup_in_one_round():
+    budget = ToolResultBudget()
+    first, second = budget.apply([result("call_0", "a"), result("call_1", "a")])
+    assert first.result == "a" * 100
+    assert second.result == "(same result as tool call `call_0`)"
+
+
+def test_dedup_with_reused_ids():
+    budget = ToolResultBudget()
+    budget.apply([result("call_0", "a")])
+    # fake模式下一轮的id又从call_0开始
+    first, second = budget.apply([result("call_0", "b"), result("call_1", "a")])
+    assert first.result == "b" * 100
+    assert second.result == "(same result as tool call `call_0` in tool results round 1)"
+    third, = budget.apply([result("call_0", "b")])
+    assert third.result == "(same result as tool call `call_0` in tool results round 2)"
+
+
+def test_dedup_disabled():
+    results = ToolResultBudget(dedup=False).apply([result("call_0", "a"), result("call_1", "a")])
+    assert [r.result for r in results] == ["a" * 100] * 2
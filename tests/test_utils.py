@@ -0,0 +1,57 @@
+import time
+from function_server.utils import Cache, canonical_hash, canonical_json
+
+
+def test_cache_ttl():
+    cache = Cache(20)
+    cache.put("a", 1)
+    cache.put("b", 2, expire_at=time.time()*1000 + 60000)
+    assert cache.get("a") == 1
+    time.sleep(0.05)
+    assert cache.get("a") is None and cache.get("b") == 2
+    assert cache.stats()["expirations"] == 1
+
+
+def test_cache_lru_entries():
+    cache = Cache(60000, max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")      # b成为最久未使用的
+    cache.put("c", 3)
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == (1, None, 3)
+    assert cache.stats()["evictions"] == 1
+
+
+def test_cache_bytes():
+    cache = Cache(60000, max_bytes=10, sizeof=len)
+    cache.put("a", "xxxx")
+    cache.put("b", "yyyy")
+    cache.put("a", "xxxxx")     # 覆盖时重新计算大小
+    assert cache.total_bytes == 9
+    cache.put("c", "zzz")
+    assert cache.get("b") is None and len(cache) == 2 and cache.total_bytes == 8
+    cache.resize("a", 20)      # 单个条目超过上限时也被淘汰
+    assert cache.get("a") is None and cache.total_bytes == 3
+
+
+def test_cache_pop():
+    cache = Cache(60000, sizeof=len)
+    cache.put("a", "xx")
+    assert cache.pop("a") == "xx" and cache.pop("a") is None
+    assert cache.total_bytes == 0 and (cache.hits, cache.misses) == (1, 1)
+
+
+def test_canonical_json():
+    assert canonical_json({"b": 1, "a": [1, {"d": 2, "c": "中"}]}) == canonical_json({"a": [1, {"c": "中", "d": 2}], "b": 1})
+    assert canonical_json({"n": 2**70}) == b'{"n":1180591620717411303424}'
+
+
+def test_canonical_hash_ignore_fields():
+    request = {"model": "m", "user": "u1", "stream_options": {"include_usage": True, "x": 1}, "messages": [{"role": "user", "content": "hi"}]}
+    other = dict(request, user="u2", stream_options={"include_usage": False, "x": 1})
+    ignore = ["user", "stream_options.include_usage"]
+    assert canonical_hash(request) != canonical_hash(other)
+    assert canonical_hash(request, ignore) == canonical_hash(other, ignore)
+    assert canonical_hash(request, ignore) != canonical_hash(dict(other, messages=[]), ignore)
+    assert request["user"] == "u1" and "include_usage" in request["stream_options"]    # 不修改原对象
+    assert canonical_hash(request, ["missing.field", "model.x"]) == canonical_hash(request)
@@ -0,0 +1,15 @@
+from pathlib import Path
+import pytest
+from function_server.tools.websearch import ENGINES
+
+FIXTURES = Path(__file__).parent / "fixtures" / "websearch"
+EXPECTED = [
+    {"title": "FastAPI", "url": "https://fastapi.tiangolo.com/", "text": "FastAPI is a modern, fast web framework for building APIs."},
+    {"title": "tiangolo/fastapi - GitHub", "url": "https://github.com/tiangolo/fastapi", "text": "FastAPI framework, high performance, easy to learn."},
+]
+
+
+@pytest.mark.parametrize("engine", ["bing", "google", "duckduckgo"])
+def test_parse_saved_page(engine):
+    html = (FIXTURES / f"{engine}.html").read_text(encoding="utf-8")
+    assert ENGINES[engine].parse(html) == EXPECTED